@@ -2,90 +2,156 @@ import os
 import json
 import re
 import glob
+import importlib
 import numpy as np
-import faiss
-import markdown
 from datetime import datetime
 import tempfile
-from docx import Document
-from docx.shared import Pt, Inches, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from openai import OpenAI
-from sentence_transformers import SentenceTransformer
-import PyPDF2
 import streamlit as st
-from PIL import Image
-import streamlit.components.v1 as components
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 from typing import List, Dict, Any, Tuple, Optional
-import matplotlib.pyplot as plt
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
-import pandas as pd
-from io import BytesIO
-import base64
-import requests
-import plotly.express as px
 from collections import Counter
 import unicodedata # Import unicodedata for advanced cleaning
+import hashlib
+import zlib
+import zipfile
+import ntpath
+import posixpath
+import sqlite3
+import threading
+import time
+import shutil
+import weakref
+import sys
+import socket
+import argparse
+import http.client
+import heapq
+import pickle
+import multiprocessing
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlparse, urlencode, quote
+from collections import OrderedDict
+from collections.abc import Mapping
+
+IMPORT_TIMINGS = {} # module name -> seconds spent importing it on first use
+_IMPORT_LOCK = threading.RLock()
+
+class LazyModule:
+    """Stand-in for a heavy module that is imported on first attribute access.
+
+    Keeps faiss, torch/sentence-transformers, scikit-learn, PyPDF2, python-docx and the
+    OpenAI client off the startup path; each is loaded by the first feature that needs it.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            with _IMPORT_LOCK:
+                if self._module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    IMPORT_TIMINGS[self._name] = time.perf_counter() - start
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<LazyModule {self._name} ({state})>"
+
+faiss = LazyModule("faiss")
+sp = LazyModule("scipy.sparse")
+sentence_transformers = LazyModule("sentence_transformers")
+openai = LazyModule("openai")
+PyPDF2 = LazyModule("PyPDF2")
+docx = LazyModule("docx")
+lxml_etree = LazyModule("lxml.etree")
+docx_shared = LazyModule("docx.shared")
+docx_text = LazyModule("docx.enum.text")
+sklearn_text = LazyModule("sklearn.feature_extraction.text")
+sklearn_pairwise = LazyModule("sklearn.metrics.pairwise")
 
 
 
 # Helper function to remove problematic Unicode characters
+class CleanText(str):
+    """A string already passed through remove_problematic_chars, so cleaning it again is free.
+
+    Only the cleaner's own results (and section text read from the document store)
+    carry the tag; slicing or concatenating gives a plain str again. Pickles as a
+    plain str, so worker processes never need this class to unpickle results.
+    """
+    __slots__ = ()
+
+    def __reduce__(self):
+        return (str, (str(self),))
+
+# Typographic characters spelled out in ASCII; after them only printable ASCII, tab,
+# newline, carriage return and the non-breaking space survive
+_CLEAN_REPLACEMENTS = {
+    '\u2013': '-', # En dash
+    '\u2014': '-', # Em dash
+    '\u2018': "'", # Left single quote
+    '\u2019': "'", # Right single quote (apostrophe)
+    '\u201c': '"', # Left double quote
+    '\u201d': '"', # Right double quote
+    '\u2026': '...', # Ellipsis
+    '\u2022': '*', # Bullet point
+    '\u2122': '(TM)', # Trade Mark symbol
+    '\u00AE': '(R)', # Registered symbol
+    '\u00A9': '(C)', # Copyright symbol
+}
+# Latin-1 bytes dropped after encoding: control characters and everything above 0x7E but the NBSP
+_DROPPED_LATIN1 = bytes(b for b in range(0x100) if not (0x20 <= b <= 0x7E or b in b'\n\r\t\xa0'))
+
 def remove_problematic_chars(text):
     """Removes characters that might cause encoding or display issues,
        especially those outside common encodings like latin-1, by replacing
-       common problematic characters and filtering others."""
-    if not isinstance(text, str):
-        return text # Return as is if not a string
-
-    # Replace common problematic characters with safe alternatives
-    cleaned_text = text.replace('\u2013', '-') # En dash
-    cleaned_text = cleaned_text.replace('\u2014', '-') # Em dash
-    cleaned_text = cleaned_text.replace('\u2018', "'") # Left single quote
-    cleaned_text = cleaned_text.replace('\u2019', "'") # Right single quote (apostrophe)
-    cleaned_text = cleaned_text.replace('\u201c', '"') # Left double quote
-    cleaned_text = cleaned_text.replace('\u201d', '"') # Right double quote
-    cleaned_text = cleaned_text.replace('\u2026', '...') # Ellipsis
-    cleaned_text = cleaned_text.replace('\u2022', '*') # Bullet point
-    cleaned_text = cleaned_text.replace('\u2122', '(TM)') # Trade Mark symbol
-    cleaned_text = cleaned_text.replace('\u00AE', '(R)') # Registered symbol
-    cleaned_text = cleaned_text.replace('\u00A9', '(C)') # Copyright symbol
-
-
-    # Attempt standard encode/decode with 'ignore' errors for characters still problematic
-    # This is a fallback and might lose some characters not explicitly handled above
-    try:
-        # Try encoding to latin-1 and then decoding. Characters not in latin-1 will be ignored.
-        cleaned_text = cleaned_text.encode('latin-1', errors='ignore').decode('latin-1')
-    except UnicodeEncodeError:
-        # If latin-1 encoding still fails unexpectedly, try a more aggressive UTF-8 encode/decode with replace
-        cleaned_text = cleaned_text.encode('utf-8', errors='replace').decode('utf-8')
-    except Exception as e:
-        # Catch any other potential encoding errors during this step
-        print(f"Warning: Error during initial encoding cleanup: {e}. Proceeding with filtering.")
-
-
-    # Further filter potentially problematic Unicode characters using a stricter regex
-    # This regex aims to keep printable ASCII, common whitespace, and a limited set of safe Unicode.
-    # It removes control characters, surrogates, and many other non-ASCII characters.
-    # Keeping only printable ASCII and basic whitespace:
-    # \x20-\x7E : Printable ASCII characters (space to tilde)
-    # \n\r\t : Newline, carriage return, tab
-    # \u00A0 : Non-breaking space (often useful)
-    # \u20AC : Euro sign (common) - can add others if needed
-    # This regex is stricter than the previous one to avoid latin-1 issues.
-    # Adjust the regex based on what characters are expected/allowed in the output documents.
-    # Current regex keeps printable ASCII, newline, carriage return, tab, and non-breaking space.
-    problematic_chars_regex = re.compile(r'[^\x20-\x7E\n\r\t\u00A0]')
-
-
-    filtered_text = problematic_chars_regex.sub('', cleaned_text)
-
-    return filtered_text
+       common problematic characters and filtering others.
+
+    Keeps printable ASCII, tab/newline/carriage return and the non-breaking space.
+    Every step runs in C: replacements only for characters actually present, a latin-1
+    encode that drops the rest of Unicode, and one precomputed bytes.translate deletion
+    table (str.translate leaves CPython's fast path on non-ASCII input). The result is
+    a CleanText, which is returned unchanged if passed in again.
+    """
+    if not isinstance(text, str) or isinstance(text, CleanText):
+        return text # Return as is if not a string (or already cleaned)
+    if not text.isascii():
+        for char, replacement in _CLEAN_REPLACEMENTS.items():
+            if char in text:
+                text = text.replace(char, replacement)
+    return CleanText(text.encode('latin-1', errors='ignore').translate(None, _DROPPED_LATIN1).decode('latin-1'))
+
+
+# PDF page extraction pool and page-text cache; see PdfPageExtractor
+DEFAULT_DOCUMENT_EXTRACTION_CONFIG = {
+    "pdf_workers": 0,
+    "pdf_executor": "process",
+    "pdf_parallel_min_pages": 24,
+    "pdf_pages_per_task": 8,
+    "page_cache_dir": ".kb_cache/pages",
+    "page_cache_max_entries": 50000
+}
+UPLOAD_SPOOL_CHUNK_BYTES = 1 << 20
 
 
 # Load configuration
+def merge_config(defaults, overrides):
+    """Recursively merge overrides into a copy of defaults; nested sections keep their missing defaults"""
+    merged = dict(defaults)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
 def load_config():
     """Load configuration from config.json or create default if not exists"""
     config_path = "config.json"
@@ -107,8 +173,63 @@ def load_config():
         "knowledge_base": {
             "directory": "markdown_responses",
             "embedding_model": "all-MiniLM-L6-v2",
+            "embedding_cache_dir": ".kb_cache/embeddings",
+            "embedding_cache_max_entries": 200000,
+            "snapshot_dir": ".kb_cache/snapshots",
+            "snapshots_to_keep": 2,
+            "passage_max_tokens": 0,
+            "passage_overlap_tokens": 32,
+            "passage_fetch_factor": 4,
+            "bm25": {"k1": 1.5, "b": 0.75, "epsilon": 0.25},
+            # Near-duplicate sections (technical/commercial pairs, "Copy of" files) are indexed once
+            "dedup": {"enabled": True, "threshold": 0.85, "num_perm": 128, "bands": 16, "shingle_words": 5, "min_words": 40},
+            "rrf_k": 60,
+            "multi_hop_always_refine": True, # False: skip the query-expansion hop when the first hop fills k
+            "query_cache_size": 1024,
+            "result_cache_size": 512,
+            "filter_exact_max_passages": 4096,
+            "service_url": "", # e.g. "http://127.0.0.1:8765" or "unix:///tmp/rfp-kb.sock" to use `python FINAL.py serve-kb`
+            "shard_urls": [], # one `serve-kb --shard I/N` server per shard; searched with scatter-gather
+            "ingest_workers": 0, # file parsers; 0 = one per core
+            "ingest_executor": "thread", # or "process" to also parallelize text cleaning on large corpora
+            "ingest_batch_size": 1024, # sections/passages per chunking and embedding batch
+            "ingest_spill_mb": 64, # section text held in memory during a build before it moves to a scratch file
+            "ingest_encode_processes": 0, # >1: sentence-transformers multi-process encoding for large builds
+            "ingest_multiprocess_min_texts": 2000,
+            "coarse_documents": 200, # search only the sections of the N closest response files...
+            "coarse_min_files": 2000, # ...once the archive has more files than this (coarse_documents 0 disables it)
+            "watch_directory": False, # hot-reload on file changes (needs watchdog); otherwise polled per session rerun
+            "watch_debounce_seconds": 2.0,
+            "embedding_backend": "torch", # "torch", "int8" or "onnx"; check with `python FINAL.py bench-embedding-backend`
+            "embedding_onnx_file": "", # e.g. "onnx/model_qint8_avx512_vnni.onnx" for a quantized ONNX export
+            "embedding_backend_min_overlap": 0.9,
+            "index": {
+                "type": "auto",
+                "flat_max_vectors": 20000,
+                "hnsw_max_vectors": 200000,
+                "hnsw_m": 32,
+                "hnsw_ef_construction": 80,
+                "hnsw_ef_search": 64,
+                "ivf_nlist": 0,
+                "ivf_nprobe": 16,
+                "pq_subquantizers": 48,
+                "train_max_vectors": 65536, # IVF-PQ / compression training sample
+                "compression": "none", # "sq8" or "pq" shrink stored vectors; check with `python FINAL.py bench-compression`
+                "pca_dims": 0,
+                "rerank_factor": 4,
+                "recall_eval_queries": 200,
+                "recall_eval_k": 10
+            },
             "metadata_fields": ["client_industry", "proposal_success", "project_size", "key_differentiators"]
         },
+        "document_extraction": {
+            "pdf_workers": 0, # page extraction processes; 0 = one per core
+            "pdf_executor": "process", # or "thread"
+            "pdf_parallel_min_pages": 24, # smaller PDFs are extracted in-process
+            "pdf_pages_per_task": 8,
+            "page_cache_dir": ".kb_cache/pages", # extracted page text by (file hash, page); "" disables
+            "page_cache_max_entries": 50000
+        },
         "proposal_settings": {
             "default_sections": [],
             "max_tokens_per_section": 2000,
@@ -145,10 +266,8 @@ def load_config():
         with open(config_path, 'r') as f:
             config = json.load(f)
             # Merge with default config to ensure all keys exist
-            # This handles cases where config.json exists but is missing sections
-            merged_config = default_config.copy()
-            merged_config.update(config)
-            return merged_config
+            # This handles cases where config.json exists but is missing sections or nested keys
+            return merge_config(default_config, config)
     except json.JSONDecodeError:
         print(f"Error decoding JSON from {config_path}. Using default config.")
         return default_config
@@ -158,9 +277,137 @@ def load_config():
 
 
 # Document processing functions
+# WordprocessingML (transitional) names used by the streaming DOCX extractor
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_P, _W_TBL, _W_TR, _W_TC, _W_PPR = _W + "p", _W + "tbl", _W + "tr", _W + "tc", _W + "pPr"
+_W_T, _W_TAB, _W_BR, _W_CR = _W + "t", _W + "tab", _W + "br", _W + "cr"
+_W_TXBX = _W + "txbxContent"
+_PACKAGE_RELATIONSHIPS = "{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"
+_OFFICE_DOCUMENT_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+_STYLES_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles"
+_BUILTIN_HEADING_STYLE = re.compile(r"heading [1-9]")
+
+
+def _docx_part_target(package, rels_name: str, base_dir: str, rel_type: str) -> Optional[str]:
+    """Package path of the first relationship of ``rel_type`` in a .rels part"""
+    try:
+        root = lxml_etree.fromstring(package.read(rels_name))
+    except KeyError:
+        return None
+    for rel in root.iter(_PACKAGE_RELATIONSHIPS):
+        if rel.get("Type") == rel_type:
+            target = rel.get("Target", "")
+            return target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join(base_dir, target))
+    return None
+
+
+def _docx_heading_styles(package, styles_part: Optional[str]) -> Dict[str, int]:
+    """Paragraph style id -> heading level for styles whose UI name starts with Heading"""
+    levels = {}
+    if not styles_part:
+        return levels
+    try:
+        root = lxml_etree.fromstring(package.read(styles_part))
+    except KeyError:
+        return levels
+    for style in root.iter(_W + "style"):
+        name_element = style.find(_W + "name")
+        name = name_element.get(_W + "val", "") if name_element is not None else ""
+        if _BUILTIN_HEADING_STYLE.fullmatch(name):
+            name = name.capitalize()  # built-in "heading 1" is shown as "Heading 1"
+        if name.startswith("Heading"):
+            levels[style.get(_W + "styleId")] = int(name[-1]) if name[-1].isdigit() else 1
+    return levels
+
+
+def _docx_paragraph_text(paragraph) -> str:
+    parts = []
+    for child in paragraph:
+        if child.tag == _W_PPR:
+            continue  # tab stop definitions are w:tab too
+        for element in child.iter(_W_T, _W_TAB, _W_BR, _W_CR):
+            if element.tag == _W_T:
+                parts.append(element.text or "")
+            elif element.tag == _W_TAB:
+                parts.append("\t")
+            elif element.tag == _W_CR or element.get(_W + "type") in (None, "textWrapping"):
+                parts.append("\n")
+    return "".join(parts)
+
+
+def iter_docx_blocks(file_path):
+    """Stream a DOCX body in document order as (kind, text, heading_level) tuples.
+
+    ``kind`` is "heading", "paragraph" or "row" (non-empty cells joined with " | "); text is
+    cleaned and stripped, empty blocks are skipped. The main part is read with lxml iterparse
+    and every finished block is freed, so memory stays flat however many tables a tender has.
+    Text boxes are skipped, as python-docx does; rows of nested tables come before the row
+    that contains them.
+    """
+    with zipfile.ZipFile(file_path) as package:
+        document_part = _docx_part_target(package, "_rels/.rels", "", _OFFICE_DOCUMENT_REL) or "word/document.xml"
+        part_dir, part_file = posixpath.split(document_part)
+        styles_part = _docx_part_target(package, posixpath.join(part_dir, "_rels", part_file + ".rels"), part_dir, _STYLES_REL)
+        heading_levels = _docx_heading_styles(package, styles_part)
+
+        table_depth = 0
+        textbox_depth = 0
+        with package.open(document_part) as stream:
+            for event, element in lxml_etree.iterparse(stream, events=("start", "end"), tag=(_W_P, _W_TBL, _W_TR, _W_TXBX)):
+                tag = element.tag
+                if tag == _W_TXBX:
+                    textbox_depth += 1 if event == "start" else -1
+                    continue
+                if tag == _W_TBL:
+                    table_depth += 1 if event == "start" else -1
+                    if event == "end" and table_depth == 0 and textbox_depth == 0:
+                        _release_docx_element(element)
+                    continue
+                if event == "start":
+                    continue
+                if textbox_depth:
+                    element.clear()  # keeps text box content out of the enclosing paragraph
+                elif tag == _W_TR:
+                    cells = []
+                    for cell in element.iterchildren(_W_TC):
+                        text = remove_problematic_chars("\n".join(_docx_paragraph_text(p) for p in cell.iterchildren(_W_P)).strip())
+                        if text:
+                            cells.append(text)
+                    if cells:
+                        yield "row", " | ".join(cells), 0
+                    element.clear()
+                elif table_depth == 0:
+                    text = remove_problematic_chars(_docx_paragraph_text(element).strip())
+                    if text:
+                        style = element.find(f"{_W_PPR}/{_W}pStyle")
+                        level = heading_levels.get(style.get(_W + "val")) if style is not None else None
+                        if level:
+                            yield "heading", text, level
+                        else:
+                            yield "paragraph", text, 0
+                    _release_docx_element(element)
+
+
+def _release_docx_element(element):
+    """Free a finished block and the already processed siblings before it"""
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
 def extract_text_from_docx(file_path):
-    """Extract text from DOCX files including tables and headers"""
-    doc = Document(file_path)
+    """Extract text from DOCX files: headings (as markdown), paragraphs and table rows in document order"""
+    lines = []
+    for kind, text, level in iter_docx_blocks(file_path):
+        lines.append(f"{'#' * level} {text}" if kind == "heading" else text)
+    return CleanText('\n'.join(lines)) # Text is already cleaned
+
+
+def _object_model_extract_text_from_docx(file_path):
+    """Previous python-docx extractor (all tables, then all paragraphs); baseline for bench-docx"""
+    doc = docx.Document(file_path)
     full_text = []
 
     for table in doc.tables:
@@ -188,60 +435,370 @@ def extract_text_from_docx(file_path):
     return '\n'.join(full_text) # Text is already cleaned
 
 
-def extract_text_from_pdf(file_path):
-    """Extract text from PDF documents"""
+def file_sha256(file_path: str, chunk_bytes: int = 1 << 20) -> str:
+    """SHA-256 of a file's bytes, read in chunks"""
+    digest = hashlib.sha256()
     with open(file_path, 'rb') as file:
-        reader = PyPDF2.PdfReader(file)
-        text = []
-        for page in reader.pages:
-            # Apply cleaning to extracted page text
-            cleaned_page_text = remove_problematic_chars(page.extract_text())
-            text.append(cleaned_page_text)
-    return '\n'.join(text) # Text is already cleaned
+        for chunk in iter(lambda: file.read(chunk_bytes), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Each extraction worker keeps its last opened PDF, so the tasks of one document parse it once
+_PDF_WORKER_STATE = threading.local()
+
+def _extract_pdf_page_range(file_path: str, page_numbers: List[int]) -> List[Tuple[int, str]]:
+    """Cleaned text of the given (0-based) pages; runs in a PDF extraction worker"""
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_size, stat.st_mtime_ns)
+    if getattr(_PDF_WORKER_STATE, "key", None) != key:
+        previous = getattr(_PDF_WORKER_STATE, "file", None)
+        if previous is not None:
+            previous.close()
+        _PDF_WORKER_STATE.key, _PDF_WORKER_STATE.file, _PDF_WORKER_STATE.reader = None, None, None
+        file = open(file_path, 'rb')
+        _PDF_WORKER_STATE.file, _PDF_WORKER_STATE.reader = file, PyPDF2.PdfReader(file)
+        _PDF_WORKER_STATE.key = key
+    reader = _PDF_WORKER_STATE.reader
+    return [(n, remove_problematic_chars(reader.pages[n].extract_text() or "")) for n in page_numbers]
+
+
+class PdfPageExtractor:
+    """Page-level PDF text extraction on a worker pool, with a persistent page-text cache.
+
+    ``iter_pages`` yields pages as they finish so callers can show progress. Pages are cached
+    by (file hash, page number), so re-uploading a document only costs hashing it. PDFs with
+    fewer than ``pdf_parallel_min_pages`` uncached pages are extracted in-process; larger ones
+    are split into runs of ``pdf_pages_per_task`` pages for ``pdf_workers`` (0 = one per core)
+    spawn processes, kept alive between documents. Like the ingestion pool, extraction falls
+    back to threads when this module cannot be re-imported in a child process.
+    """
+    def __init__(self, settings: Optional[Dict[str, Any]] = None):
+        settings = {**DEFAULT_DOCUMENT_EXTRACTION_CONFIG, **(settings or {})}
+        self.workers = int(settings["pdf_workers"]) or min(32, os.cpu_count() or 1)
+        self.use_processes = settings["pdf_executor"] == "process"
+        self.parallel_min_pages = int(settings["pdf_parallel_min_pages"])
+        self.pages_per_task = max(1, int(settings["pdf_pages_per_task"]))
+        self.page_cache = None
+        if settings["page_cache_dir"]:
+            try:
+                self.page_cache = PageTextCache(settings["page_cache_dir"], settings["page_cache_max_entries"])
+            except (OSError, sqlite3.Error) as e:
+                print(f"Warning: Could not open page text cache ({e}). PDF pages will not be cached.")
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                if self.use_processes:
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+                else:
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="pdf-extract")
+            return self._executor
+
+    def _fall_back_to_threads(self, error):
+        print(f"Warning: Process pool PDF extraction failed ({error}). Continuing with threads.")
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self.use_processes = False
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def iter_pages(self, file_path: str):
+        """Yield (page_number, page_count, cleaned_text) for every page, in completion order"""
+        file_hash = file_sha256(file_path)
+        page_count, cached = self.page_cache.get(file_hash) if self.page_cache else (None, {})
+        if page_count is None or len(cached) < page_count:
+            with open(file_path, 'rb') as file:
+                page_count = len(PyPDF2.PdfReader(file).pages)
+        for page_number in sorted(cached):
+            yield page_number, page_count, cached[page_number]
+
+        missing = [n for n in range(page_count) if n not in cached]
+        extracted = {}
+        try:
+            if len(missing) < max(self.parallel_min_pages, 2) or self.workers <= 1:
+                for page_number, text in self._extract_serially(file_path, missing):
+                    extracted[page_number] = text
+                    yield page_number, page_count, text
+            else:
+                for page_number, text in self._extract_in_pool(file_path, missing):
+                    extracted[page_number] = text
+                    yield page_number, page_count, text
+        finally:
+            # Cache whatever finished, also when the caller stops early
+            if self.page_cache and extracted:
+                self.page_cache.put_many(file_hash, page_count, extracted)
+
+    @staticmethod
+    def _extract_serially(file_path, page_numbers):
+        with open(file_path, 'rb') as file:
+            reader = PyPDF2.PdfReader(file)
+            for n in page_numbers:
+                yield n, remove_problematic_chars(reader.pages[n].extract_text() or "")
+
+    def _extract_in_pool(self, file_path, page_numbers):
+        remaining = list(page_numbers)
+        finished = set()
+        while remaining:
+            executor = self._pool()
+            futures = [
+                executor.submit(_extract_pdf_page_range, file_path, remaining[start:start + self.pages_per_task])
+                for start in range(0, len(remaining), self.pages_per_task)
+            ]
+            try:
+                for future in as_completed(futures):
+                    for page_number, text in future.result():
+                        finished.add(page_number)
+                        yield page_number, text
+            except (BrokenProcessPool, pickle.PicklingError) as e:
+                # e.g. when this module cannot be re-imported in a child process
+                if not self.use_processes:
+                    raise
+                self._fall_back_to_threads(e)
+            finally:
+                for future in futures:
+                    future.cancel()
+            remaining = [n for n in remaining if n not in finished]
+
+    def extract(self, file_path: str, progress=None) -> str:
+        """Full document text, pages in order; ``progress(done, total)`` is called per page"""
+        pages = {}
+        for page_number, page_count, text in self.iter_pages(file_path):
+            pages[page_number] = text
+            if progress is not None:
+                progress(len(pages), page_count)
+        return CleanText('\n'.join(pages[n] for n in sorted(pages))) # Pages are already cleaned
+
+
+_PDF_EXTRACTOR = None
+_PDF_EXTRACTOR_LOCK = threading.Lock()
+
+def configure_document_extraction(settings: Optional[Dict[str, Any]] = None) -> PdfPageExtractor:
+    """(Re)create the shared PDF extractor from the "document_extraction" config section"""
+    global _PDF_EXTRACTOR
+    with _PDF_EXTRACTOR_LOCK:
+        if _PDF_EXTRACTOR is not None:
+            _PDF_EXTRACTOR.shutdown()
+        _PDF_EXTRACTOR = PdfPageExtractor(settings)
+        return _PDF_EXTRACTOR
+
+def pdf_extractor() -> PdfPageExtractor:
+    with _PDF_EXTRACTOR_LOCK:
+        extractor = _PDF_EXTRACTOR
+    return extractor if extractor is not None else configure_document_extraction()
+
+
+def extract_text_from_pdf(file_path, progress=None):
+    """Extract text from PDF documents page by page; ``progress(done, total)`` reports pages"""
+    return pdf_extractor().extract(file_path, progress)
+
+
+# RFP headings, matched in a single pass over the whole text. Alternatives, in priority order:
+# numbered or plain title lines ("2.1. Scope of Work"), ALL-CAPS lines ending in ':' or '.',
+# and "Section 3: Pricing". [^\S\n] is whitespace other than a newline, so a heading never
+# spans lines.
+RFP_HEADING_PATTERN = re.compile(
+    r"^[^\S\n]*(?:"
+    r"(?P<number>(?:\d+\.){1,3})?[^\S\n]*(?P<title>[A-Z][A-Za-z \t\r\f\v\xa0]+)"
+    r"|(?P<caps>[A-Z][A-Z \t\r\f\v\xa0]+)[:.]"
+    r"|(?:Section|SECTION)[^\S\n]+(?P<section>\d+)[^\S\n]*[:\-.][^\S\n]*(?P<section_title>[A-Za-z \t\r\f\v\xa0]+)"
+    r")[^\S\n]*$",
+    re.MULTILINE
+)
+RFP_TITLE_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+class RFPSection:
+    """One heading of a parsed RFP with character offsets into the cleaned text.
+
+    ``start`` is where the heading line begins, ``body_start``/``end`` bound the section's own
+    text (up to the next heading of any level) and ``subtree_end`` the end of its last
+    subsection. The root section ("Overview", level 0) holds the text before the first heading.
+    """
+    __slots__ = ("title", "number", "level", "order", "start", "body_start", "end",
+                 "subtree_end", "has_body", "children")
+
+    def __init__(self, title: str, number: str, level: int, order: int, start: int, body_start: int):
+        self.title = title
+        self.number = number
+        self.level = level
+        self.order = order
+        self.start = start
+        self.body_start = body_start
+        self.end = body_start
+        self.subtree_end = body_start
+        self.has_body = False
+        self.children = []
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "title": self.title,
+            "number": self.number,
+            "level": self.level,
+            "start": self.start,
+            "body_start": self.body_start,
+            "end": self.end,
+            "subtree_end": self.subtree_end,
+            "children": [child.to_dict() for child in self.children]
+        }
 
+    def __repr__(self):
+        return f"RFPSection({self.number + ' ' if self.number else ''}{self.title!r}, level={self.level})"
 
-def extract_sections_from_rfp(rfp_text):
-    """Extract structured sections from the RFP text with improved pattern matching"""
-    # Ensure the input text is cleaned before processing
-    cleaned_rfp_text = remove_problematic_chars(rfp_text)
 
-    section_patterns = [
-        r'^(?:\d+\.)?(?:\d+\.)?(?:\d+\.)?\s*([A-Z][A-Za-z\s]+)$',
-        r'^([A-Z][A-Z\s]+)(?:\:|\.)?\s*$',
-        r'^(?:Section|SECTION)\s+\d+\s*[\:\-\.]\s*([A-Za-z\s]+)$'
-    ]
+def _rfp_heading_level(number: str, title: str) -> int:
+    """Numbered headings nest by depth ("2.1." is level 2); unnumbered ALL-CAPS and "Section N"
+    headings are top level, other unnumbered title lines sit one level below"""
+    if number:
+        return number.count('.')
+    return 1 if title.isupper() else 2
 
-    sections = {}
-    current_section = "Overview"
-    current_content = []
 
-    for line in cleaned_rfp_text.split('\n'):
-        matched = False
-        for pattern in section_patterns:
-            match = re.match(pattern, line.strip())
-            if match:
-                if current_content:
-                    sections[current_section] = '\n'.join(current_content)
-                    current_content = []
+def _rfp_title_key(title: str) -> Tuple[str, ...]:
+    return tuple(RFP_TITLE_WORD_PATTERN.findall(title.lower()))
 
-                current_section = match.group(1).strip()
-                matched = True
-                break
 
-        if not matched:
-            current_content.append(line)
+class RFPStructure:
+    """Section tree of one RFP, built by parse_rfp, with dictionary lookups by title"""
+    def __init__(self, text: str, sections: List[RFPSection]):
+        self.text = text
+        self.sections = sections  # document order, sections[0] is the root
+        self.root = sections[0]
+        # Normalized title -> sections, and every contiguous word run of a title -> sections
+        self._by_title = {}
+        self._by_phrase = {}
+        for section in sections:
+            if section is self.root and not section.has_body:
+                continue
+            words = _rfp_title_key(section.title)
+            if not words:
+                continue
+            self._by_title.setdefault(words, []).append(section)
+            phrases = {words[i:j] for i in range(len(words)) for j in range(i + 1, len(words) + 1)}
+            for phrase in phrases:
+                self._by_phrase.setdefault(phrase, []).append(section)
+
+    def body(self, section: RFPSection) -> str:
+        """The section's own text, without the heading line or its subsections"""
+        if not section.has_body:
+            return CleanText("")
+        return CleanText(self.text[section.body_start:section.end])
+
+    def subtree_text(self, section: RFPSection) -> str:
+        """The section's text including its subsections and their headings"""
+        return CleanText(self.text[section.body_start:section.subtree_end])
+
+    def find(self, name: str) -> Optional[RFPSection]:
+        """First section (document order) whose title contains ``name`` as a word run or is
+        itself contained in ``name``; case-insensitive"""
+        words = _rfp_title_key(name)
+        if not words:
+            return None
+        candidates = list(self._by_phrase.get(words, ()))
+        for i in range(len(words)):
+            for j in range(i + 1, len(words) + 1):
+                candidates.extend(self._by_title.get(words[i:j], ()))
+        return min(candidates, key=lambda section: section.order) if candidates else None
+
+    def content_for(self, name: str) -> str:
+        """Text of the section matching ``name``: its own body, or its subsections when the
+        heading only introduces them; empty when nothing matches"""
+        section = self.find(name)
+        if section is None:
+            return CleanText("")
+        body = self.body(section)
+        return body if body.strip() else self.subtree_text(section)
+
+    def to_dict(self) -> Dict[str, str]:
+        """Flat title -> own text map; repeated headings are merged rather than overwritten"""
+        sections = {}
+        for section in self.sections:
+            if not section.has_body:
+                continue
+            body = self.body(section)
+            if section.title in sections:
+                sections[section.title] = CleanText(sections[section.title] + "\n\n" + body)
+            else:
+                sections[section.title] = body
+        return sections
+
+    def outline(self) -> Dict[str, Any]:
+        return self.root.to_dict()
 
-    if current_content:
-        sections[current_section] = '\n'.join(current_content)
 
-    return sections
+def _parse_rfp_text(text: str) -> RFPStructure:
+    root = RFPSection("Overview", "", 0, 0, 0, 0)
+    sections = [root]
+    stack = [root]
+    for match in RFP_HEADING_PATTERN.finditer(text):
+        if match.group("section") is not None:
+            number, title = match.group("section"), match.group("section_title").strip()
+            level = 1
+        else:
+            number = match.group("number") or ""
+            title = (match.group("title") or match.group("caps")).strip()
+            level = _rfp_heading_level(number, title)
+        line_end = match.end()
+        section = RFPSection(title, number, level, len(sections), match.start(), min(line_end + 1, len(text)))
+        section.has_body = line_end < len(text)
+        previous = sections[-1]
+        previous.end = match.start() - 1
+        previous.has_body = previous.has_body and previous.body_start < match.start()
+        while stack[-1].level >= level:
+            stack.pop()
+        stack[-1].children.append(section)
+        stack.append(section)
+        sections.append(section)
+    last = sections[-1]
+    last.end = len(text)
+    if last is root:
+        root.has_body = True
+    else:
+        root.has_body = root.has_body or sections[1].start > 0
+    for section in reversed(sections):
+        section.subtree_end = max([section.end] + [child.subtree_end for child in section.children])
+    return RFPStructure(text, sections)
 
-def process_rfp(file_path):
-    """Extract text from uploaded RFP document"""
+
+def parse_rfp(rfp_text: str) -> RFPStructure:
+    """Parse an RFP into its section tree once; repeated calls with the same text are served
+    from a cache keyed by the text's hash"""
+    cleaned_rfp_text = remove_problematic_chars(rfp_text)
+    key = hashlib.sha1(cleaned_rfp_text.encode('utf-8')).hexdigest()
+    structure = RFP_STRUCTURE_CACHE.get(key)
+    if structure is None:
+        structure = _parse_rfp_text(cleaned_rfp_text)
+        RFP_STRUCTURE_CACHE.put(key, structure)
+    return structure
+
+
+def extract_sections_from_rfp(rfp_text):
+    """Extract structured sections from the RFP text as a flat title -> content map"""
+    return parse_rfp(rfp_text).to_dict()
+
+def spool_upload(uploaded_file, suffix: str = "") -> str:
+    """Copy an uploaded file to a temporary file in chunks and return its path (the caller
+    removes it); avoids materializing a second in-memory copy with getvalue()"""
+    uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_file:
+        shutil.copyfileobj(uploaded_file, temp_file, UPLOAD_SPOOL_CHUNK_BYTES)
+    return temp_file.name
+
+
+def process_rfp(file_path, progress=None):
+    """Extract text from uploaded RFP document; ``progress(done, total)`` reports PDF pages"""
     if file_path.endswith('.docx'):
         return extract_text_from_docx(file_path)
     elif file_path.endswith('.pdf'):
-        return extract_text_from_pdf(file_path)
+        return extract_text_from_pdf(file_path, progress)
     elif file_path.endswith('.md') or file_path.endswith('.txt'):
         # Added errors='replace' to handle problematic characters during reading
         with open(file_path, 'r', encoding='utf-8', errors='replace') as file:
@@ -272,25 +829,103 @@ def expand_query(query: str) -> str:
     return ' '.join(expanded_words)
 
 class HierarchicalEmbeddingModel:
-    """Model for hierarchical embeddings (document and section level)"""
-    def __init__(self, model_name: str):
+    """Model for hierarchical embeddings (document and section level)
+
+    ``backend`` selects how the SentenceTransformer runs on CPU: "torch" (full precision),
+    "int8" (PyTorch dynamic quantization of the Linear layers) or "onnx" (ONNX Runtime,
+    optionally a quantized export chosen with ``onnx_file``). Vectors of different backends
+    are not interchangeable, so caches and snapshots are keyed by ``model_id``.
+    """
+    BACKENDS = ("torch", "int8", "onnx")
+
+    def __init__(self, model_name: str, backend: str = "torch", onnx_file: str = ""):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown embedding backend '{backend}' (expected one of {', '.join(self.BACKENDS)})")
+        self.model_name = model_name
+        self.backend = backend
+        self.onnx_file = onnx_file if backend == "onnx" else ""
+        if backend == "onnx":
+            try:
+                model_kwargs = {"file_name": onnx_file} if onnx_file else None
+                self.model = sentence_transformers.SentenceTransformer(
+                    model_name, device='cpu', backend="onnx", model_kwargs=model_kwargs
+                )
+                print(f"SentenceTransformer loaded with ONNX Runtime for model: {model_name} {onnx_file}".rstrip())
+                return
+            except Exception as e: # optimum/onnxruntime missing or the model has no ONNX export
+                print(f"Warning: ONNX backend unavailable ({e}). Falling back to PyTorch.")
+                self.backend, self.onnx_file = "torch", ""
     # --- CHANGE HERE ---
     # Explicitly set the device. Use 'cuda' if you have a configured GPU,
     # otherwise 'cpu' is safer.
         try:
             # Try loading directly to CPU first, often resolves this.
-            self.model = SentenceTransformer(model_name, device='cpu') # Modified line
+            self.model = sentence_transformers.SentenceTransformer(model_name, device='cpu') # Modified line
             print(f"SentenceTransformer loaded on CPU for model: {model_name} (local files only)")
         except Exception as e:
             print(f"Error loading SentenceTransformer on CPU with local_files_only=True: {e}. Trying default loading.")
             # Fallback logic - if you want the fallback to *also* be local-only:
             try:
-                    self.model = SentenceTransformer(model_name, local_files_only=True) # Add here too
+                    self.model = sentence_transformers.SentenceTransformer(model_name, local_files_only=True) # Add here too
                     print(f"SentenceTransformer loaded with local_files_only=True (default device)")
             except Exception as fallback_e:
                     print(f"Error loading SentenceTransformer even with fallback and local_files_only=True: {fallback_e}")
                     # Depending on your strictness, you might want to raise an error or handle this failure.
                     raise fallback_e # Re-raise if strictly local-only loading is mandatory
+        if self.backend == "int8":
+            self._quantize_int8()
+
+    def _quantize_int8(self):
+        """Swap the Linear layers for int8 dynamically quantized ones (weights int8, activations quantized per batch)"""
+        try:
+            import torch
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+            print(f"Applied int8 dynamic quantization to {self.model_name}")
+        except Exception as e:
+            print(f"Warning: int8 quantization failed ({e}). Using full precision.")
+            self.backend = "torch"
+
+    @property
+    def model_id(self) -> str:
+        """Identifies the vectors this model produces (the name alone for full-precision PyTorch)"""
+        if self.backend == "torch":
+            return self.model_name
+        return f"{self.model_name}@{self.backend}" + (f":{self.onnx_file}" if self.onnx_file else "")
+
+    @classmethod
+    def from_config(cls, model_name: str, kb_config: Optional[Dict[str, Any]] = None):
+        kb_config = kb_config or {}
+        return cls(model_name, kb_config.get("embedding_backend", "torch"), kb_config.get("embedding_onnx_file", ""))
+
+    def dimension(self) -> int:
+        """Size of the vectors produced by the underlying model"""
+        return int(self.model.get_sentence_embedding_dimension())
+
+    def start_process_pool(self, processes: int) -> bool:
+        """Encode sections with sentence-transformers' multi-process pool until stop_process_pool()"""
+        if getattr(self, "_pool", None) is not None:
+            return True
+        # Each worker gets its share of the cores instead of all of them
+        previous = os.environ.get("OMP_NUM_THREADS")
+        os.environ["OMP_NUM_THREADS"] = str(max(1, (os.cpu_count() or 1) // processes))
+        try:
+            self._pool = self.model.start_multi_process_pool(["cpu"] * processes)
+            print(f"Encoding with {processes} worker processes")
+            return True
+        except Exception as e:
+            print(f"Warning: Multi-process encoding unavailable ({e}). Encoding in this process.")
+            self._pool = None
+            return False
+        finally:
+            if previous is None:
+                os.environ.pop("OMP_NUM_THREADS", None)
+            else:
+                os.environ["OMP_NUM_THREADS"] = previous
+
+    def stop_process_pool(self):
+        pool, self._pool = getattr(self, "_pool", None), None
+        if pool is not None:
+            self.model.stop_multi_process_pool(pool)
 
     def encode(self, texts: List[str], level: str = 'section') -> np.ndarray:
         """Generate embeddings with different pooling strategies based on level"""
@@ -298,208 +933,3641 @@ class HierarchicalEmbeddingModel:
         cleaned_texts = [remove_problematic_chars(text) for text in texts]
 
         if level == 'document':
-            embeddings = self.model.encode(cleaned_texts, convert_to_tensor=True)
-            # Use weighted pooling for document-level embeddings
-            weights = np.linspace(0.1, 1.0, len(embeddings))
-            weighted_embeddings = embeddings * weights[:, np.newaxis]
-            return np.mean(weighted_embeddings, axis=0)
+            # One vector for the whole document, pooled from its sections (given in document order)
+            if not cleaned_texts:
+                return np.zeros(self.dimension(), dtype=np.float32)
+            return self.pool_document(self.model.encode(cleaned_texts))
+        elif getattr(self, "_pool", None) is not None:
+            return self.model.encode(cleaned_texts, pool=self._pool)
         else:
             return self.model.encode(cleaned_texts)
 
-class ProposalKnowledgeBase:
-    def __init__(self, kb_directory="markdown_responses", embedding_model="all-MiniLM-L6-v2"):
+    @staticmethod
+    def pool_document(section_vectors: np.ndarray) -> np.ndarray:
+        """Unit-length weighted mean of unit section vectors; later sections weigh more (0.1 -> 1.0)"""
+        vectors = np.asarray(section_vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        weights = np.linspace(0.1, 1.0, len(vectors), dtype=np.float32)
+        pooled = weights @ vectors / weights.sum()
+        return pooled / max(float(np.linalg.norm(pooled)), 1e-12)
+
+class EmbeddingCache:
+    """Persistent, content-addressed cache of section embeddings.
+
+    Vectors are stored in a small SQLite database keyed by the embedding model
+    name and the SHA-256 of the cleaned section text, so a knowledge base rebuild
+    only runs the model for text it has never seen before. The cache is bounded
+    by ``max_entries``; the least recently used vectors are evicted first.
+    """
+    def __init__(self, cache_dir: str, model_name: str, max_entries: int = 200000):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "embeddings.sqlite3")
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL, text_hash TEXT NOT NULL, dim INTEGER NOT NULL,"
+            " vector BLOB NOT NULL, last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, text_hash))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get_many(self, hashes: List[str]) -> Dict[str, np.ndarray]:
+        """Return the cached vectors for the given hashes (missing ones are omitted)"""
+        found = {}
+        unique_hashes = list(dict.fromkeys(hashes))
+        with self._lock:
+            # SQLite limits the number of bound parameters, so query in chunks
+            for start in range(0, len(unique_hashes), 500):
+                chunk = unique_hashes[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [self.model_name] + chunk
+                ).fetchall()
+                for text_hash, blob in rows:
+                    found[text_hash] = np.frombuffer(blob, dtype=np.float32)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, self.model_name, h) for h in found]
+                )
+                self._conn.commit()
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]):
+        """Store vectors by text hash and evict the oldest entries beyond the size bound"""
+        if not items:
+            return
+        now = time.time()
+        rows = [
+            (self.model_name, text_hash, int(vector.shape[0]), np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for text_hash, vector in items.items()
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, dim, vector, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache fits in max_entries (lock held)"""
+        if not self.max_entries or self.max_entries <= 0:
+            return
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN "
+                "(SELECT rowid FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                (overflow,)
+            )
+            self.evictions += overflow
+
+    def encode(self, texts: List[str], encoder) -> np.ndarray:
+        """Embed texts, running ``encoder`` only on the ones missing from the cache"""
+        hashes = [self.text_hash(text) for text in texts]
+        cached = self.get_many(hashes)
+
+        missing = {}
+        for text_hash, text in zip(hashes, texts):
+            if text_hash not in cached and text_hash not in missing:
+                missing[text_hash] = text
+        self.hits += len(texts) - sum(1 for h in hashes if h in missing)
+        self.misses += len(missing)
+
+        if missing:
+            new_vectors = np.asarray(encoder(list(missing.values())), dtype=np.float32)
+            fresh = dict(zip(missing.keys(), new_vectors))
+            self.put_many(fresh)
+            cached.update(fresh)
+
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.vstack([cached[h] for h in hashes]).astype('float32')
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            (entries,) = self._conn.execute(
+                "SELECT COUNT(*) FROM embeddings WHERE model = ?", (self.model_name,)
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0
+        }
+
+class PageTextCache:
+    """Persistent cache of extracted document page text keyed by file SHA-256 and page number.
+
+    Stored in SQLite next to the embedding cache and bounded by ``max_entries`` pages; the
+    least recently used pages are evicted first.
+    """
+    def __init__(self, cache_dir: str, max_entries: int = 50000):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "pages.sqlite3")
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " file_hash TEXT NOT NULL, page INTEGER NOT NULL, page_count INTEGER NOT NULL,"
+            " text TEXT NOT NULL, last_used REAL NOT NULL,"
+            " PRIMARY KEY (file_hash, page))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pages_last_used ON pages(last_used)")
+        self._conn.commit()
+
+    def get(self, file_hash: str) -> Tuple[Optional[int], Dict[int, str]]:
+        """(page_count, {page: text}) of the cached pages of a file; (None, {}) when none are"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT page, page_count, text FROM pages WHERE file_hash = ?", (file_hash,)
+            ).fetchall()
+            if rows:
+                self._conn.execute("UPDATE pages SET last_used = ? WHERE file_hash = ?", (time.time(), file_hash))
+                self._conn.commit()
+        if not rows:
+            self.misses += 1
+            return None, {}
+        self.hits += 1
+        return rows[0][1], {page: CleanText(text) for page, _, text in rows}
+
+    def put_many(self, file_hash: str, page_count: int, pages: Dict[int, str]):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO pages (file_hash, page, page_count, text, last_used) VALUES (?, ?, ?, ?, ?)",
+                [(file_hash, page, page_count, str(text), now) for page, text in pages.items()]
+            )
+            if self.max_entries and self.max_entries > 0:
+                (count,) = self._conn.execute("SELECT COUNT(*) FROM pages").fetchone()
+                if count > self.max_entries:
+                    self._conn.execute(
+                        "DELETE FROM pages WHERE rowid IN (SELECT rowid FROM pages ORDER BY last_used ASC LIMIT ?)",
+                        (count - self.max_entries,)
+                    )
+            self._conn.commit()
+
+class LRUCache:
+    """Small thread-safe in-memory LRU map with hit/miss counters"""
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0
+        }
+
+# Parsed RFP structures keyed by the hash of the cleaned RFP text (see parse_rfp)
+RFP_STRUCTURE_CACHE = LRUCache(32)
+
+# Dense index tiers: exact search for small knowledge bases, graph or quantized ANN above that
+DEFAULT_INDEX_CONFIG = {
+    "type": "auto",
+    "flat_max_vectors": 20000,
+    "hnsw_max_vectors": 200000,
+    "hnsw_m": 32,
+    "hnsw_ef_construction": 80,
+    "hnsw_ef_search": 64,
+    "ivf_nlist": 0, # 0 = derive from corpus size
+    "ivf_nprobe": 16,
+    "pq_subquantizers": 48,
+    "train_max_vectors": 65536,
+    "compression": "none", # flat/hnsw storage: "none", "sq8" (int8 scalar) or "pq" (product quantization)
+    "pca_dims": 0, # >0: PCA-reduce vectors to this many dimensions before storage (learned on the KB)
+    "rerank_factor": 4, # compressed indexes: re-score factor*k candidates against full-precision vectors on disk
+    "recall_eval_queries": 200,
+    "recall_eval_k": 10
+}
+
+def select_index_tier(n_vectors: int, index_config: Dict[str, Any]) -> str:
+    """Pick 'flat', 'hnsw' or 'ivfpq' for a corpus of the given size"""
+    requested = index_config.get("type", "auto")
+    if requested != "auto":
+        return requested
+    if n_vectors <= index_config["flat_max_vectors"]:
+        return "flat"
+    if n_vectors <= index_config["hnsw_max_vectors"]:
+        return "hnsw"
+    return "ivfpq"
+
+def build_dense_index(dimension: int, n_vectors: int, index_config: Dict[str, Any]) -> Tuple[Any, str]:
+    """Create an empty, id-mapped inner-product index for the selected tier.
+
+    Vectors must be L2-normalized before they are added or searched, so the
+    inner product equals cosine similarity on every tier.
+    """
+    tier = select_index_tier(n_vectors, index_config)
+    # Optional PCA learned on the KB; it wraps the id map, so the index still takes and
+    # reconstructs full-dimension vectors
+    pca_dims = int(index_config.get("pca_dims", 0))
+    prefix = f"PCA{pca_dims}," if 0 < pca_dims < dimension else ""
+    stored_dimension = pca_dims if prefix else dimension
+    storage = _compressed_storage(index_config, stored_dimension, n_vectors)
+    if tier == "hnsw":
+        layout = f"HNSW{index_config['hnsw_m']}_{storage}" if storage else f"HNSW{index_config['hnsw_m']},Flat"
+        index = faiss.index_factory(dimension, f"{prefix}IDMap2,{layout}", faiss.METRIC_INNER_PRODUCT)
+        faiss.downcast_index(_id_map(index).index).hnsw.efConstruction = index_config["hnsw_ef_construction"]
+    elif tier == "ivfpq":
+        # Roughly 4*sqrt(n) lists, while keeping ~39 training points per centroid
+        nlist = index_config["ivf_nlist"] or int(4 * np.sqrt(max(n_vectors, 1)))
+        nlist = max(1, min(nlist, n_vectors // 39 or 1))
+        m = _pq_subquantizers(index_config, stored_dimension)
+        index = faiss.index_factory(dimension, f"{prefix}IDMap2,IVF{nlist},PQ{m}x{_pq_bits(n_vectors)}",
+                                    faiss.METRIC_INNER_PRODUCT)
+    else:
+        tier = "flat"
+        index = faiss.index_factory(dimension, f"{prefix}IDMap2,{storage or 'Flat'}", faiss.METRIC_INNER_PRODUCT)
+    _skip_polysemous_training(index)
+    return index, tier
+
+def _skip_polysemous_training(index):
+    """Polysemous codes only pay off with a Hamming threshold, which is never set; training them dominates PQ builds"""
+    inner = faiss.downcast_index(_id_map(index).index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner = faiss.downcast_index(inner.storage)
+    if isinstance(inner, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        inner.do_polysemous_training = False
+
+def train_dense_index(index, vectors: np.ndarray):
+    """Train a dense index on a sample of unit vectors.
+
+    FAISS PCA centers the data, which would rank by centered rather than raw inner
+    products; training it on the sample together with its negation (zero mean) keeps
+    the projection inner-product preserving. Quantizers then train on the projected sample.
+    """
+    if isinstance(index, faiss.IndexPreTransform):
+        pca = faiss.downcast_VectorTransform(index.chain.at(0))
+        if not pca.is_trained:
+            pca.train(np.ascontiguousarray(np.vstack([vectors, -vectors])))
+    index.train(vectors)
+
+def _pq_subquantizers(index_config: Dict[str, Any], dimension: int) -> int:
+    """Largest sub-quantizer count up to ``pq_subquantizers`` that divides the dimension (PQ requires it)"""
+    return max(d for d in range(1, min(index_config["pq_subquantizers"], dimension) + 1) if dimension % d == 0)
+
+def _pq_bits(n_vectors: int) -> int:
+    """PQ codebook bits: 8-bit codebooks want ~39 training points per centroid; small KBs get smaller codebooks"""
+    return int(np.clip(np.log2(max(n_vectors, 1) / 39), 4, 8))
+
+def _compressed_storage(index_config: Dict[str, Any], dimension: int, n_vectors: int) -> str:
+    """Factory code for the configured vector compression ('' when vectors are stored as float32)"""
+    compression = index_config.get("compression", "none")
+    if compression == "sq8":
+        return "SQ8"
+    if compression == "pq":
+        return f"PQ{_pq_subquantizers(index_config, dimension)}x{_pq_bits(n_vectors)}"
+    if compression != "none":
+        raise ValueError(f"Unknown index compression '{compression}' (expected 'none', 'sq8' or 'pq')")
+    return ""
+
+def is_lossy_index(index_config: Dict[str, Any], tier: str) -> bool:
+    """True if the index scores approximate vectors, so results are re-ranked at full precision"""
+    return (tier == "ivfpq" or index_config.get("compression", "none") != "none"
+            or int(index_config.get("pca_dims", 0)) > 0)
+
+def _id_map(index):
+    """The IDMap2 of a dense index (under the PCA pre-transform, if there is one)"""
+    if isinstance(index, faiss.IndexPreTransform):
+        return faiss.downcast_index(index.index)
+    return index
+
+def supports_id_selector(index) -> bool:
+    """False for flat PQ storage, which cannot restrict a search to an id subset"""
+    return not isinstance(faiss.downcast_index(_id_map(index).index), faiss.IndexPQ)
+
+def remove_dense_ids(index, passage_ids) -> int:
+    """Physically remove vectors; the PCA pre-transform does not implement removal itself"""
+    id_map = _id_map(index)
+    removed = id_map.remove_ids(np.asarray(passage_ids, dtype='int64'))
+    index.ntotal = id_map.ntotal
+    return removed
+
+def dense_index_bytes(index) -> int:
+    """Serialized size of a dense index, i.e. the memory it occupies once loaded"""
+    return int(faiss.serialize_index(index).nbytes) if index is not None else 0
+
+def dense_search_params(tier: str, index_config: Dict[str, Any], selector=None, index=None):
+    """Per-query search parameters for a tier (optionally restricted to an id selector).
+
+    Pass the index when it may carry a PCA pre-transform, which only forwards
+    parameters wrapped for it.
+    """
+    if tier == "hnsw":
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = index_config["hnsw_ef_search"]
+    elif tier == "ivfpq":
+        params = faiss.SearchParametersIVF()
+        params.nprobe = index_config["ivf_nprobe"]
+    elif index is not None and isinstance(faiss.downcast_index(_id_map(index).index), faiss.IndexPQ):
+        params = faiss.SearchParametersPQ() # IndexPQ rejects generic parameters
+    else:
+        params = faiss.SearchParameters()
+    if selector is not None:
+        params.sel = selector
+    if isinstance(index, faiss.IndexPreTransform):
+        wrapped = faiss.SearchParametersPreTransform()
+        wrapped.index_params = params
+        wrapped.referenced_objects = [params, selector] # SWIG does not keep the inner objects alive
+        return wrapped
+    return params
+
+class FullVectorStore:
+    """Full-precision passage vectors in a flat float32 file, memory-mapped for re-ranking.
+
+    Row i is the unit vector of passage i. Compressed indexes keep only codes in
+    memory; the few candidates of each search are re-scored from this file, whose
+    pages the OS loads on demand. Stores opened from a snapshot are read-only and
+    are copied to a private scratch file on the first write.
+    """
+    FILENAME = "vectors.f32"
+
+    def __init__(self, path: str, dimension: int, read_only: bool = False, owned: bool = False):
+        self.path = path
+        self.dimension = dimension
+        self.read_only = read_only
+        self._mapped = None
+        if owned:
+            weakref.finalize(self, _remove_file_quietly, path)
+
+    @classmethod
+    def create(cls, dimension: int, directory: str) -> "FullVectorStore":
+        """An empty store in a scratch file that is deleted with the store"""
+        os.makedirs(directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix="vectors-", suffix=".f32", dir=directory)
+        os.close(fd)
+        return cls(path, dimension, owned=True)
+
+    @classmethod
+    def load(cls, directory: str, dimension: int) -> Optional["FullVectorStore"]:
+        path = os.path.join(directory, cls.FILENAME)
+        return cls(path, dimension, read_only=True) if os.path.exists(path) else None
+
+    def __len__(self):
+        return os.path.getsize(self.path) // (4 * self.dimension)
+
+    def nbytes(self) -> int:
+        return os.path.getsize(self.path)
+
+    def put(self, passage_ids, vectors):
+        """Write rows at their passage ids (ids are assigned in increasing runs)"""
+        if self.read_only:
+            raise ValueError("Snapshot vector stores are read-only; call writable() first")
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        passage_ids = np.asarray(passage_ids, dtype=np.int64)
+        row_bytes = 4 * self.dimension
+        with open(self.path, 'r+b') as f:
+            # One write per run of consecutive ids
+            breaks = np.flatnonzero(np.diff(passage_ids) != 1) + 1
+            for start, end in zip(np.concatenate(([0], breaks)), np.concatenate((breaks, [len(passage_ids)]))):
+                f.seek(int(passage_ids[start]) * row_bytes)
+                f.write(vectors[start:end].tobytes())
+        self._mapped = None
+
+    def get(self, passage_ids) -> np.ndarray:
+        if self._mapped is None:
+            self._mapped = np.memmap(self.path, dtype=np.float32, mode='r').reshape(-1, self.dimension)
+        return np.asarray(self._mapped[np.asarray(passage_ids, dtype=np.int64)])
+
+    def writable(self, directory: str) -> "FullVectorStore":
+        if not self.read_only:
+            return self
+        copy = FullVectorStore.create(self.dimension, directory)
+        shutil.copyfile(self.path, copy.path)
+        return copy
+
+    def save(self, directory: str):
+        shutil.copyfile(self.path, os.path.join(directory, self.FILENAME))
+
+def _remove_file_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class PassageChunker:
+    """Splits section text into overlapping, token-bounded passages.
+
+    Token boundaries come from the embedding model's own tokenizer when it
+    exposes offsets, so no passage is silently truncated by the model; otherwise
+    whitespace-delimited words are used as an approximation. Passages are
+    returned as UTF-8 byte ranges into the parent section's content.
+    """
+    def __init__(self, tokenizer=None, max_tokens: int = 254, overlap_tokens: int = 32):
+        self.tokenizer = tokenizer
+        self.max_tokens = max(8, int(max_tokens))
+        self.overlap_tokens = max(0, min(int(overlap_tokens), self.max_tokens // 2))
+
+    def _token_spans(self, text: str) -> List[Tuple[int, int]]:
+        """Character (start, end) of every token in text"""
+        if self.tokenizer is not None:
+            try:
+                encoded = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True, verbose=False)
+                return [tuple(span) for span in encoded["offset_mapping"] if span[1] > span[0]]
+            except Exception:
+                # Slow tokenizers do not expose offsets; fall back to words
+                pass
+        return [match.span() for match in re.finditer(r'\S+', text)]
+
+    @staticmethod
+    def _byte_offsets(text: str, char_offsets: List[int]) -> List[int]:
+        if text.isascii():
+            return list(char_offsets)
+        char_bytes = np.fromiter((len(ch.encode('utf-8')) for ch in text), dtype=np.int64, count=len(text))
+        prefix = np.concatenate(([0], np.cumsum(char_bytes)))
+        return [int(prefix[offset]) for offset in char_offsets]
+
+    def _token_spans_many(self, texts: List[str]) -> List[List[Tuple[int, int]]]:
+        """_token_spans for many texts; fast tokenizers encode a batch on all cores"""
+        if self.tokenizer is not None and texts:
+            try:
+                encoded = self.tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True, verbose=False)
+                return [[tuple(span) for span in offsets if span[1] > span[0]] for offsets in encoded["offset_mapping"]]
+            except Exception:
+                pass
+        return [self._token_spans(text) for text in texts]
+
+    def chunk_many(self, texts: List[str]) -> List[List[Tuple[int, int]]]:
+        """chunk() for a batch of texts"""
+        return [self._chunk_spans(text, spans) for text, spans in zip(texts, self._token_spans_many(texts))]
+
+    def chunk(self, text: str) -> List[Tuple[int, int]]:
+        """Return (byte_start, byte_end) ranges of the passages covering text"""
+        return self._chunk_spans(text, self._token_spans(text))
+
+    def _chunk_spans(self, text: str, spans: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        if not spans:
+            return []
+        stride = self.max_tokens - self.overlap_tokens
+        char_ranges = []
+        for start in range(0, len(spans), stride):
+            window = spans[start:start + self.max_tokens]
+            char_ranges.append((window[0][0], window[-1][1]))
+            if start + self.max_tokens >= len(spans):
+                break
+        flat = self._byte_offsets(text, [offset for char_range in char_ranges for offset in char_range])
+        return list(zip(flat[0::2], flat[1::2]))
+
+class BM25Index:
+    """Inverted-index BM25 retriever over knowledge-base sections.
+
+    Scoring follows rank_bm25.BM25Okapi (k1, b and the epsilon floor for
+    negative idf), but a query only touches the posting lists of its own terms
+    instead of scoring every document. Postings are kept as a compiled,
+    term-major CSR base (which can be memory-mapped from a snapshot) plus an
+    in-memory delta for documents added since the last compaction; removed
+    documents are masked through a zero document length.
+    """
+    TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.vocabulary = {}
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.posting_docs = np.zeros(0, dtype=np.int64)
+        self.posting_tfs = np.zeros(0, dtype=np.float32)
+        self.delta = {}
+        self.doc_lengths = np.zeros(0, dtype=np.float32)
+        self.n_docs = 0
+        self.total_length = 0.0
+        self._average_idf = None # Recomputed from the live document frequencies after adds and removes
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        return cls.TOKEN_PATTERN.findall(text.lower())
+
+    def add(self, doc_id: int, text: str):
+        tokens = self.tokenize(text)
+        if doc_id >= len(self.doc_lengths) or not self.doc_lengths.flags.writeable:
+            # Grow geometrically; this also copies a memory-mapped array before the first write
+            grown = np.zeros(max(doc_id + 1, 2 * len(self.doc_lengths)), dtype=np.float32)
+            grown[:len(self.doc_lengths)] = self.doc_lengths
+            self.doc_lengths = grown
+        # Documents without tokens still count toward N, like in rank_bm25; a tiny length keeps them "live"
+        self.doc_lengths[doc_id] = max(len(tokens), 1e-6)
+        self.n_docs += 1
+        self.total_length += len(tokens)
+        self._average_idf = None
+        for term, tf in Counter(tokens).items():
+            term_id = self.vocabulary.setdefault(term, len(self.vocabulary))
+            self.delta.setdefault(term_id, {})[doc_id] = tf
+
+    def remove(self, doc_id: int):
+        if doc_id < len(self.doc_lengths) and self.doc_lengths[doc_id] > 0:
+            if not self.doc_lengths.flags.writeable:
+                self.doc_lengths = np.array(self.doc_lengths)
+            self.total_length -= float(np.floor(self.doc_lengths[doc_id]))
+            self.n_docs -= 1
+            self.doc_lengths[doc_id] = 0
+            self._average_idf = None
+
+    def _postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Live (doc ids, term frequencies) for one term"""
+        if term_id + 1 < len(self.indptr):
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            docs, tfs = self.posting_docs[start:end], self.posting_tfs[start:end]
+        else:
+            docs, tfs = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        extra = self.delta.get(term_id)
+        if extra:
+            docs = np.concatenate([docs, np.fromiter(extra.keys(), dtype=np.int64, count=len(extra))])
+            tfs = np.concatenate([tfs, np.fromiter(extra.values(), dtype=np.float32, count=len(extra))])
+        alive = self.doc_lengths[docs] > 0
+        return docs[alive], tfs[alive]
+
+    def _idf(self, df: int, n_docs: Optional[int] = None, average_idf: Optional[float] = None) -> float:
+        n_docs = self.n_docs if n_docs is None else n_docs
+        idf = np.log(n_docs - df + 0.5) - np.log(df + 0.5)
+        return float(idf) if idf >= 0 else self.epsilon * (self.average_idf if average_idf is None else average_idf)
+
+    def statistics(self, terms: List[str]) -> Dict[str, Any]:
+        """Corpus statistics behind the scores of ``terms``; summed across shards to score with global idf/avgdl"""
+        return {
+            "n_docs": self.n_docs,
+            "total_length": self.total_length,
+            "average_idf": self.average_idf,
+            "df": {term: int(len(self._postings(self.vocabulary[term])[0])) if term in self.vocabulary else 0
+                   for term in terms}
+        }
+
+    def _live_document_frequencies(self) -> np.ndarray:
+        """Live document frequency per term id (0 for terms whose documents were all removed)"""
+        term_ids = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int64), np.diff(self.indptr))
+        df = np.bincount(term_ids[self.doc_lengths[self.posting_docs] > 0], minlength=len(self.vocabulary))
+        for term_id, extra in self.delta.items():
+            docs = np.fromiter(extra.keys(), dtype=np.int64, count=len(extra))
+            df[term_id] += int(np.count_nonzero(self.doc_lengths[docs] > 0))
+        return df
+
+    @property
+    def average_idf(self) -> float:
+        """Mean idf over the terms of the live documents, as rank_bm25 computes it over its corpus"""
+        if self._average_idf is None:
+            df = self._live_document_frequencies()
+            df = df[df > 0].astype(np.float64)
+            self._average_idf = float(np.mean(np.log(self.n_docs - df + 0.5) - np.log(df + 0.5))) if len(df) else 0.0
+        return self._average_idf
+
+    def document_frequencies(self) -> Dict[str, int]:
+        """Live document frequency of every term that still occurs in a live document"""
+        df = self._live_document_frequencies()
+        return {term: int(df[term_id]) for term, term_id in self.vocabulary.items() if df[term_id]}
+
+    def term_weights(self, term: str, corpus: Optional[Dict[str, Any]] = None,
+                     allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """BM25 contribution of one query term to every document containing it.
+
+        ``corpus`` (see ``statistics``) replaces this index's N, total length, document
+        frequencies and average idf, so partitions of one corpus score like the whole.
+        ``allowed`` is an optional boolean mask over document ids; postings outside it are
+        dropped before they are weighted (the idf still counts every document).
+        """
+        term_id = self.vocabulary.get(term)
+        if term_id is None or self.n_docs == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        docs, tfs = self._postings(term_id)
+        if len(docs) == 0:
+            return docs, tfs
+        if corpus is None:
+            n_docs, total_length, df, average_idf = self.n_docs, self.total_length, len(docs), None
+        else:
+            n_docs, total_length = corpus["n_docs"], corpus["total_length"]
+            df, average_idf = corpus["df"].get(term, len(docs)), corpus["average_idf"]
+        if allowed is not None:
+            keep = allowed[docs]
+            docs, tfs = docs[keep], tfs[keep]
+            if len(docs) == 0:
+                return docs, tfs
+        avgdl = total_length / n_docs if n_docs else 1.0
+        lengths = np.floor(self.doc_lengths[docs])
+        weights = self._idf(df, n_docs, average_idf) * (tfs * (self.k1 + 1) / (tfs + self.k1 * (1 - self.b + self.b * lengths / max(avgdl, 1e-9))))
+        return docs, weights.astype(np.float32)
+
+    def search(self, text: str, k: int, allowed: Optional[np.ndarray] = None,
+               corpus: Optional[Dict[str, Any]] = None) -> List[Tuple[float, int]]:
+        """Top-k (score, doc_id) for a query; repeated query terms count repeatedly, as in rank_bm25.
+
+        ``allowed`` is an optional boolean mask over document ids; postings outside it are
+        dropped before any scoring work.
+        """
+        doc_parts, weight_parts = [], []
+        for term, count in Counter(self.tokenize(text)).items():
+            docs, weights = self.term_weights(term, corpus, allowed)
+            if len(docs):
+                doc_parts.append(docs)
+                weight_parts.append(weights * count)
+        if not doc_parts:
+            return []
+        candidates, inverse = np.unique(np.concatenate(doc_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weight_parts))
+        return self._top_k(scores, candidates, k)
+
+    def search_batch(self, texts: List[str], k: int, allowed: Optional[np.ndarray] = None,
+                     corpus: Optional[Dict[str, Any]] = None) -> List[List[Tuple[float, int]]]:
+        """Top-k for many queries with one sparse product: (queries x terms) @ (terms x candidate docs)"""
+        query_counts = [Counter(self.tokenize(text)) for text in texts]
+        terms = sorted({term for counts in query_counts for term in counts if term in self.vocabulary})
+        if not terms:
+            return [[] for _ in texts]
+
+        # Weight matrix restricted to the union of the query terms and the documents they occur in
+        rows, cols, values = [], [], []
+        for row, term in enumerate(terms):
+            docs, weights = self.term_weights(term, corpus, allowed)
+            rows.append(np.full(len(docs), row, dtype=np.int64))
+            cols.append(docs)
+            values.append(weights)
+        candidates, columns = np.unique(np.concatenate(cols), return_inverse=True)
+        term_doc = sp.csr_matrix((np.concatenate(values), (np.concatenate(rows), columns)),
+                                 shape=(len(terms), len(candidates)))
+
+        term_position = {term: i for i, term in enumerate(terms)}
+        q_rows, q_cols, q_values = [], [], []
+        for query_row, counts in enumerate(query_counts):
+            for term, count in counts.items():
+                if term in term_position:
+                    q_rows.append(query_row)
+                    q_cols.append(term_position[term])
+                    q_values.append(count)
+        query_term = sp.csr_matrix((q_values, (q_rows, q_cols)), shape=(len(texts), len(terms)))
+
+        scores = (query_term @ term_doc).tocsr()
+        results = []
+        for query_row in range(len(texts)):
+            start, end = scores.indptr[query_row], scores.indptr[query_row + 1]
+            results.append(self._top_k(scores.data[start:end], candidates[scores.indices[start:end]], k))
+        return results
+
+    @staticmethod
+    def _top_k(scores: np.ndarray, doc_ids: np.ndarray, k: int) -> List[Tuple[float, int]]:
+        if len(scores) > k:
+            # argpartition keeps the selection linear in the number of candidates
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(doc_ids[i])) for i in top]
+
+    def compact(self):
+        """Fold the delta into the compiled postings and drop removed documents"""
+        rows_docs, rows_tfs, indptr = [], [], [0]
+        for term_id in range(len(self.vocabulary)):
+            docs, tfs = self._postings(term_id)
+            order = np.argsort(docs)
+            rows_docs.append(docs[order])
+            rows_tfs.append(tfs[order])
+            indptr.append(indptr[-1] + len(docs))
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.posting_docs = np.concatenate(rows_docs) if rows_docs else np.zeros(0, dtype=np.int64)
+        self.posting_tfs = np.concatenate(rows_tfs) if rows_tfs else np.zeros(0, dtype=np.float32)
+        self.delta = {}
+
+    def save(self, directory: str):
+        self.compact()
+        np.save(os.path.join(directory, "bm25_indptr.npy"), self.indptr)
+        np.save(os.path.join(directory, "bm25_docs.npy"), self.posting_docs)
+        np.save(os.path.join(directory, "bm25_tfs.npy"), self.posting_tfs)
+        np.save(os.path.join(directory, "bm25_doc_lengths.npy"), self.doc_lengths)
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        with open(os.path.join(directory, "bm25.json"), 'w', encoding='utf-8') as f:
+            json.dump({
+                "k1": self.k1, "b": self.b, "epsilon": self.epsilon,
+                "n_docs": self.n_docs, "total_length": self.total_length, "terms": terms
+            }, f)
+
+    @classmethod
+    def load(cls, directory: str) -> "BM25Index":
+        """Open a saved index with its postings memory-mapped"""
+        with open(os.path.join(directory, "bm25.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        index = cls(meta["k1"], meta["b"], meta["epsilon"])
+        index.vocabulary = {term: term_id for term_id, term in enumerate(meta["terms"])}
+        index.n_docs = meta["n_docs"]
+        index.total_length = meta["total_length"]
+        index.indptr = np.load(os.path.join(directory, "bm25_indptr.npy"), mmap_mode='r')
+        index.posting_docs = np.load(os.path.join(directory, "bm25_docs.npy"), mmap_mode='r')
+        index.posting_tfs = np.load(os.path.join(directory, "bm25_tfs.npy"), mmap_mode='r')
+        index.doc_lengths = np.load(os.path.join(directory, "bm25_doc_lengths.npy"), mmap_mode='r')
+        return index
+
+SNAPSHOT_FORMAT_VERSION = 6
+
+# Currency markers seen in past proposals, mapped to ISO codes. KB text is already through
+# remove_problematic_chars, which drops symbols such as the rupee, euro and pound signs,
+# so only codes and ASCII markers can be matched
+CURRENCY_CODES = {
+    "aed": "AED", "dhs": "AED", "dh": "AED",
+    "usd": "USD", "us$": "USD", "$": "USD",
+    "inr": "INR", "rs": "INR", "rs.": "INR",
+    "eur": "EUR", "gbp": "GBP", "sar": "SAR"
+}
+
+PRICE_ENTRY_DTYPE = np.dtype([
+    ("amount", "f8"),
+    ("currency", "U3"),
+    ("doc_id", "i8"),
+    ("file", "i4"),
+    ("client", "i4"),
+    ("industry", "i4"),
+    ("commercial", "?")
+])
+
+class PricingIndex:
+    """Every currency amount in the knowledge base as one NumPy structured array.
+
+    Filenames, clients and industries are interned into small lookup tables so
+    the entries stay fixed-width and filters are plain vectorized comparisons.
+    ``commercial`` marks amounts from pricing sections, as opposed to figures
+    quoted in case studies and campaign reports.
+    """
+    _SCALE_WORDS = r'k|m|mn|bn|thousand|million|billion'
+    _CODES = r'AED|USD|INR|EUR|GBP|SAR|Dhs?'
+    # Words that may follow an amount written with space-separated thousands ("AED 10 000 per month")
+    _PRICE_WORDS = r'per|monthly|yearly|annually|excl|excluding|incl|including|plus|only|vat'
+    # 1,234.56 | 3 200,00 (space or no-break-space thousands) | 3200.5 | 3200,00 or 1,5 million (decimal comma).
+    # Space-separated groups must end on a real boundary, so "AED 50 100 hours" is not read as 50100
+    _NUMBER = (r'(\d{1,3}(?:,\d{3})+(?:\.\d+)?'
+               r'|\d{1,3}(?:[ \u00a0]\d{3})+(?:[.,]\d{1,2}(?!\d)|(?=\s?(?:' + _SCALE_WORDS + '|' + _CODES + '|' + _PRICE_WORDS
+               + r')\b|(?![ \u00a0]?[A-Za-z0-9])))'
+               r'|\d+(?:\.\d+|,\d{2}(?!\d)|,\d(?=\s?(?:' + _SCALE_WORDS + r')\b))?)')
+    _DECIMAL_COMMA = re.compile(r',\d{1,2}$')
+    _SCALE = r'(?:\s?(' + _SCALE_WORDS + r')\b)?'
+    # Reject OCR debris such as "AED2Z", "AED2,2I9" or "AED 2 Ooo,00" instead of reading a truncated number:
+    # glued letters/digits, or a following token that is a bare number or mixes letters with digits
+    _END = r'(?![A-Za-z0-9]|[.,][A-Za-z0-9]|[ \u00a0](?:\d|[A-Za-z]+[.,]?\d|[Oo]{3}(?![A-Za-z])))'
+    PREFIX_PATTERN = re.compile(
+        r'(?<![A-Za-z])(AED|USD|US\$|INR|EUR|GBP|SAR|Dhs?|Rs\.?|\$)\s?' + _NUMBER + _SCALE + _END,
+        re.IGNORECASE
+    )
+    SUFFIX_PATTERN = re.compile(
+        r'(?<![\w.,])' + _NUMBER + _SCALE + r'\s?(' + _CODES + r')\b',
+        re.IGNORECASE
+    )
+    SCALES = {"k": 1e3, "thousand": 1e3, "m": 1e6, "mn": 1e6, "million": 1e6, "bn": 1e9, "billion": 1e9}
+    COMMERCIAL_SECTION = re.compile(
+        r'\b(commercial|pric(?:e|es|ed|ing)|costs?|budgets?|fees?|financials?|quotations?|packages?|add[- ]?ons?)\b',
+        re.IGNORECASE
+    )
+    PRICE_TABLE_ROW = re.compile(r'^\|.*\b(price|sub-?total|fees?)\b.*\|\s*$', re.IGNORECASE | re.MULTILINE)
+
+    def __init__(self):
+        self.entries = np.zeros(0, dtype=PRICE_ENTRY_DTYPE)
+        self.files: List[str] = []
+        self.clients: List[str] = []
+        self.industries: List[str] = []
+        self._ids = {"files": {}, "clients": {}, "industries": {}}
+
+    def _intern(self, table: str, value: str) -> int:
+        lookup = self._ids[table]
+        key = (value or "").strip().lower()
+        if key not in lookup:
+            lookup[key] = len(getattr(self, table))
+            getattr(self, table).append(value)
+        return lookup[key]
+
+    @classmethod
+    def _number(cls, number: str) -> float:
+        number = number.replace(' ', '').replace('\u00a0', '')
+        if cls._DECIMAL_COMMA.search(number):
+            return float(number.replace(',', '.'))
+        return float(number.replace(',', ''))
+
+    @classmethod
+    def parse_amounts(cls, text: str) -> List[Tuple[float, str]]:
+        """All (amount, ISO currency) pairs in the text, with k/million/billion applied"""
+        amounts = []
+        taken = []
+        for match in cls.PREFIX_PATTERN.finditer(text):
+            symbol, number, scale = match.groups()
+            amounts.append((cls._number(number) * cls.SCALES.get((scale or "").lower(), 1.0),
+                            CURRENCY_CODES[symbol.lower()]))
+            taken.append(match.span())
+        for match in cls.SUFFIX_PATTERN.finditer(text):
+            if any(start < match.end() and match.start() < end for start, end in taken):
+                continue
+            number, scale, symbol = match.groups()
+            amounts.append((cls._number(number) * cls.SCALES.get((scale or "").lower(), 1.0),
+                            CURRENCY_CODES[symbol.lower()]))
+        return amounts
+
+    @classmethod
+    def is_commercial(cls, section_name: str, content: str) -> bool:
+        return bool(cls.COMMERCIAL_SECTION.search(section_name or "") or cls.PRICE_TABLE_ROW.search(content or ""))
+
+    def add_sections(self, sections):
+        """Index (doc_id, filename, client, industry, section_name, content) tuples"""
+        rows = []
+        for doc_id, filename, client, industry, section_name, content in sections:
+            amounts = self.parse_amounts(content)
+            if not amounts:
+                continue
+            file_id = self._intern("files", filename)
+            client_id = self._intern("clients", client)
+            industry_id = self._intern("industries", industry)
+            commercial = self.is_commercial(section_name, content)
+            rows.extend((amount, currency, doc_id, file_id, client_id, industry_id, commercial)
+                        for amount, currency in amounts)
+        if rows:
+            self.entries = np.concatenate([self.entries, np.array(rows, dtype=PRICE_ENTRY_DTYPE)])
+
+    def remove_sections(self, doc_ids):
+        if len(self.entries) and doc_ids:
+            self.entries = self.entries[~np.isin(self.entries["doc_id"], np.fromiter(doc_ids, dtype=np.int64))]
+
+    def select(self, currency=None, industry=None, client=None, commercial_only=True) -> np.ndarray:
+        """Entries matching all given filters (names are compared case-insensitively)"""
+        mask = np.ones(len(self.entries), dtype=bool)
+        if commercial_only:
+            mask &= self.entries["commercial"]
+        if currency:
+            mask &= self.entries["currency"] == CURRENCY_CODES.get(currency.lower(), currency.upper())
+        for table, field, value in (("industries", "industry", industry), ("clients", "client", client)):
+            if value:
+                value_id = self._ids[table].get(value.strip().lower())
+                if value_id is None:
+                    return self.entries[:0]
+                mask &= self.entries[field] == value_id
+        return self.entries[mask]
+
+    def summary(self, **filters) -> Dict[str, Dict[str, float]]:
+        """Per-currency count/min/max/mean/median over the selected entries"""
+        return self.summarize(self.select(**filters))
+
+    @staticmethod
+    def summarize(entries: np.ndarray) -> Dict[str, Dict[str, float]]:
+        if not len(entries):
+            return {}
+        # Sort by currency then amount so every group is a contiguous, ordered run
+        order = np.lexsort((entries["amount"], entries["currency"]))
+        amounts = entries["amount"][order]
+        currencies, starts, counts = np.unique(entries["currency"][order], return_index=True, return_counts=True)
+        sums = np.add.reduceat(amounts, starts)
+        medians = (amounts[starts + (counts - 1) // 2] + amounts[starts + counts // 2]) / 2
+        return {
+            str(currency): {
+                "count": int(count),
+                "files": int(len(np.unique(entries["file"][entries["currency"] == currency]))),
+                "min": float(amounts[start]),
+                "max": float(amounts[start + count - 1]),
+                "mean": float(total / count),
+                "median": float(median)
+            }
+            for currency, start, count, total, median in zip(currencies, starts, counts, sums, medians)
+        }
+
+class FacetIndex:
+    """Posting lists of document ids per metadata value, used to pre-filter searches.
+
+    Filters are given by facet name (``industry``, ``success``, ``size``, ``client``,
+    ``project``); a list of values matches any of them, and facets are intersected.
+    Values are compared case-insensitively.
+    """
+    FIELDS = ("industry", "success", "size", "client", "project")
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, set]] = {field: {} for field in self.FIELDS}
+        self._doc_keys: Dict[int, Tuple[str, ...]] = {}
+
+    @staticmethod
+    def _key(value) -> str:
+        return str(value).strip().lower()
+
+    def add(self, doc_id: int, values: Dict[str, Any]):
+        keys = tuple(self._key(values.get(field, "")) for field in self.FIELDS)
+        for field, key in zip(self.FIELDS, keys):
+            self.postings[field].setdefault(key, set()).add(doc_id)
+        self._doc_keys[doc_id] = keys
+
+    def remove(self, doc_ids):
+        for doc_id in doc_ids:
+            keys = self._doc_keys.pop(doc_id, None)
+            if keys is None:
+                continue
+            for field, key in zip(self.FIELDS, keys):
+                posting = self.postings[field].get(key)
+                if posting is not None:
+                    posting.discard(doc_id)
+                    if not posting:
+                        del self.postings[field][key]
+
+    def values(self, field: str) -> Dict[str, int]:
+        """Distinct values of a facet with their document counts"""
+        return {key: len(posting) for key, posting in sorted(self.postings[field].items())}
+
+    def match(self, filters: Dict[str, Any]) -> Optional[np.ndarray]:
+        """Sorted ids of the documents matching every filter, or None if no filter is active"""
+        selected = []
+        for field, value in filters.items():
+            if field not in self.postings:
+                raise ValueError(f"Unknown search filter '{field}' (expected one of {', '.join(self.FIELDS)})")
+            if value is None:
+                continue
+            wanted = value if isinstance(value, (list, tuple, set)) else [value]
+            selected.append(set().union(*(self.postings[field].get(self._key(v), set()) for v in wanted)))
+        if not selected:
+            return None
+        # Intersect starting from the most selective facet
+        selected.sort(key=len)
+        matched = selected[0].intersection(*selected[1:])
+        return np.array(sorted(matched), dtype=np.int64)
+
+class NearDuplicateIndex:
+    """MinHash/LSH detector for near-duplicate sections.
+
+    A section's word shingles are min-hashed into ``num_perm`` values whose agreement
+    rate estimates the Jaccard similarity of two sections. LSH splits each signature
+    into ``bands``: sections sharing a band are candidates, and a candidate whose
+    estimated similarity reaches ``threshold`` is a near-duplicate. Only canonical
+    sections are added, so each new section is compared against a few buckets rather
+    than the whole knowledge base. Sections under ``min_words`` words are never
+    collapsed; short sign-offs and headings repeat legitimately.
+    """
+    PRIME = 4294967291 # largest prime below 2**32: every min-hash fits in uint32
+    WORD_PATTERN = re.compile(r"\w+")
+
+    def __init__(self, threshold: float = 0.85, num_perm: int = 128, bands: int = 16, shingle_words: int = 5,
+                 min_words: int = 40, seed: int = 0):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_words = shingle_words
+        self.min_words = min_words
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, self.PRIME, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, self.PRIME, num_perm, dtype=np.uint64)
+        self.signatures: Dict[int, np.ndarray] = {}
+        self._buckets: Dict[Tuple[int, bytes], List[int]] = {}
+
+    @classmethod
+    def from_config(cls, dedup_config: Dict[str, Any]) -> Optional["NearDuplicateIndex"]:
+        """Detector for the ``dedup`` config section; None when deduplication is disabled"""
+        if not dedup_config.get("enabled", True):
+            return None
+        return cls(**{key: dedup_config[key] for key in ("threshold", "num_perm", "bands", "shingle_words", "min_words")
+                      if key in dedup_config})
+
+    def settings(self) -> Dict[str, Any]:
+        return {"threshold": self.threshold, "num_perm": self.num_perm, "bands": self.bands,
+                "shingle_words": self.shingle_words, "min_words": self.min_words, "seed": self.seed}
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """MinHash signature of a text, or None if it is too short to deduplicate"""
+        words = self.WORD_PATTERN.findall(text.lower())
+        if len(words) < self.min_words:
+            return None
+        n = self.shingle_words
+        shingles = {" ".join(words[i:i + n]) for i in range(len(words) - n + 1)}
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+                             dtype=np.uint64, count=len(shingles))
+        # (a*x + b) mod p stays below 2**64 for 32-bit a, b and x; blocks bound the temporary
+        signature = np.full(self.num_perm, self.PRIME, dtype=np.uint64)
+        for start in range(0, len(hashes), 4096):
+            block = (np.outer(self._a, hashes[start:start + 4096]) + self._b[:, None]) % self.PRIME
+            np.minimum(signature, block.min(axis=1), out=signature)
+        return signature.astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray) -> List[Tuple[int, bytes]]:
+        rows = self.num_perm // self.bands
+        return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(self.bands)]
+
+    def query(self, signature: np.ndarray) -> Optional[int]:
+        """The indexed section most similar to a signature, if it reaches the threshold"""
+        candidates = sorted({doc_id for key in self._band_keys(signature) for doc_id in self._buckets.get(key, ())})
+        if not candidates:
+            return None
+        similarities = (np.stack([self.signatures[doc_id] for doc_id in candidates]) == signature).mean(axis=1)
+        best = int(np.argmax(similarities))
+        return candidates[best] if similarities[best] >= self.threshold else None
+
+    def add(self, doc_id: int, signature: np.ndarray):
+        self.signatures[doc_id] = signature
+        for key in self._band_keys(signature):
+            self._buckets.setdefault(key, []).append(doc_id)
+
+    def remove(self, doc_id: int):
+        signature = self.signatures.pop(doc_id, None)
+        if signature is None:
+            return
+        for key in self._band_keys(signature):
+            bucket = self._buckets.get(key, [])
+            if doc_id in bucket:
+                bucket.remove(doc_id)
+            if not bucket:
+                self._buckets.pop(key, None)
+
+class SnapshotMismatchError(ValueError):
+    """Raised when an on-disk KB snapshot was built for a different model or format"""
+
+DOCUMENT_ROW_DTYPE = np.dtype([
+    ("filename", "i4"),
+    ("section_name", "i4"),
+    ("industry", "i4"),
+    ("size", "i4"),
+    ("differentiators", "i4"),
+    ("success", "?"),
+    ("live", "?")
+])
+
+class DocumentView(Mapping):
+    """Read-only mapping over one row of a DocumentStore.
+
+    Behaves like the old per-section dicts (``id``, ``filename``, ``section_name``,
+    ``content``, ``metadata``) but only holds the store and a row number; content is
+    decoded from the shared buffer when it is read.
+    """
+    __slots__ = ("_store", "_doc_id")
+    _KEYS = ("id", "filename", "section_name", "content", "metadata")
+
+    def __init__(self, store, doc_id):
+        self._store = store
+        self._doc_id = doc_id
+
+    def __getitem__(self, key):
+        if key == "id":
+            return self._doc_id
+        if key == "content":
+            return self._store.content(self._doc_id)
+        if key == "filename":
+            return self._store.filename(self._doc_id)
+        if key == "section_name":
+            return self._store.section_name(self._doc_id)
+        if key == "metadata":
+            return self._store.metadata(self._doc_id)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self):
+        return len(self._KEYS)
+
+    def __repr__(self):
+        return f"DocumentView(id={self._doc_id}, filename={self['filename']!r}, section_name={self['section_name']!r})"
+
+class DocumentStore:
+    """Columnar section table.
+
+    Section text lives in one UTF-8 buffer addressed by an offsets array; filenames,
+    section names and metadata values are interned into small string tables referenced
+    from a structured row array. A store loaded from a snapshot memory-maps all three
+    arrays, so processes opening the same snapshot share page-cache pages; call
+    ``writable()`` before appending to it.
+
+    The buffer is a memory-mapped prefix plus an in-memory tail of recent appends:
+    ``spill()`` moves the tail to a scratch file, so a large build never holds the
+    whole corpus text in memory. A writable copy of a snapshot store keeps mapping
+    the snapshot's text as its prefix instead of copying it.
+    """
+    TABLES = ("filename", "section_name", "industry", "size", "differentiators")
+
+    def __init__(self):
+        self._content = bytearray() # Tail not spilled yet; byte offsets continue after the prefix
+        self._prefix = np.zeros(0, dtype=np.uint8) # Memory-mapped text (snapshot or spill file)
+        self._spill_path = None # Scratch file backing the prefix, once this store owns one
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._rows = np.zeros(0, dtype=DOCUMENT_ROW_DTYPE)
+        self._size = 0
+        self.tables = {name: [] for name in self.TABLES}
+        self._lookup = {name: {} for name in self.TABLES}
+        self.read_only = False
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for doc_id in range(self._size):
+            yield self[doc_id]
+
+    def __getitem__(self, doc_id):
+        if not 0 <= doc_id < self._size:
+            raise IndexError(doc_id)
+        if not self._rows["live"][doc_id]:
+            return None # Removed section; ids are only reassigned by compaction
+        return DocumentView(self, doc_id)
+
+    def _intern(self, table, value):
+        lookup = self._lookup[table]
+        if value not in lookup:
+            lookup[value] = len(self.tables[table])
+            self.tables[table].append(value)
+        return lookup[value]
+
+    def _reserve(self, count):
+        if count <= len(self._rows):
+            return
+        capacity = max(count, 2 * len(self._rows), 64)
+        rows = np.zeros(capacity, dtype=DOCUMENT_ROW_DTYPE)
+        rows[:self._size] = self._rows[:self._size]
+        offsets = np.zeros(capacity + 1, dtype=np.int64)
+        offsets[:self._size + 1] = self._offsets[:self._size + 1]
+        self._rows, self._offsets = rows, offsets
+
+    def append(self, filename, section_name, content, metadata) -> int:
+        """Add a section and return its document id"""
+        doc_id = self._size
+        self._reserve(doc_id + 1)
+        self._content.extend(content.encode('utf-8'))
+        self._offsets[doc_id + 1] = len(self._prefix) + len(self._content)
+        self._rows[doc_id] = (
+            self._intern("filename", filename),
+            self._intern("section_name", section_name),
+            self._intern("industry", metadata.get("client_industry", "general")),
+            self._intern("size", metadata.get("project_size", "medium")),
+            self._intern("differentiators", tuple(metadata.get("key_differentiators", ()))),
+            bool(metadata.get("proposal_success", True)),
+            True
+        )
+        self._size += 1
+        return doc_id
+
+    def remove(self, doc_id):
+        self._rows["live"][doc_id] = False
+
+    def unspilled_bytes(self) -> int:
+        return len(self._content)
+
+    def spill(self, directory):
+        """Move the in-memory tail of the text buffer to this store's scratch file and map it"""
+        if self.read_only or not self._content:
+            return
+        if self._spill_path is None:
+            os.makedirs(directory, exist_ok=True)
+            fd, path = tempfile.mkstemp(prefix="content-", suffix=".bin", dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                # A prefix borrowed from a snapshot is copied once so the snapshot is never written to
+                for start in range(0, len(self._prefix), 1 << 24):
+                    f.write(memoryview(self._prefix[start:start + (1 << 24)]))
+            self._spill_path = path
+            weakref.finalize(self, _remove_file_quietly, path)
+        with open(self._spill_path, 'ab') as f:
+            f.write(self._content)
+        self._prefix = np.memmap(self._spill_path, dtype=np.uint8, mode='r')
+        self._content = bytearray()
+
+    def live_ids(self) -> List[int]:
+        return np.flatnonzero(self._rows["live"][:self._size]).tolist()
+
+    def content_bytes(self, doc_id, byte_start=0, byte_end=None) -> memoryview:
+        start = int(self._offsets[doc_id])
+        end = int(self._offsets[doc_id + 1])
+        if byte_end is not None:
+            end = min(end, start + byte_end)
+        # A section is appended and spilled whole, so it never straddles the prefix and the tail
+        spilled = len(self._prefix)
+        if start < spilled:
+            return memoryview(self._prefix)[start + byte_start:end]
+        return memoryview(self._content)[start - spilled + byte_start:end - spilled]
+
+    def content(self, doc_id, byte_start=0, byte_end=None) -> str:
+        # The view is released right away so the in-memory buffer can keep growing
+        with self.content_bytes(doc_id, byte_start, byte_end) as view:
+            # Everything in the store was cleaned at ingestion
+            return CleanText(view, 'utf-8', errors='ignore')
+
+    def filename(self, doc_id) -> str:
+        return self.tables["filename"][self._rows["filename"][doc_id]]
+
+    def section_name(self, doc_id) -> str:
+        return self.tables["section_name"][self._rows["section_name"][doc_id]]
+
+    def metadata(self, doc_id) -> Dict[str, Any]:
+        row = self._rows[doc_id]
+        return {
+            "client_industry": self.tables["industry"][row["industry"]],
+            "proposal_success": bool(row["success"]),
+            "project_size": self.tables["size"][row["size"]],
+            "key_differentiators": list(self.tables["differentiators"][row["differentiators"]])
+        }
+
+    def writable(self) -> "DocumentStore":
+        """In-memory copy of a snapshot-backed store (the store itself if it already is one)"""
+        if not self.read_only:
+            return self
+        store = DocumentStore()
+        store._prefix = self._prefix
+        store._rows = np.array(self._rows[:self._size])
+        store._offsets = np.array(self._offsets[:self._size + 1])
+        store._size = self._size
+        store.tables = {name: list(values) for name, values in self.tables.items()}
+        store._lookup = {name: {value: i for i, value in enumerate(values)} for name, values in store.tables.items()}
+        return store
+
+    def save(self, directory):
+        """Write content.bin, content_offsets.npy, documents.npy and documents.json; removed sections are dropped from the buffer"""
+        offsets = np.zeros(self._size + 1, dtype=np.int64)
+        live = self._rows["live"][:self._size]
+        with open(os.path.join(directory, "content.bin"), 'wb') as content_file:
+            for doc_id in range(self._size):
+                if live[doc_id]:
+                    content_file.write(self.content_bytes(doc_id))
+                offsets[doc_id + 1] = content_file.tell()
+        np.save(os.path.join(directory, "content_offsets.npy"), offsets)
+        np.save(os.path.join(directory, "documents.npy"), np.ascontiguousarray(self._rows[:self._size]))
+        with open(os.path.join(directory, "documents.json"), 'w', encoding='utf-8') as f:
+            json.dump({name: [list(v) if isinstance(v, tuple) else v for v in values]
+                       for name, values in self.tables.items()}, f)
+
+    @classmethod
+    def load(cls, directory) -> "DocumentStore":
+        store = cls()
+        with open(os.path.join(directory, "documents.json"), 'r', encoding='utf-8') as f:
+            tables = json.load(f)
+        tables["differentiators"] = [tuple(values) for values in tables["differentiators"]]
+        store.tables = tables
+        store._lookup = {name: {value: i for i, value in enumerate(values)} for name, values in tables.items()}
+        store._rows = np.load(os.path.join(directory, "documents.npy"), mmap_mode='r')
+        store._offsets = np.load(os.path.join(directory, "content_offsets.npy"), mmap_mode='r')
+        store._size = len(store._rows)
+        content_path = os.path.join(directory, "content.bin")
+        # np.memmap refuses empty files, which happens when every section is blank
+        if os.path.getsize(content_path) > 0:
+            store._prefix = np.memmap(content_path, dtype=np.uint8, mode='r')
+        store.read_only = True
+        return store
+
+class MultiHopSearchMixin:
+    """Query-expansion search on top of ``hybrid_search``/``search_batch``"""
+    def _needs_refinement(self, first, k):
+        # With multi_hop_always_refine off, a first hop that fills k is returned as-is
+        return self.kb_config.get("multi_hop_always_refine", True) or len(first) < k
+
+    def _merge_hops(self, first, second, k):
+        """Reciprocal-rank fusion of the two hops' rankings (their scores are not on one scale)"""
+        rrf_k = self.kb_config.get("rrf_k", 60)
+        fused, by_id = {}, {}
+        for hop in (first, second):
+            for rank, result in enumerate(hop, 1):
+                doc_id = result["document"]["id"]
+                by_id.setdefault(doc_id, result)
+                fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+        # Stable sort: ties keep first-hop order
+        return [by_id[doc_id] for doc_id in sorted(fused, key=fused.get, reverse=True)[:k]]
+
+    def multi_hop_search(self, initial_query, k=5, **filters):
+        # Clean the initial query
+        cleaned_initial_query = remove_problematic_chars(initial_query)
+        first = self.hybrid_search(cleaned_initial_query, k=3*k, **filters)
+        if not self._needs_refinement(first, k):
+            return first[:k]
+        # Result content was cleaned at ingestion
+        refined_query = cleaned_initial_query + " " + " ".join([r["document"]["content"][:200] for r in first[:3]])
+        second = self.hybrid_search(refined_query, k=k, **filters)
+        return self._merge_hops(first, second, k)
+
+    def multi_hop_search_batch(self, initial_queries, k=5, **filters):
+        """multi_hop_search for many queries; each hop is a single search_batch call"""
+        cleaned_queries = [remove_problematic_chars(query) for query in initial_queries]
+        first_hops = self.search_batch(cleaned_queries, k=3*k, **filters)
+        results = [None if self._needs_refinement(first, k) else first[:k] for first in first_hops]
+
+        pending = [i for i, result in enumerate(results) if result is None]
+        if pending:
+            refined_queries = [
+                cleaned_queries[i] + " " + " ".join([r["document"]["content"][:200] for r in first_hops[i][:3]])
+                for i in pending
+            ]
+            for i, second in zip(pending, self.search_batch(refined_queries, k=k, **filters)):
+                results[i] = self._merge_hops(first_hops[i], second, k)
+        return results
+
+# Snapshot versions memory-mapped by live ProposalKnowledgeBase instances of this process (path -> instances)
+_MAPPED_SNAPSHOTS = Counter()
+_MAPPED_SNAPSHOTS_LOCK = threading.Lock()
+
+def _pin_snapshot(kb, snapshot_path):
+    """Keep snapshot_path from being pruned until kb is garbage-collected; returns a finalizer that unpins it"""
+    snapshot_path = os.path.abspath(snapshot_path)
+    with _MAPPED_SNAPSHOTS_LOCK:
+        _MAPPED_SNAPSHOTS[snapshot_path] += 1
+    return weakref.finalize(kb, _unpin_snapshot, snapshot_path)
+
+def _unpin_snapshot(snapshot_path):
+    with _MAPPED_SNAPSHOTS_LOCK:
+        _MAPPED_SNAPSHOTS[snapshot_path] -= 1
+        if _MAPPED_SNAPSHOTS[snapshot_path] <= 0:
+            del _MAPPED_SNAPSHOTS[snapshot_path]
+
+def shard_for_file(filename, shard_count):
+    """Stable shard of a response file: a hash of its cleaned name, independent of directory order"""
+    digest = hashlib.sha1(remove_problematic_chars(filename).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+class ProposalKnowledgeBase(MultiHopSearchMixin):
+    def __init__(self, kb_directory="markdown_responses", embedding_model="all-MiniLM-L6-v2", kb_config=None,
+                 snapshot_path=None, progress=None, rebuild=False):
         self.kb_directory = kb_directory
-        self.model = HierarchicalEmbeddingModel(embedding_model)
-        self.documents = []
+        # Optional progress(stage, done, total) callback for builds (stages: read, chunk, encode)
+        self.progress = progress
+        self._progress_state = {}
+        self.kb_config = kb_config or {}
+        # An already-loaded model can be passed in so several knowledge bases share one copy
+        if isinstance(embedding_model, HierarchicalEmbeddingModel):
+            self.model = embedding_model
+        else:
+            self.model = HierarchicalEmbeddingModel.from_config(embedding_model, self.kb_config)
+        self.embedding_cache = None
+        cache_dir = self.kb_config.get("embedding_cache_dir", ".kb_cache/embeddings")
+        if cache_dir:
+            try:
+                self.embedding_cache = EmbeddingCache(
+                    cache_dir, self.model.model_id,
+                    max_entries=self.kb_config.get("embedding_cache_max_entries", 200000)
+                )
+            except (sqlite3.Error, OSError) as e:
+                print(f"Warning: Embedding cache unavailable ({e}). Sections will be re-encoded on every build.")
+        self.documents = DocumentStore()
         self.section_map = {}
-        self.metadata = []
+        self.file_doc_ids = {}
+        self.file_fingerprints = {}
+        self.deleted_ids = set()
         self.index = None
-        self.tfidf_vectorizer = TfidfVectorizer()
+        self.sparse_index = None
+        self.snapshot_root = self.kb_config.get("snapshot_dir", ".kb_cache/snapshots")
+        self.snapshot_path = None
+        self._snapshot_pin = None # Unpins the snapshot version this instance maps (see _prune_snapshots)
+        self._index_is_mapped = False
+        self.index_config = dict(DEFAULT_INDEX_CONFIG, **self.kb_config.get("index", {}))
+        self.index_tier = None
+        self.index_stats = {}
+        self.full_vectors = None # FullVectorStore behind compressed indexes, for re-ranking
+        self.dense_tombstones = set()
+        self.passages = [] # passage id -> (parent document id, byte start, byte end)
+        self.doc_passages = {}
+        self._chunker = None
+        # Bumped on every index change; result cache keys include it so stale entries are never served
+        self.version = 0
+        self._snapshot_version = None # self.version at the last snapshot save/load
+        self.query_embedding_cache = LRUCache(self.kb_config.get("query_cache_size", 1024))
+        self.result_cache = LRUCache(self.kb_config.get("result_cache_size", 512))
+        # (version, filter key) -> (allowed doc ids, doc mask, passage ids), so repeated filters skip the O(N) masks
+        self.filter_cache = LRUCache(self.kb_config.get("filter_cache_size", 64))
+        self.file_clients = self._load_file_index()
+        self.pricing_index = PricingIndex()
+        self.facet_index = FacetIndex()
+        self._document_level = None # (version, filenames, pooled file vectors, section and passage ids per file), built on first use
+        self._passage_docs = None
+        self._passage_selector = (None, None, None) # (allowed passage ids, FAISS selector, its bitmap) of the last filtered search
+        # Near-duplicate sections are collapsed into the first (canonical) one; only canonical sections are indexed
+        self.near_duplicates = NearDuplicateIndex.from_config(self.kb_config.get("dedup", {}))
+        self.duplicate_of = {} # collapsed section id -> canonical section id
+        self.duplicates = {} # canonical section id -> collapsed section ids
+        self._canonical_map = None
 
         if not os.path.exists(kb_directory):
             os.makedirs(kb_directory)
 
-        self.load_documents()
+        # rebuild=True ignores existing snapshots and re-reads the directory, then writes a fresh one
+        if rebuild or not self._open_latest_snapshot(snapshot_path):
+            self.load_documents()
+            self._save_snapshot_safely()
 
     def load_documents(self):
         """Load all documents from the knowledge base directory"""
-        self.documents = []
+        self.documents = DocumentStore()
         self.section_map = {}
-        self.metadata = []
+        self.file_doc_ids = {}
+        self.file_fingerprints = {}
+        self.deleted_ids = set()
+        self._index_is_mapped = False
+        self.pricing_index = PricingIndex()
+        self.facet_index = FacetIndex()
 
         if not os.path.exists(self.kb_directory):
             return
 
-        for filename in os.listdir(self.kb_directory):
-            if filename.endswith('.md') or filename.endswith('.txt'):
-                file_path = os.path.join(self.kb_directory, filename)
-                # Added errors='replace' here too for reading
-                with open(file_path, 'r', encoding='utf-8', errors='replace') as file:
-                    content = file.read()
-
-                # Clean content immediately after reading
-                cleaned_content = remove_problematic_chars(content)
-
-                # Call the internal method using self
-                sections = self._split_into_sections(cleaned_content) # Use cleaned content
-
-                for section_name, section_content in sections.items():
-                    doc_id = len(self.documents)
-                    metadata = {
-                        "client_industry": "general",
-                        "proposal_success": True,
-                        "project_size": "medium",
-                        "key_differentiators": ["quality", "experience"]
-                    }
-
-                    # Apply cleaning to metadata strings if they come from filenames or external sources
-                    cleaned_filename = remove_problematic_chars(filename)
-                    if "_success_" in cleaned_filename:
-                        metadata["proposal_success"] = cleaned_filename.split("_success_")[1].split("_")[0] == "True"
-                    if "_industry_" in cleaned_filename:
-                        metadata["client_industry"] = remove_problematic_chars(cleaned_filename.split("_industry_")[1].split("_")[0])
-                    if "_size_" in cleaned_filename:
-                        metadata["project_size"] = remove_problematic_chars(cleaned_filename.split("_size_")[1].split("_")[0])
-
-                    self.documents.append({
-                        "id": doc_id,
-                        "filename": cleaned_filename, # Store cleaned filename
-                        "section_name": remove_problematic_chars(section_name), # Store cleaned section name
-                        "content": remove_problematic_chars(section_content), # Store cleaned content
-                        "metadata": metadata
-                    })
-
-                    # Use cleaned section name for mapping
-                    cleaned_section_name = remove_problematic_chars(section_name)
-                    if cleaned_section_name not in self.section_map:
-                        self.section_map[cleaned_section_name] = []
-                    self.section_map[cleaned_section_name].append(doc_id)
-                    self.metadata.append(metadata)
+        files = list(self._scan_directory().items())
+        for done, (filename, file_path, records) in enumerate(self._parse_files(files), 1):
+            self._append_sections(records)
+            self.file_fingerprints[filename] = self._file_fingerprint(file_path)
+            self._spill_documents()
+            self._report_progress("read", done, len(files))
+        self._spill_documents(force=True)
 
         self._build_index()
 
+    def _parse_files(self, files):
+        """Read, clean and split files on a worker pool; yields (filename, path, records) in input order.
+
+        ``ingest_workers`` (0 = one per core) parse in parallel while the caller appends the
+        finished files; at most two files per worker are parsed ahead of it, so memory stays
+        bounded however large the directory is. ``ingest_executor`` "process" also spreads the
+        text cleaning itself over the cores, "thread" (default) overlaps the file reads.
+        """
+        workers = int(self.kb_config.get("ingest_workers", 0)) or min(32, os.cpu_count() or 1)
+        use_processes = self.kb_config.get("ingest_executor", "thread") == "process" and len(files) > workers
+        position = 0
+        while position < len(files):
+            if use_processes:
+                executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+            else:
+                executor = ThreadPoolExecutor(workers, thread_name_prefix="kb-ingest")
+            try:
+                pending = []
+                for filename, file_path in files[position:]:
+                    pending.append((filename, file_path, executor.submit(ProposalKnowledgeBase._read_file_sections, file_path)))
+                    if len(pending) >= 2 * workers:
+                        filename, file_path, future = pending.pop(0)
+                        yield filename, file_path, future.result()
+                        position += 1
+                for filename, file_path, future in pending:
+                    yield filename, file_path, future.result()
+                    position += 1
+            except (BrokenProcessPool, pickle.PicklingError) as e:
+                # e.g. when this module cannot be re-imported in a child process
+                print(f"Warning: Process pool ingestion failed ({e}). Continuing with threads.")
+                use_processes = False
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    def _report_progress(self, stage, done, total):
+        """Per-stage build progress for the callback; printed every 10% on large builds with the stage's throughput"""
+        if self.progress is not None:
+            self.progress(stage, done, total)
+        state = self._progress_state.setdefault(stage, {"started": time.perf_counter(), "step": 0})
+        step = 10 * done // max(total, 1)
+        if step > state["step"] and (total >= 10 * self._ingest_batch_size() or done >= total) and total >= 100:
+            state["step"] = step
+            elapsed = time.perf_counter() - state["started"]
+            print(f"Knowledge base build [{stage}] {done}/{total} in {elapsed:.1f}s ({done / max(elapsed, 1e-9):.0f}/s)")
+        if done >= total:
+            self._progress_state.pop(stage, None)
+
+    @staticmethod
+    def _read_file_sections(file_path):
+        """Read one response file and return its cleaned section records"""
+        filename = os.path.basename(file_path)
+        # Added errors='replace' here too for reading
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as file:
+            content = file.read()
+
+        # Clean content immediately after reading
+        cleaned_content = remove_problematic_chars(content)
+
+        sections = ProposalKnowledgeBase._split_into_sections(cleaned_content) # Use cleaned content
+
+        # Apply cleaning to metadata strings if they come from filenames or external sources
+        cleaned_filename = remove_problematic_chars(filename)
+        records = []
+        for section_name, section_content in sections:
+            metadata = {
+                "client_industry": "general",
+                "proposal_success": True,
+                "project_size": "medium",
+                "key_differentiators": ["quality", "experience"]
+            }
+            if "_success_" in cleaned_filename:
+                metadata["proposal_success"] = cleaned_filename.split("_success_")[1].split("_")[0] == "True"
+            if "_industry_" in cleaned_filename:
+                metadata["client_industry"] = cleaned_filename.split("_industry_")[1].split("_")[0]
+            if "_size_" in cleaned_filename:
+                metadata["project_size"] = cleaned_filename.split("_size_")[1].split("_")[0]
+
+            # Names and content are pieces of the cleaned file text, so they are clean already
+            records.append({
+                "filename": cleaned_filename,
+                "section_name": section_name,
+                "content": section_content,
+                "metadata": metadata
+            })
+        return records
+
+    def _load_file_index(self):
+        """Client/project per response file from files_index.json (keys are cleaned markdown filenames)"""
+        index_path = os.path.join(self.kb_directory, "files_index.json")
+        if not os.path.exists(index_path):
+            return {}
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Warning: Could not read {index_path}: {e}")
+            return {}
+        file_clients = {}
+        for entry in entries:
+            # markdown_file paths were written on Windows ("markdown_responses\\name.md")
+            filename = remove_problematic_chars(ntpath.basename(entry.get("markdown_file", "")))
+            if filename:
+                file_clients[filename] = {
+                    "client": remove_problematic_chars(entry.get("client", "")),
+                    "project": remove_problematic_chars(entry.get("project", ""))
+                }
+        return file_clients
+
+    def client_for_file(self, filename):
+        return self.file_clients.get(filename, {}).get("client") or "Unknown"
+
+    def _index_pricing(self, doc_ids):
+        """Add the amounts of canonical sections; collapsed copies would count the same quote twice"""
+        sections = []
+        for doc_id in doc_ids:
+            document = self.documents[doc_id]
+            if document is None or doc_id in self.duplicate_of:
+                continue
+            sections.append((doc_id, document["filename"], self.client_for_file(document["filename"]),
+                             (document["metadata"] or {}).get("client_industry", "general"),
+                             document["section_name"], document["content"]))
+        self.pricing_index.add_sections(sections)
+
+    def _index_facets(self, doc_ids):
+        for doc_id in doc_ids:
+            document = self.documents[doc_id]
+            if document is None:
+                continue
+            metadata = document["metadata"] or {}
+            file_info = self.file_clients.get(document["filename"], {})
+            self.facet_index.add(doc_id, {
+                "industry": metadata.get("client_industry", "general"),
+                "success": metadata.get("proposal_success", True),
+                "size": metadata.get("project_size", "medium"),
+                "client": file_info.get("client") or "Unknown",
+                "project": file_info.get("project") or "Unknown"
+            })
+
+    @staticmethod
+    def _file_fingerprint(file_path):
+        stat = os.stat(file_path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _ensure_writable(self):
+        """Copy snapshot-backed structures into process memory before the first mutation"""
+        self.documents = self.documents.writable()
+        if isinstance(self.passages, np.ndarray):
+            self.passages = [tuple(int(value) for value in row) for row in self.passages]
+        if self._index_is_mapped and self.index is not None:
+            # A memory-mapped index views read-only pages; serializing round-trips it into owned memory
+            self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+            self._index_is_mapped = False
+        if self.full_vectors is not None:
+            self.full_vectors = self.full_vectors.writable(self._scratch_directory())
+
+    def _spill_documents(self, force=False):
+        """Move section text to a scratch file once ``ingest_spill_mb`` has accumulated (or at the end of a stage)"""
+        limit = float(self.kb_config.get("ingest_spill_mb", 64)) * (1 << 20)
+        if force or self.documents.unspilled_bytes() >= limit:
+            self.documents.spill(self._scratch_directory())
+
+    def _scratch_directory(self):
+        """Where private working files (the full-precision vector store) live until a snapshot copies them"""
+        return os.path.join(self.snapshot_root, "scratch") if self.snapshot_root else tempfile.gettempdir()
+
+    def _append_sections(self, records):
+        """Assign new document ids to section records and register them; returns the new ids"""
+        self._ensure_writable()
+        new_ids = []
+        for record in records:
+            doc_id = self.documents.append(record["filename"], record["section_name"], record["content"], record["metadata"])
+
+            # Use cleaned section name for mapping
+            self.section_map.setdefault(record["section_name"], []).append(doc_id)
+            self.file_doc_ids.setdefault(record["filename"], []).append(doc_id)
+            new_ids.append(doc_id)
+        self._index_pricing(new_ids)
+        self._index_facets(new_ids)
+        return new_ids
+
+    def _live_ids(self):
+        return self.documents.live_ids()
+
     # Moved this function inside the class
-    def _split_into_sections(self, content):
-        """Split a document into sections based on headers"""
-        # Input content is assumed to be already cleaned
-        sections = {}
+    @staticmethod
+    def _split_into_sections(content):
+        """Split a document into (section name, content) pairs based on headers.
+
+        A list is returned rather than a dict so repeated header names within one
+        file keep all of their content.
+        """
+        # Input content is assumed to be already cleaned, so header names are too
+        sections = []
         current_section = "Introduction"
         current_content = []
 
         for line in content.split('\n'):
             if line.startswith('# '):
                 if current_content:
-                    sections[remove_problematic_chars(current_section)] = '\n'.join(current_content)
+                    sections.append((current_section, '\n'.join(current_content)))
                     current_content = []
                 current_section = line[2:].strip()
             elif line.startswith('## '):
                 if current_content:
-                    sections[remove_problematic_chars(current_section)] = '\n'.join(current_content)
+                    sections.append((current_section, '\n'.join(current_content)))
                     current_content = []
                 current_section = line[3:].strip()
             else:
                 current_content.append(line)
 
         if current_content:
-            sections[remove_problematic_chars(current_section)] = '\n'.join(current_content)
+            sections.append((current_section, '\n'.join(current_content)))
 
         return sections
 
+    @property
+    def chunker(self):
+        """Passage chunker bound to the embedding model's tokenizer and sequence length"""
+        if self._chunker is None:
+            tokenizer = getattr(self.model.model, "tokenizer", None)
+            max_tokens = self.kb_config.get("passage_max_tokens", 0)
+            if not max_tokens:
+                # Leave room for the [CLS]/[SEP] tokens the model adds itself
+                max_tokens = int(getattr(self.model.model, "max_seq_length", 256) or 256) - 2
+            self._chunker = PassageChunker(tokenizer, max_tokens, self.kb_config.get("passage_overlap_tokens", 32))
+        return self._chunker
+
+    def _chunk_documents(self, doc_ids):
+        """Split documents into passages and register them; returns the new passage ids.
+
+        Sections are tokenized in bounded batches; only byte ranges are kept, the text
+        stays in the document store.
+        """
+        passage_ids = []
+        batch_size = self._ingest_batch_size()
+        for start in range(0, len(doc_ids), batch_size):
+            batch = doc_ids[start:start + batch_size]
+            for doc_id, ranges in zip(batch, self.chunker.chunk_many([self.documents.content(doc_id) for doc_id in batch])):
+                for byte_start, byte_end in ranges:
+                    passage_id = len(self.passages)
+                    self.passages.append((doc_id, byte_start, byte_end))
+                    self.doc_passages.setdefault(doc_id, []).append(passage_id)
+                    passage_ids.append(passage_id)
+            self._report_progress("chunk", min(start + batch_size, len(doc_ids)), len(doc_ids))
+        return passage_ids
+
+    def _passage_texts(self, passage_ids):
+        texts = []
+        for passage_id in passage_ids:
+            doc_id, byte_start, byte_end = (int(value) for value in self.passages[passage_id])
+            texts.append(self.documents.content(doc_id, byte_start, byte_end))
+        return texts
+
+    def _ingest_batch_size(self):
+        return max(1, int(self.kb_config.get("ingest_batch_size", 1024)))
+
+    def _add_passage_vectors(self, passage_ids):
+        """Embed passages in bounded batches and add them to the dense index.
+
+        Only one batch of texts and vectors is in memory at a time. Indexes that need
+        training (IVF-PQ, compression, PCA) are first trained on an evenly spaced sample of at most
+        ``train_max_vectors`` passages. With ``ingest_encode_processes`` > 1, batches with
+        enough uncached passages are encoded by a sentence-transformers process pool.
+        """
+        batch_size = self._ingest_batch_size()
+        processes = int(self.kb_config.get("ingest_encode_processes", 0))
+        use_pool = processes > 1 and len(passage_ids) >= int(self.kb_config.get("ingest_multiprocess_min_texts", 2000))
+        if use_pool:
+            use_pool = self.model.start_process_pool(processes)
+        try:
+            if not self.index.is_trained:
+                train_size = min(len(passage_ids), int(self.index_config.get("train_max_vectors", 65536)))
+                sample = passage_ids[::max(1, len(passage_ids) // train_size)][:train_size]
+                train_dense_index(self.index, np.vstack([
+                    self._normalized(self._encode_sections(self._passage_texts(sample[i:i + batch_size]), report=False))
+                    for i in range(0, len(sample), batch_size)
+                ]))
+            for start in range(0, len(passage_ids), batch_size):
+                batch = passage_ids[start:start + batch_size]
+                vectors = self._normalized(self._encode_sections(self._passage_texts(batch), report=False))
+                self.index.add_with_ids(vectors, np.array(batch, dtype='int64'))
+                if self.full_vectors is not None:
+                    self.full_vectors.put(batch, vectors)
+                self._report_progress("encode", start + len(batch), len(passage_ids))
+        finally:
+            if use_pool:
+                self.model.stop_process_pool()
+        if self.embedding_cache is not None:
+            stats = self.embedding_cache.stats()
+            print(f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries stored")
+
+    def get_passage(self, passage_id):
+        """Return a passage with its byte range inside the parent section"""
+        doc_id, byte_start, byte_end = (int(value) for value in self.passages[passage_id])
+        return {
+            "passage_id": int(passage_id),
+            "document_id": doc_id,
+            "byte_start": byte_start,
+            "byte_end": byte_end,
+            "text": self.documents.content(doc_id, byte_start, byte_end)
+        }
+
     def _build_index(self):
         """Build a FAISS index for fast similarity search"""
-        if not self.documents:
+        self.index = None
+        self._index_is_mapped = False
+        self.full_vectors = None
+        self.sparse_index = None
+        self.dense_tombstones = set()
+        self.passages = []
+        self.doc_passages = {}
+        self.near_duplicates = NearDuplicateIndex.from_config(self.kb_config.get("dedup", {}))
+        previously_collapsed = set(self.duplicate_of)
+        self.duplicate_of = {}
+        self.duplicates = {}
+        live_ids = self._live_ids()
+        if not live_ids:
+            self.version += 1
+            return
+        indexed_ids = self._collapse_duplicates(live_ids)
+        # Sections that stopped being copies get their amounts back
+        self._index_pricing([doc_id for doc_id in indexed_ids if doc_id in previously_collapsed])
+        if self.duplicate_of:
+            print(f"Near-duplicate sections: {len(self.duplicate_of)} of {len(live_ids)} collapsed into "
+                  f"{len(self.duplicates)} canonical sections")
+        # Dense vectors are built per passage so long sections are embedded in full
+        passage_ids = self._chunk_documents(indexed_ids)
+        # Vectors are stored under their passage id; passage -> document links stay stable
+        # across incremental updates and removals
+        self.index, self.index_tier = build_dense_index(self.model.dimension(), len(passage_ids), self.index_config)
+        if is_lossy_index(self.index_config, self.index_tier):
+            self.full_vectors = FullVectorStore.create(self.model.dimension(), self._scratch_directory())
+        if passage_ids:
+            self._add_passage_vectors(passage_ids)
+        self.sparse_index = self._new_sparse_index()
+        for doc_id in indexed_ids:
+            self.sparse_index.add(doc_id, self.documents.content(doc_id)) # Stored content is already cleaned
+        self.sparse_index.compact()
+
+        self.version += 1
+        self.index_stats = {"tier": self.index_tier, "vectors": len(passage_ids), "documents": len(live_ids),
+                            "duplicates": len(self.duplicate_of), "index_bytes": dense_index_bytes(self.index)}
+        # The exact baseline reads the full-precision vectors back from disk (or the embedding cache)
+        lossy = self.index_tier != "flat" or self.full_vectors is not None
+        if lossy and passage_ids and (self.full_vectors is not None or self.embedding_cache is not None):
+            self.index_stats.update(self.evaluate_index_recall())
+            print(f"Dense index tier '{self.index_tier}': recall@{self.index_stats['k']} vs exact = {self.index_stats['recall']:.3f}")
+
+    @staticmethod
+    def _normalized(embeddings):
+        """L2-normalize rows so that inner product equals cosine similarity"""
+        vectors = np.ascontiguousarray(np.array(embeddings, dtype='float32'))
+        if vectors.ndim == 1:
+            vectors = vectors.reshape(1, -1)
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    def _dense_passage_search(self, query_vectors, fetch, allowed_passages=None):
+        """Raw passage-level search skipping tombstones; one [(score, passage_id), ...] list per query.
+
+        ``allowed_passages`` restricts the search to the given passage ids through a FAISS id
+        selector; on the ANN tiers small sets are scored exactly against their stored vectors.
+        Compressed indexes fetch ``rerank_factor`` times more candidates and re-score them
+        against the full-precision vectors on disk (``rerank_factor`` 0 keeps the approximate scores).
+        """
+        query_vectors = self._normalized(query_vectors)
+        if self.index is None or self.index.ntotal == 0:
+            return [[] for _ in range(len(query_vectors))]
+        if allowed_passages is not None:
+            if len(allowed_passages) == 0:
+                return [[] for _ in range(len(query_vectors))]
+            # Graph and IVF searches lose recall when a selector rejects most candidates;
+            # a small filtered set is cheaper to score exactly anyway
+            if self.index_tier != "flat" and len(allowed_passages) <= self.kb_config.get("filter_exact_max_passages", 4096):
+                return self._exact_passage_search(query_vectors, fetch, allowed_passages)
+            if not supports_id_selector(self.index):
+                return self._exact_passage_search(query_vectors, fetch, allowed_passages)
+        # Only the flat tier removes vectors physically; ANN tiers keep tombstones until
+        # the next compaction, so over-fetch some candidates to make up for them
+        rerank_factor = int(self.index_config.get("rerank_factor", 4)) if self.full_vectors is not None else 0
+        candidates = fetch * max(1, rerank_factor)
+        padded = candidates + min(len(self.dense_tombstones), 4 * candidates)
+        padded = max(1, min(padded, self.index.ntotal))
+        selector = self._selector(allowed_passages) if allowed_passages is not None else None
+        params = dense_search_params(self.index_tier, self.index_config, selector, index=self.index)
+        scores, ids = self.index.search(query_vectors, padded, params=params)
+        results = []
+        for query_vector, row_scores, row_ids in zip(query_vectors, scores, ids):
+            hits = []
+            for score, passage_id in zip(row_scores, row_ids):
+                # FAISS pads with -1 when fewer than k vectors are indexed
+                if passage_id < 0 or passage_id in self.dense_tombstones:
+                    continue
+                hits.append((float(score), int(passage_id)))
+                if len(hits) == candidates:
+                    break
+            if rerank_factor > 0 and hits:
+                exact = self.full_vectors.get([passage_id for _, passage_id in hits]) @ query_vector
+                hits = sorted(((float(score), passage_id) for score, (_, passage_id) in zip(exact, hits)), reverse=True)
+            results.append(hits[:fetch])
+        return results
+
+    def _exact_passage_search(self, query_vectors, fetch, passage_ids):
+        """Brute-force inner products against a small set of passages"""
+        passage_ids = np.asarray(passage_ids, dtype=np.int64)
+        scores = query_vectors @ self._passage_vectors(passage_ids).T
+        results = []
+        for row in scores:
+            top = np.argpartition(-row, fetch - 1)[:fetch] if len(row) > fetch else np.arange(len(row))
+            top = top[np.argsort(-row[top])]
+            results.append([(float(row[i]), int(passage_ids[i])) for i in top])
+        return results
+
+    def _selector(self, allowed_passages):
+        """FAISS id selector for a passage id array, reused while a cached filter hands in the same array.
+
+        A bitmap over passage ids costs one bit test per scanned vector, where IDSelectorBatch
+        hashes every id; the bitmap is kept alongside since FAISS only holds a pointer to it.
+        """
+        passages, selector, _ = self._passage_selector
+        if passages is not allowed_passages:
+            member = np.zeros(len(self.passages), dtype=bool)
+            member[allowed_passages] = True
+            bitmap = np.packbits(member, bitorder='little')
+            selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+            self._passage_selector = (allowed_passages, selector, bitmap)
+        return selector
+
+    def _allowed_passages(self, doc_ids):
+        return np.flatnonzero(self._doc_mask(doc_ids)[self._passage_doc_ids()]).astype(np.int64)
+
+    def _passage_doc_ids(self):
+        """Parent section id of every passage as an array, cached per version"""
+        cached = self._passage_docs
+        if cached is None or cached[0] != self.version:
+            docs = np.asarray(self.passages, dtype=np.int64).reshape(-1, 3)[:, 0]
+            self._passage_docs = cached = (self.version, docs)
+        return cached[1]
+
+    def _dense_search(self, query_vectors, k, allowed_docs=None, allowed_passages=None):
+        """Passage-level search aggregated to sections; one [(score, doc_id, best passage id), ...] list per query.
+
+        A section scores as its best-matching passage. ``allowed_passages`` can be passed
+        when already known for ``allowed_docs`` (see ``_filter_masks``).
+        """
+        fetch = k * max(1, int(self.kb_config.get("passage_fetch_factor", 4)))
+        if allowed_passages is None and allowed_docs is not None:
+            allowed_passages = self._allowed_passages(allowed_docs)
+        return [self._best_passage_per_section(hits, k) for hits in self._dense_passage_search(query_vectors, fetch, allowed_passages)]
+
+    def _best_passage_per_section(self, hits, k):
+        """Top-k sections of score-ordered passage hits, each as (score, doc_id, best passage id)"""
+        best = {}
+        for score, passage_id in hits:
+            doc_id = int(self.passages[passage_id][0])
+            if doc_id not in best:
+                best[doc_id] = (score, doc_id, passage_id)
+                if len(best) == k:
+                    break
+        return list(best.values())
+
+    def evaluate_index_recall(self, k=None, n_queries=None, vectors=None, seed=0):
+        """Measure recall@k of the dense index against exact search on a held-out query set.
+
+        Queries are the distinct section headings of the knowledge base (sampled up
+        to ``recall_eval_queries``), i.e. short natural-language probes that are not
+        themselves indexed as documents.
+        """
+        k = k or self.index_config["recall_eval_k"]
+        n_queries = n_queries or self.index_config["recall_eval_queries"]
+        if self.index is None:
+            return {"k": k, "queries": 0, "recall": None}
+        if vectors is None:
+            base_ids = [pid for pid in range(len(self.passages)) if pid not in self.dense_tombstones
+                        and int(self.passages[pid][0]) not in self.deleted_ids]
+            if not base_ids:
+                return {"k": k, "queries": 0, "recall": None}
+            # Stream the exact baseline in bounded batches rather than materializing every vector
+            batch_size = self._ingest_batch_size()
+            blocks = ((base_ids[i:i + batch_size], self._full_precision_vectors(base_ids[i:i + batch_size]))
+                      for i in range(0, len(base_ids), batch_size))
+        else:
+            base_vectors, base_ids = vectors
+            blocks = [(base_ids, base_vectors)]
+
+        rng = np.random.default_rng(seed)
+        headings = sorted(self.section_map.keys())
+        if len(headings) > n_queries:
+            headings = [headings[i] for i in rng.choice(len(headings), n_queries, replace=False)]
+        if not headings:
+            return {"k": k, "queries": 0, "recall": None}
+        queries = self._normalized(self.model.encode(headings))
+        k = min(k, len(base_ids))
+
+        exact = self._exact_top_k(queries, blocks, k)
+        approx = self._dense_passage_search(queries, k)
+        overlap = [len(set(exact_row.tolist()) & {passage_id for _, passage_id in approx_row}) / k
+                   for exact_row, approx_row in zip(exact, approx)]
+        return {"k": k, "queries": len(headings), "recall": float(np.mean(overlap))}
+
+    @staticmethod
+    def _exact_top_k(queries, blocks, k):
+        """Ids of each query's k best inner products over (ids, vectors) blocks, keeping a running top-k"""
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_ids = np.empty((len(queries), 0), dtype=np.int64)
+        for ids, vectors in blocks:
+            ids = np.asarray(ids, dtype=np.int64)
+            scores = np.concatenate([best_scores, queries @ np.asarray(vectors).T], axis=1)
+            candidates = np.concatenate([best_ids, np.broadcast_to(ids, (len(queries), len(ids)))], axis=1)
+            keep = np.argpartition(-scores, min(k, scores.shape[1]) - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(scores, keep, axis=1)
+            best_ids = np.take_along_axis(candidates, keep, axis=1)
+        return best_ids
+
+    def _new_sparse_index(self):
+        bm25_config = self.kb_config.get("bm25", {})
+        return BM25Index(bm25_config.get("k1", 1.5), bm25_config.get("b", 0.75), bm25_config.get("epsilon", 0.25))
+
+    def _index_new_sections(self, doc_ids):
+        """Add freshly appended documents to the dense and sparse indexes"""
+        if not doc_ids:
+            return
+        if self.index is None or self.sparse_index is None:
+            self._build_index()
+            return
+        self._ensure_writable()
+        self._index_sections(self._collapse_duplicates(doc_ids))
+
+    def _index_sections(self, doc_ids):
+        """Add canonical sections to the dense and sparse indexes"""
+        live_count = self.index.ntotal - len(self.dense_tombstones)
+        if select_index_tier(live_count + len(doc_ids), self.index_config) != self.index_tier:
+            # The corpus crossed a tier threshold; rebuild (vectors come from the embedding cache)
+            self._build_index()
+            return
+        passage_ids = self._chunk_documents(doc_ids)
+        if passage_ids:
+            self._add_passage_vectors(passage_ids)
+        for doc_id in doc_ids:
+            self.sparse_index.add(doc_id, self.documents.content(doc_id))
+        self.version += 1
+
+    def _collapse_duplicates(self, doc_ids):
+        """Link near-duplicates of indexed sections to their canonical section; returns the ids to index"""
+        if self.near_duplicates is None:
+            return list(doc_ids)
+        canonical_ids = []
+        for doc_id in doc_ids:
+            signature = self.near_duplicates.signature(self.documents.content(doc_id))
+            canonical = self.near_duplicates.query(signature) if signature is not None else None
+            if canonical is None:
+                if signature is not None:
+                    self.near_duplicates.add(doc_id, signature)
+                canonical_ids.append(doc_id)
+            else:
+                self.duplicate_of[doc_id] = canonical
+                self.duplicates.setdefault(canonical, []).append(doc_id)
+        self.pricing_index.remove_sections([doc_id for doc_id in doc_ids if doc_id in self.duplicate_of])
+        return canonical_ids
+
+    def _release_duplicates(self, doc_ids):
+        """Unlink sections being removed from their duplicate groups; returns duplicates promoted to canonical.
+
+        When a canonical section goes, its first remaining duplicate takes its place (and
+        has to be indexed), so the text stays searchable as long as any copy exists.
+        """
+        removed = set(doc_ids)
+        promoted = []
+        for doc_id in doc_ids:
+            canonical = self.duplicate_of.pop(doc_id, None)
+            if canonical is not None:
+                group = self.duplicates.get(canonical, [])
+                if doc_id in group:
+                    group.remove(doc_id)
+                if not group:
+                    self.duplicates.pop(canonical, None)
+                continue
+            if self.near_duplicates is not None:
+                self.near_duplicates.remove(doc_id)
+            group = [dup_id for dup_id in self.duplicates.pop(doc_id, []) if dup_id not in removed]
+            if not group:
+                continue
+            heir, rest = group[0], group[1:]
+            del self.duplicate_of[heir]
+            for dup_id in rest:
+                self.duplicate_of[dup_id] = heir
+            if rest:
+                self.duplicates[heir] = rest
+            signature = self.near_duplicates.signature(self.documents.content(heir))
+            if signature is not None:
+                self.near_duplicates.add(heir, signature)
+            promoted.append(heir)
+        return promoted
+
+    def section_sources(self, doc_id):
+        """Files a section's text appears in: the section's own file first, then every other copy"""
+        canonical = self.duplicate_of.get(doc_id, doc_id)
+        filenames = [self.documents.filename(doc_id)]
+        for dup_id in [canonical] + self.duplicates.get(canonical, []):
+            filename = self.documents.filename(dup_id)
+            if filename not in filenames:
+                filenames.append(filename)
+        return filenames
+
+    def _filtered_member(self, doc_id, allowed_docs):
+        """The section of doc_id's duplicate group that passes the filter (sorted ``allowed_docs``).
+
+        Filters select collapsed copies through their canonical section, so a hit has to be
+        reported as the copy that actually matched, not as a section from another file.
+        """
+        if allowed_docs is None or doc_id not in self.duplicates:
+            return doc_id # a hit without copies passed the filter itself
+        for member in [doc_id] + self.duplicates[doc_id]:
+            position = np.searchsorted(allowed_docs, member)
+            if position < len(allowed_docs) and allowed_docs[position] == member:
+                return member
+        return doc_id
+
+    def _canonical_ids(self):
+        """Canonical section id of every section id as an array, cached per version"""
+        cached = self._canonical_map
+        if cached is None or cached[0] != self.version:
+            canonical = np.arange(len(self.documents), dtype=np.int64)
+            if self.duplicate_of:
+                canonical[np.fromiter(self.duplicate_of.keys(), dtype=np.int64, count=len(self.duplicate_of))] = \
+                    np.fromiter(self.duplicate_of.values(), dtype=np.int64, count=len(self.duplicate_of))
+            self._canonical_map = cached = (self.version, canonical)
+        return cached[1]
+
+    def _tombstone(self, doc_ids):
+        """Mark documents as deleted without renumbering the remaining ones"""
+        if not doc_ids:
+            return
+        self._ensure_writable()
+        promoted = self._release_duplicates(doc_ids)
+        for doc_id in doc_ids:
+            document = self.documents[doc_id]
+            if document is None:
+                continue
+            same_name = self.section_map.get(document["section_name"], [])
+            if doc_id in same_name:
+                same_name.remove(doc_id)
+            if not same_name:
+                self.section_map.pop(document["section_name"], None)
+            self.documents.remove(doc_id)
+            self.deleted_ids.add(doc_id)
+
+        passage_ids = [pid for doc_id in doc_ids for pid in self.doc_passages.pop(doc_id, [])]
+        if self.index is not None and passage_ids:
+            if self.index_tier == "flat":
+                remove_dense_ids(self.index, passage_ids)
+            else:
+                # Graph and IVF-PQ indexes cannot drop vectors in place
+                self.dense_tombstones.update(passage_ids)
+        if self.sparse_index is not None:
+            for doc_id in doc_ids:
+                self.sparse_index.remove(doc_id)
+        self.pricing_index.remove_sections(doc_ids)
+        self._index_pricing(promoted)
+        self.facet_index.remove(doc_ids)
+        self.version += 1
+        if promoted and self.index is not None and self.sparse_index is not None:
+            self._index_sections(promoted)
+
+    def _maybe_compact(self):
+        """Compact once removed sections exceed ``compaction_tombstone_ratio`` of all rows.
+
+        Compaction renumbers sections, so this runs only after an update has finished using its ids.
+        """
+        max_ratio = self.kb_config.get("compaction_tombstone_ratio", 0.3)
+        if self.documents and len(self.deleted_ids) / len(self.documents) > max_ratio:
+            self.compact()
+
+    def compact(self):
+        """Drop removed sections for good: live sections are renumbered densely and every index is rebuilt over them"""
+        documents = self.documents
+        records = [
+            {"filename": documents.filename(doc_id), "section_name": documents.section_name(doc_id),
+             "content": documents.content(doc_id), "metadata": documents.metadata(doc_id)}
+            for doc_id in self._live_ids()
+        ]
+        self.documents = DocumentStore()
+        self.section_map = {}
+        self.file_doc_ids = {}
+        self.deleted_ids = set()
+        self.pricing_index = PricingIndex()
+        self.facet_index = FacetIndex()
+        self._append_sections(records)
+        self._spill_documents(force=True)
+        self._build_index()
+
+    def upsert_file(self, file_path):
+        """Add or refresh one response file, touching only the sections that changed"""
+        records = self._read_file_sections(file_path)
+        filename = remove_problematic_chars(os.path.basename(file_path))
+
+        # Unchanged sections keep their document ids; everything else is replaced
+        existing = {}
+        for doc_id in self.file_doc_ids.get(filename, []):
+            document = self.documents[doc_id]
+            if document is not None:
+                existing.setdefault((document["section_name"], document["content"]), []).append(doc_id)
+
+        kept_ids, new_records = [], []
+        for record in records:
+            matches = existing.get((record["section_name"], record["content"]))
+            if matches:
+                kept_ids.append(matches.pop(0))
+            else:
+                new_records.append(record)
+        stale_ids = [doc_id for ids in existing.values() for doc_id in ids]
+
+        self._tombstone(stale_ids)
+        self.file_fingerprints[filename] = self._file_fingerprint(file_path)
+        self.file_doc_ids[filename] = list(kept_ids)
+        new_ids = self._append_sections(new_records)
+        if self.index is not None:
+            self._index_new_sections(new_ids)
+        else:
+            self._build_index()
+        result = {"added": new_ids, "removed": stale_ids, "unchanged": kept_ids}
+        self._maybe_compact()
+        return result
+
+    def remove_file(self, file_path):
+        """Drop every section that came from the given response file"""
+        filename = remove_problematic_chars(os.path.basename(file_path))
+        doc_ids = [doc_id for doc_id in self.file_doc_ids.pop(filename, []) if self.documents[doc_id] is not None]
+        self.file_fingerprints.pop(filename, None)
+        self._tombstone(doc_ids)
+        self._maybe_compact()
+        return doc_ids
+
+    def apply_file_changes(self, file_paths):
+        """Upsert or remove just the given response files (e.g. from watcher events); True if anything changed"""
+        changed = False
+        for file_path in file_paths:
+            filename = os.path.basename(file_path)
+            if not (filename.endswith('.md') or filename.endswith('.txt')) or not self.owns_file(filename):
+                continue
+            if os.path.exists(file_path):
+                if self.file_fingerprints.get(remove_problematic_chars(filename)) != self._file_fingerprint(file_path):
+                    self.upsert_file(file_path)
+                    changed = True
+            elif remove_problematic_chars(filename) in self.file_fingerprints:
+                self.remove_file(file_path)
+                changed = True
+        return changed
+
+    def fork(self):
+        """Independent copy to apply changes to while this instance keeps serving searches.
+
+        The copy re-opens this instance's snapshot (memory-mapped, so nothing is copied until
+        it is modified); without snapshots it falls back to a full rebuild from the directory.
+        """
+        if self.snapshot_root and self._snapshot_version != self.version:
+            self._save_snapshot_safely()
+        if self.snapshot_path is None or self._snapshot_version != self.version:
+            return ProposalKnowledgeBase(self.kb_directory, self.model, self.kb_config)
+        clone = ProposalKnowledgeBase(self.kb_directory, self.model, self.kb_config, snapshot_path=self.snapshot_path)
+        # Query embeddings depend only on the model, so the warm cache carries over
+        clone.query_embedding_cache = self.query_embedding_cache
+        return clone
+
+    def _scan_directory(self):
+        """Cleaned filename -> path for every response file currently in the KB directory"""
+        current = {}
+        if os.path.exists(self.kb_directory):
+            for filename in os.listdir(self.kb_directory):
+                if (filename.endswith('.md') or filename.endswith('.txt')) and self.owns_file(filename):
+                    current[remove_problematic_chars(filename)] = os.path.join(self.kb_directory, filename)
+        return current
+
+    def owns_file(self, filename):
+        """False for files that belong to another shard (see the ``shard`` config key)"""
+        shard = self.kb_config.get("shard")
+        return not shard or shard_for_file(filename, shard[1]) == shard[0]
+
+    def has_directory_changes(self):
+        """True if files were added, modified or removed since the KB was last synced (read-only check)"""
+        current = self._scan_directory()
+        if set(current) != set(self.file_fingerprints):
+            return True
+        return any(self.file_fingerprints[filename] != self._file_fingerprint(path) for filename, path in current.items())
+
+    def sync_with_directory(self):
+        """Upsert new/modified files and remove deleted ones; returns True if anything changed"""
+        current = self._scan_directory()
+
+        changed = False
+        for filename in list(self.file_fingerprints):
+            if filename not in current:
+                self.remove_file(filename)
+                changed = True
+        for filename, file_path in current.items():
+            if self.file_fingerprints.get(filename) != self._file_fingerprint(file_path):
+                self.upsert_file(file_path)
+                changed = True
+        return changed
+
+    # --- Snapshots ---
+    def _snapshot_namespace(self):
+        """Directory holding the snapshot versions for this KB directory"""
+        key = os.path.abspath(self.kb_directory)
+        if self.kb_config.get("shard"):
+            key += "#shard{}/{}".format(*self.kb_config["shard"])
+        if self.model.model_id != self.model.model_name:
+            # Other backends get their own snapshots, so switching back and forth never forces a rebuild
+            key += "#" + self.model.model_id
+        return os.path.join(self.snapshot_root, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+    def save_snapshot(self):
+        """Write the index, document table and sparse matrix to a new snapshot version"""
+        if self.index is None or self.sparse_index is None:
+            return None
+        namespace = self._snapshot_namespace()
+        os.makedirs(namespace, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=namespace)
+        try:
+            self.documents.save(staging)
+
+            faiss.write_index(self.index, os.path.join(staging, "dense.faiss"))
+            if self.full_vectors is not None:
+                self.full_vectors.save(staging)
+            np.save(os.path.join(staging, "passages.npy"), np.array(self.passages, dtype=np.int64).reshape(-1, 3))
+
+            self.sparse_index.save(staging)
+            self._save_duplicates(staging)
+
+            manifest = {
+                "format_version": SNAPSHOT_FORMAT_VERSION,
+                "embedding_model": self.model.model_id,
+                "dimension": int(self.index.d),
+                "metric": "inner_product",
+                "index_tier": self.index_tier,
+                "compression": self.index_config.get("compression", "none"),
+                "pca_dims": int(self.index_config.get("pca_dims", 0)),
+                "dedup": self.near_duplicates.settings() if self.near_duplicates is not None else None,
+                "kb_directory": os.path.abspath(self.kb_directory),
+                "document_count": len(self.documents),
+                "files": self.file_fingerprints,
+                "created_at": datetime.now().isoformat()
+            }
+            with open(os.path.join(staging, "manifest.json"), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=2)
+
+            version = f"v{time.time_ns()}"
+            final_path = os.path.join(namespace, version)
+            os.rename(staging, final_path)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        # Publish atomically: readers either see the previous CURRENT or the new one
+        pointer_tmp = os.path.join(namespace, f".CURRENT.{os.getpid()}")
+        with open(pointer_tmp, 'w') as f:
+            f.write(version)
+        os.replace(pointer_tmp, os.path.join(namespace, "CURRENT"))
+        self.snapshot_path = final_path
+        self._snapshot_version = self.version
+        self._prune_snapshots(namespace)
+        return final_path
+
+    def _save_duplicates(self, directory):
+        """Duplicate links and the LSH signatures of canonical sections"""
+        pairs = np.array(sorted(self.duplicate_of.items()), dtype=np.int64).reshape(-1, 2)
+        np.save(os.path.join(directory, "duplicates.npy"), pairs)
+        signatures = self.near_duplicates.signatures if self.near_duplicates is not None else {}
+        num_perm = self.near_duplicates.num_perm if self.near_duplicates is not None else 0
+        ids = np.array(sorted(signatures), dtype=np.int64)
+        np.save(os.path.join(directory, "dedup_ids.npy"), ids)
+        np.save(os.path.join(directory, "dedup_signatures.npy"),
+                np.array([signatures[doc_id] for doc_id in ids.tolist()], dtype=np.uint32).reshape(len(ids), num_perm))
+
+    def _load_duplicates(self, directory):
+        pairs = np.load(os.path.join(directory, "duplicates.npy"))
+        self.duplicate_of = dict(zip(pairs[:, 0].tolist(), pairs[:, 1].tolist()))
+        self.duplicates = {}
+        for dup_id, canonical in self.duplicate_of.items():
+            self.duplicates.setdefault(canonical, []).append(dup_id)
+        if self.near_duplicates is not None:
+            signatures = np.load(os.path.join(directory, "dedup_signatures.npy"))
+            for doc_id, signature in zip(np.load(os.path.join(directory, "dedup_ids.npy")).tolist(), signatures):
+                self.near_duplicates.add(doc_id, signature)
+
+    def _prune_snapshots(self, namespace):
+        """Delete old snapshot versions that no live instance of this process still maps.
+
+        A version swapped out by a reload stays on disk while in-flight searches hold the
+        old instance, and goes with the first save after it is collected. Other processes
+        that still map a deleted version keep valid pages.
+        """
+        keep = max(1, int(self.kb_config.get("snapshots_to_keep", 2)))
+        versions = sorted(name for name in os.listdir(namespace) if name.startswith("v"))
+        with _MAPPED_SNAPSHOTS_LOCK:
+            mapped = set(_MAPPED_SNAPSHOTS)
+        for name in versions[:-keep]:
+            path = os.path.join(namespace, name)
+            if os.path.abspath(path) not in mapped:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def load_snapshot(self, snapshot_path=None):
+        """Attach to a snapshot read-only and memory-mapped; raises SnapshotMismatchError on model/format mismatch"""
+        if snapshot_path is None:
+            pointer = os.path.join(self._snapshot_namespace(), "CURRENT")
+            with open(pointer, 'r') as f:
+                snapshot_path = os.path.join(self._snapshot_namespace(), f.read().strip())
+
+        with open(os.path.join(snapshot_path, "manifest.json"), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+            raise SnapshotMismatchError(
+                f"Snapshot format {manifest.get('format_version')} is not supported (expected {SNAPSHOT_FORMAT_VERSION})"
+            )
+        if manifest.get("embedding_model") != self.model.model_id:
+            raise SnapshotMismatchError(
+                f"Snapshot was built with embedding model '{manifest.get('embedding_model')}', "
+                f"but the knowledge base is configured for '{self.model.model_id}'"
+            )
+        expected_dimension = self.model.dimension()
+        if manifest.get("dimension") != expected_dimension:
+            raise SnapshotMismatchError(
+                f"Snapshot vectors have dimension {manifest.get('dimension')}, "
+                f"but '{self.model.model_name}' produces {expected_dimension}"
+            )
+
+        layout = (self.index_config.get("compression", "none"), int(self.index_config.get("pca_dims", 0)))
+        if (manifest.get("compression", "none"), manifest.get("pca_dims", 0)) != layout:
+            raise SnapshotMismatchError(
+                f"Snapshot vectors are stored with compression={manifest.get('compression', 'none')}, "
+                f"pca_dims={manifest.get('pca_dims', 0)}, but the index is configured for "
+                f"compression={layout[0]}, pca_dims={layout[1]}"
+            )
+
+        near_duplicates = NearDuplicateIndex.from_config(self.kb_config.get("dedup", {}))
+        dedup_settings = near_duplicates.settings() if near_duplicates is not None else None
+        if manifest.get("dedup") != dedup_settings:
+            raise SnapshotMismatchError(
+                f"Snapshot was deduplicated with {manifest.get('dedup')}, but the knowledge base is configured for {dedup_settings}"
+            )
+
+        index = faiss.read_index(os.path.join(snapshot_path, "dense.faiss"), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        if index.d != expected_dimension:
+            raise SnapshotMismatchError(f"Snapshot index dimension {index.d} does not match manifest")
+        documents = DocumentStore.load(snapshot_path)
+        passages = np.load(os.path.join(snapshot_path, "passages.npy"), mmap_mode='r')
+        sparse_index = BM25Index.load(snapshot_path)
+
+        self.index = index
+        self.index_tier = manifest.get("index_tier", "flat")
+        self.index_stats = {"tier": self.index_tier, "vectors": index.ntotal}
+        self._index_is_mapped = True
+        self.full_vectors = FullVectorStore.load(snapshot_path, expected_dimension)
+        self.dense_tombstones = set()
+        self.documents = documents
+        self.passages = passages
+        self.doc_passages = {}
+        for passage_id, doc_id in enumerate(passages[:, 0].tolist()):
+            self.doc_passages.setdefault(doc_id, []).append(passage_id)
+        self.sparse_index = sparse_index
+        self.near_duplicates = near_duplicates
+        self._load_duplicates(snapshot_path)
+        self.file_fingerprints = manifest.get("files", {})
+        self.section_map = {}
+        self.file_doc_ids = {}
+        self.deleted_ids = set(range(len(documents))) - set(documents.live_ids())
+        for doc_id in documents.live_ids():
+            self.section_map.setdefault(documents.section_name(doc_id), []).append(doc_id)
+            self.file_doc_ids.setdefault(documents.filename(doc_id), []).append(doc_id)
+        self.snapshot_path = snapshot_path
+        if self._snapshot_pin is not None:
+            self._snapshot_pin() # Nothing is mapped from the previously loaded version any more
+        self._snapshot_pin = _pin_snapshot(self, snapshot_path)
+        self.pricing_index = PricingIndex()
+        self._index_pricing(self._live_ids())
+        self.facet_index = FacetIndex()
+        self._index_facets(self._live_ids())
+        self.version += 1
+        self._snapshot_version = self.version
+
+    def _open_latest_snapshot(self, snapshot_path=None):
+        """Attach to the current snapshot and catch up with directory changes; False if a rebuild is needed.
+
+        An explicit snapshot_path is opened as-is, without the directory sync (see ``fork``).
+        """
+        if not self.snapshot_root:
+            return False
+        try:
+            self.load_snapshot(snapshot_path)
+        except FileNotFoundError:
+            return False
+        except SnapshotMismatchError as e:
+            print(f"Ignoring knowledge base snapshot: {e}. Rebuilding.")
+            return False
+        except Exception as e:
+            print(f"Could not open knowledge base snapshot ({e}). Rebuilding.")
+            return False
+
+        if snapshot_path is None and self.sync_with_directory():
+            self._save_snapshot_safely()
+        return True
+
+    def _save_snapshot_safely(self):
+        if not self.snapshot_root:
             return
-        # Ensure texts for indexing are cleaned
-        texts = [remove_problematic_chars(doc["content"]) for doc in self.documents]
-        embeddings = self.model.encode(texts)
-        dimension = embeddings.shape[1]
-        self.index = faiss.IndexFlatL2(dimension)
-        self.index.add(np.array(embeddings).astype('float32'))
-        self.tfidf_matrix = self.tfidf_vectorizer.fit_transform(texts)
-
-    def hybrid_search(self, query, k=5):
-        """Hybrid search combining dense and sparse retrieval"""
-        if not self.index or not self.documents:
+        try:
+            self.save_snapshot()
+        except Exception as e:
+            print(f"Warning: Could not write knowledge base snapshot: {e}")
+
+    def _encode_sections(self, texts, report=True):
+        """Embed section texts through the on-disk cache when it is available"""
+        if self.embedding_cache is None:
+            return self.model.encode(texts)
+        embeddings = self.embedding_cache.encode(texts, self.model.encode)
+        if report:
+            stats = self.embedding_cache.stats()
+            print(f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries stored")
+        return embeddings
+
+    def _encode_queries(self, cleaned_queries):
+        """Query embeddings through the in-memory LRU; misses are encoded in a single model call"""
+        vectors = [self.query_embedding_cache.get(query) for query in cleaned_queries]
+        missing = list(dict.fromkeys(query for query, vector in zip(cleaned_queries, vectors) if vector is None))
+        if missing:
+            fresh = dict(zip(missing, np.asarray(self.model.encode(missing), dtype=np.float32)))
+            for query, vector in fresh.items():
+                self.query_embedding_cache.put(query, vector)
+            vectors = [fresh[query] if vector is None else vector for query, vector in zip(cleaned_queries, vectors)]
+        return np.vstack(vectors)
+
+    @staticmethod
+    def _copy_results(results):
+        """Cached lists are handed out as shallow copies; documents are read-only views and are shared"""
+        return [dict(result) for result in results]
+
+    def cache_stats(self):
+        return {"query_embeddings": self.query_embedding_cache.stats(), "results": self.result_cache.stats()}
+
+    def _full_precision_vectors(self, passage_ids):
+        """Exact normalized passage vectors: from the on-disk store, else re-encoded through the embedding cache"""
+        if self.full_vectors is not None:
+            return self.full_vectors.get(passage_ids)
+        return self._normalized(self._encode_sections(self._passage_texts(list(passage_ids)), report=False))
+
+    def _passage_vectors(self, passage_ids):
+        """Normalized vectors of indexed passages (re-read from the embedding cache if the index cannot reconstruct)"""
+        if self.full_vectors is not None:
+            return self.full_vectors.get(passage_ids)
+        try:
+            return self.index.reconstruct_batch(np.asarray(passage_ids, dtype=np.int64)).astype('float32')
+        except RuntimeError:
+            return self._normalized(self._encode_sections([self.get_passage(pid)["text"] for pid in passage_ids]))
+
+    def _section_similarities(self, query_vector, doc_ids, dense_hits):
+        """Cosine similarity of each section's best passage to the query.
+
+        Sections found by the dense retriever already carry it; sections found only
+        by BM25 are scored against their passage vectors.
+        """
+        similarities = {doc_id: (score, passage_id) for score, doc_id, passage_id in dense_hits}
+        missing = [doc_id for doc_id in doc_ids if doc_id not in similarities]
+        passage_ids = [pid for doc_id in missing for pid in self.doc_passages.get(doc_id, [])]
+        if passage_ids:
+            scores = self._passage_vectors(passage_ids) @ self._normalized(query_vector)[0]
+            for pid, score in zip(passage_ids, scores):
+                doc_id = int(self.passages[pid][0])
+                if doc_id not in similarities or score > similarities[doc_id][0]:
+                    similarities[doc_id] = (float(score), pid)
+        for doc_id in missing:
+            similarities.setdefault(doc_id, (0.0, None)) # Sections with no text to embed
+        return similarities
+
+    def _filter_masks(self, filters):
+        """(allowed doc ids, boolean doc mask, allowed passage ids) for facet filters.
+
+        All None when unfiltered or when the filters match every live section, so such
+        searches cost the same as unfiltered ones. Cached per filter and index version.
+        """
+        if not filters:
+            return None, None, None
+        cache_key = (self.version, self._filter_key(filters))
+        cached = self.filter_cache.get(cache_key)
+        if cached is None:
+            allowed_docs = self.facet_index.match(filters)
+            if allowed_docs is None or len(allowed_docs) >= len(self.documents) - len(self.deleted_ids):
+                cached = (None, None, None)
+            else:
+                cached = (allowed_docs, self._doc_mask(allowed_docs), self._allowed_passages(allowed_docs))
+            self.filter_cache.put(cache_key, cached)
+        return cached
+
+    def _doc_mask(self, doc_ids):
+        """Boolean mask over indexed sections; collapsed duplicates select their canonical section"""
+        mask = np.zeros(len(self.documents), dtype=bool)
+        mask[self._canonical_ids()[np.asarray(doc_ids, dtype=np.int64)]] = True
+        return mask
+
+    def _document_vectors(self):
+        """(filenames, vectors) of the document level: one pooled unit vector per response file.
+
+        Pooled from the passage vectors already in the dense index, so no text is re-encoded;
+        rebuilt on first use after any change to the knowledge base.
+        """
+        return self._document_level_index()[:2]
+
+    def _document_level_index(self):
+        """(filenames, pooled vectors, live section ids per file, live passage ids per file) for the current version"""
+        cached = self._document_level
+        if cached is not None and cached[0] == self.version:
+            return cached[1:]
+        filenames, file_docs, file_passages, counts, passage_ids = [], [], [], [], []
+        for filename, doc_ids in self.file_doc_ids.items():
+            live_docs = [doc_id for doc_id in sorted(doc_ids) if doc_id not in self.deleted_ids]
+            canonical = self._canonical_ids()
+            ids = [pid for doc_id in live_docs for pid in self.doc_passages.get(int(canonical[doc_id]), [])
+                   if pid not in self.dense_tombstones]
+            if ids:
+                filenames.append(filename)
+                file_docs.append(np.array(live_docs, dtype=np.int64))
+                file_passages.append(np.array(ids, dtype=np.int64))
+                counts.append(len(ids))
+                passage_ids.extend(ids)
+        if passage_ids:
+            groups = np.split(self._passage_vectors(passage_ids), np.cumsum(counts)[:-1])
+            vectors = np.stack([HierarchicalEmbeddingModel.pool_document(group) for group in groups])
+        else:
+            vectors = np.zeros((0, self.index.d if self.index is not None else 0), dtype=np.float32)
+        self._document_level = (self.version, filenames, vectors, file_docs, file_passages)
+        return filenames, vectors, file_docs, file_passages
+
+    def _allowed_files(self, filenames, allowed_docs):
+        """Boolean mask over filenames: files with at least one allowed section"""
+        if allowed_docs is None:
+            return np.ones(len(filenames), dtype=bool)
+        allowed = set(allowed_docs.tolist())
+        return np.array([any(doc_id in allowed for doc_id in self.file_doc_ids.get(name, [])) for name in filenames],
+                        dtype=bool)
+
+    def _coarse_candidates(self, query_vectors, allowed_docs=None, allowed_mask=None):
+        """Coarse stage of coarse-to-fine search: per query, (section ids, passage ids) of its top ``coarse_documents`` files.
+
+        None when the stage is off or the archive has no more than ``coarse_min_files`` files
+        (or ``coarse_documents``). ``allowed_mask`` is the doc mask of ``allowed_docs``.
+        """
+        top_m = int(self.kb_config.get("coarse_documents", 200))
+        if top_m <= 0 or len(self.file_doc_ids) <= max(top_m, int(self.kb_config.get("coarse_min_files", 2000))):
+            return None
+        filenames, vectors, file_docs, file_passages = self._document_level_index()
+        if len(filenames) <= top_m:
+            return None
+        scores = self._normalized(query_vectors) @ vectors.T
+        scores[:, ~self._allowed_files(filenames, allowed_docs)] = -np.inf
+        candidates = []
+        for top in np.argpartition(-scores, top_m - 1, axis=1)[:, :top_m]:
+            doc_ids = np.sort(np.concatenate([file_docs[i] for i in top]))
+            passage_ids = np.concatenate([file_passages[i] for i in top])
+            if allowed_docs is not None:
+                doc_ids = np.intersect1d(doc_ids, allowed_docs)
+                passage_ids = passage_ids[allowed_mask[self._passage_doc_ids()[passage_ids]]]
+            candidates.append((doc_ids, passage_ids))
+        return candidates
+
+    def _coarse_search(self, cleaned_query, query_vector, k, candidates, corpus=None):
+        """Fine stage for one query: exact dense scores over just the candidate files' passages, and BM25 within their sections"""
+        doc_ids, passage_ids = candidates
+        if len(passage_ids):
+            fetch = k * max(1, int(self.kb_config.get("passage_fetch_factor", 4)))
+            dense_hits = self._best_passage_per_section(
+                self._exact_passage_search(self._normalized(query_vector), fetch, passage_ids)[0], k)
+        else:
+            dense_hits = []
+        return dense_hits, self.sparse_index.search(cleaned_query, k, self._doc_mask(doc_ids), corpus)
+
+    def closest_proposals(self, query, k=5, **filters):
+        """Past response files closest to a query text, or to a new document given as a list of its sections.
+
+        A list is pooled like the document level itself (see ``HierarchicalEmbeddingModel.pool_document``).
+        """
+        filenames, vectors = self._document_vectors()
+        if not filenames:
+            return []
+        if isinstance(query, str):
+            query_vector = self._encode_queries([remove_problematic_chars(query)])
+        else:
+            query_vector = self.model.encode(list(query), level='document')[np.newaxis, :]
+        scores = (self._normalized(query_vector) @ vectors.T)[0]
+        allowed_docs, _, _ = self._filter_masks(filters)
+        scores[~self._allowed_files(filenames, allowed_docs)] = -np.inf
+        ranked = [i for i in np.argsort(-scores)[:k] if np.isfinite(scores[i])]
+        return [{"filename": filenames[i], "client": self.client_for_file(filenames[i]), "score": float(scores[i]),
+                 "sections": len(self.file_doc_ids[filenames[i]])} for i in ranked]
+
+    @staticmethod
+    def _filter_key(filters):
+        return tuple(sorted((field, repr(value)) for field, value in filters.items() if value is not None))
+
+    def facet_values(self, field):
+        """Distinct values (with section counts) available for a search filter"""
+        return self.facet_index.values(field)
+
+    def hybrid_search(self, query, k=5, **filters):
+        """Hybrid search fusing dense passage retrieval and BM25 with reciprocal-rank fusion.
+
+        Results are ordered by the fused rank; ``score`` is the cosine similarity of the
+        section's best passage so it keeps a stable, absolute meaning for callers.
+        Keyword filters (``industry``, ``success``, ``size``, ``client``, ``project``)
+        restrict the candidates before scoring.
+        """
+        if self.index is None or self.sparse_index is None or not self.documents:
             return []
         # Clean the query before encoding and vectorizing
         cleaned_query = remove_problematic_chars(query)
-        query_embedding = self.model.encode([cleaned_query])
-        dense_scores, dense_indices = self.index.search(np.array(query_embedding).astype('float32'), k)
-        query_tfidf = self.tfidf_vectorizer.transform([cleaned_query])
-        sparse_scores = cosine_similarity(query_tfidf, self.tfidf_matrix).flatten()
-        sparse_indices = np.argsort(-sparse_scores)[:k]
-        combined = []
-        seen = set()
-        for idx in dense_indices[0]:
-            if idx not in seen:
-                combined.append((dense_scores[0][list(dense_indices[0]).index(idx)], idx))
-                seen.add(idx)
-        for idx in sparse_indices:
-            if idx not in seen:
-                combined.append((sparse_scores[idx], idx))
-                seen.add(idx)
-        combined.sort(key=lambda x: x[0], reverse=True)
-        # Ensure document content in results is cleaned
-        results = [{"score": float(score), "document": {
-            "id": self.documents[idx]["id"],
-            "filename": self.documents[idx]["filename"], # Already cleaned
-            "section_name": self.documents[idx]["section_name"], # Already cleaned
-            "content": remove_problematic_chars(self.documents[idx]["content"]), # Ensure content is cleaned
-            "metadata": self.documents[idx]["metadata"] # Metadata should also be cleaned on load
-        }} for score, idx in combined[:k]]
-        return results
+        cache_key = (cleaned_query, k, self.version, self._filter_key(filters))
+        cached = self.result_cache.get(cache_key)
+        if cached is not None:
+            return self._copy_results(cached)
+        allowed_docs, allowed_mask, allowed_passages = self._filter_masks(filters)
+        if allowed_docs is not None and len(allowed_docs) == 0:
+            return []
+        filter_docs = allowed_docs
+        query_embedding = self._encode_queries([cleaned_query])
+        coarse = self._coarse_candidates(query_embedding, allowed_docs, allowed_mask)
+        if coarse is not None:
+            # Only the sections of the query's closest response files are scored
+            dense_hits, sparse_hits = self._coarse_search(cleaned_query, query_embedding, k, coarse[0])
+        else:
+            dense_hits = self._dense_search(query_embedding, k, allowed_docs, allowed_passages)[0]
+            sparse_hits = self.sparse_index.search(cleaned_query, k, allowed_mask)
+        results = self._fuse_results(query_embedding, dense_hits, sparse_hits, k, filter_docs)
+        self.result_cache.put(cache_key, results)
+        return self._copy_results(results)
+
+    def search_batch(self, queries, k=5, **filters):
+        """hybrid_search for many queries: one encoder pass, one FAISS search and one sparse product"""
+        if not queries:
+            return []
+        if self.index is None or self.sparse_index is None or not self.documents:
+            return [[] for _ in queries]
+        cleaned_queries = [remove_problematic_chars(query) for query in queries]
+        version, filter_key = self.version, self._filter_key(filters)
+        results = [self.result_cache.get((query, k, version, filter_key)) for query in cleaned_queries]
+        # Only the queries missing from the result cache go through retrieval
+        pending = list(dict.fromkeys(query for query, result in zip(cleaned_queries, results) if result is None))
+        if pending:
+            retrieved = self._retrieve(pending, k, filters)
+            if retrieved is None:
+                return [[] for _ in queries]
+            query_embeddings, dense_hits, sparse_hits, filter_docs = retrieved
+            fresh = {}
+            for i, query in enumerate(pending):
+                fresh[query] = self._fuse_results(query_embeddings[i:i + 1], dense_hits[i], sparse_hits[i], k, filter_docs)
+                self.result_cache.put((query, k, version, filter_key), fresh[query])
+            results = [fresh[query] if result is None else result for query, result in zip(cleaned_queries, results)]
+        return [self._copy_results(result) for result in results]
+
+    def _retrieve(self, cleaned_queries, k, filters, corpus=None):
+        """(query embeddings, dense top-k, BM25 top-k, filtered doc ids) for each query; None when the filters match nothing"""
+        allowed_docs, allowed_mask, allowed_passages = self._filter_masks(filters)
+        if allowed_docs is not None and len(allowed_docs) == 0:
+            return None
+        query_embeddings = self._encode_queries(cleaned_queries)
+        coarse = self._coarse_candidates(query_embeddings, allowed_docs, allowed_mask)
+        if coarse is None:
+            dense_hits = self._dense_search(query_embeddings, k, allowed_docs, allowed_passages)
+            sparse_hits = self.sparse_index.search_batch(cleaned_queries, k, allowed_mask, corpus)
+        else:
+            # Each query scores only the sections of its own closest response files
+            dense_hits, sparse_hits = [], []
+            for i, (query, candidates) in enumerate(zip(cleaned_queries, coarse)):
+                dense, sparse = self._coarse_search(query, query_embeddings[i:i + 1], k, candidates, corpus)
+                dense_hits.append(dense)
+                sparse_hits.append(sparse)
+        return query_embeddings, dense_hits, sparse_hits, allowed_docs
+
+    def sparse_statistics(self, queries):
+        """BM25 corpus statistics for the terms of ``queries`` (summed across shards, see ShardedKnowledgeBase)"""
+        terms = sorted({term for query in queries for term in BM25Index.tokenize(remove_problematic_chars(query))})
+        if self.sparse_index is None:
+            return {"n_docs": 0, "total_length": 0.0, "average_idf": 0.0, "df": dict.fromkeys(terms, 0), "version": self.version}
+        return dict(self.sparse_index.statistics(terms), version=self.version)
+
+    def document_frequencies(self):
+        """Document frequency of every BM25 term (for the global average idf across shards)"""
+        return self.sparse_index.document_frequencies() if self.sparse_index is not None else {}
+
+    def shard_candidates(self, queries, k=5, corpus=None, **filters):
+        """Unfused dense and BM25 top-k of each query, for a coordinator to merge across shards.
+
+        BM25 is scored with the global ``corpus`` statistics. Each candidate is a result dict
+        with ``dense_score`` (its dense hit score, None outside the dense top-k) and
+        ``sparse_score`` (None outside the BM25 top-k).
+        """
+        if not queries:
+            return []
+        if self.index is None or self.sparse_index is None or not self.documents:
+            return [[] for _ in queries]
+        cleaned_queries = [remove_problematic_chars(query) for query in queries]
+        retrieved = self._retrieve(cleaned_queries, k, filters, corpus)
+        if retrieved is None:
+            return [[] for _ in queries]
+        query_embeddings, dense_hits, sparse_hits, filter_docs = retrieved
+        candidates = []
+        for i in range(len(cleaned_queries)):
+            dense_scores = {doc_id: score for score, doc_id, _ in dense_hits[i]}
+            sparse_scores = {doc_id: score for score, doc_id in sparse_hits[i]}
+            doc_ids = list(dict.fromkeys(list(dense_scores) + list(sparse_scores)))
+            similarities = self._section_similarities(query_embeddings[i:i + 1], doc_ids, dense_hits[i])
+            members = {idx: self._filtered_member(idx, filter_docs) for idx in doc_ids}
+            candidates.append([
+                {"score": similarities[idx][0], "dense_score": dense_scores.get(idx), "sparse_score": sparse_scores.get(idx),
+                 "document": self.documents[members[idx]], "sources": self.section_sources(members[idx]),
+                 "passage": self.get_passage(similarities[idx][1]) if similarities[idx][1] is not None else None}
+                for idx in doc_ids
+            ])
+        return candidates
+
+    def _fuse_results(self, query_embedding, dense_hits, sparse_hits, k, filter_docs=None):
+        """Reciprocal-rank fusion of dense and sparse rankings into result dicts.
+
+        With ``filter_docs`` (the sorted ids passing the search filters) each hit is reported
+        as the member of its duplicate group that passed them.
+        """
+        rrf_k = self.kb_config.get("rrf_k", 60)
+        fused = {}
+        for ranking in ([doc_id for _, doc_id, _ in dense_hits], [doc_id for _, doc_id in sparse_hits]):
+            for rank, doc_id in enumerate(ranking):
+                fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+        ranked = sorted(fused, key=fused.get, reverse=True)[:k]
+        similarities = self._section_similarities(query_embedding, ranked, dense_hits)
+        # Documents are views over the store; their text was cleaned at ingestion
+        sparse_scores = dict((doc_id, score) for score, doc_id in sparse_hits)
+        members = {idx: self._filtered_member(idx, filter_docs) for idx in ranked}
+        return [{"score": similarities[idx][0], "fused_score": fused[idx], "sparse_score": sparse_scores.get(idx, 0.0),
+                 "document": self.documents[members[idx]], "sources": self.section_sources(members[idx]),
+                 "passage": self.get_passage(similarities[idx][1]) if similarities[idx][1] is not None else None}
+                for idx in ranked]
 
     def get_common_section_names(self, top_n=15):
         return []
 
-    def multi_hop_search(self, initial_query, k=5):
-        # Clean the initial query
-        cleaned_initial_query = remove_problematic_chars(initial_query)
-        first = self.hybrid_search(cleaned_initial_query, k=3*k)
-        # Ensure content used for refined query is cleaned
-        refined_query = cleaned_initial_query + " " + " ".join([remove_problematic_chars(r["document"]["content"])[ :200] for r in first[:3]])
-        second = self.hybrid_search(refined_query, k=k)
-        all_r = {r["document"]["id"]: r for r in first+second}
-        topk = sorted(all_r.values(), key=lambda x: x["score"], reverse=True)[:k]
-        return topk
-
     def get_section_documents(self, section_name):
         # Ensure section name is cleaned for lookup
         cleaned_section_name = remove_problematic_chars(section_name)
-        # Ensure returned document content is cleaned
-        return [{
-            "id": self.documents[idx]["id"],
-            "filename": self.documents[idx]["filename"],
-            "section_name": self.documents[idx]["section_name"],
-            "content": remove_problematic_chars(self.documents[idx]["content"]),
-            "metadata": self.documents[idx]["metadata"]
-        } for idx in self.section_map.get(cleaned_section_name, [])]
+        # Read-only views; content was cleaned at ingestion. Copies of a section listed here are skipped
+        doc_ids = self.section_map.get(cleaned_section_name, [])
+        listed = set(doc_ids)
+        return [self.documents[idx] for idx in doc_ids if self.duplicate_of.get(idx) not in listed]
 
     def get_all_section_names(self):
-        # Return cleaned section names
-        return [remove_problematic_chars(name) for name in self.section_map.keys()]
-
-    def extract_pricing_from_kb(self) -> List[int]:
-        prices = []
-        pattern = re.compile(r'(?:₹|Rs\.?)[\s]*([0-9,]+)')
-        md_paths = glob.glob(os.path.join(self.kb_directory, '*.md'))
-        for path in md_paths:
-            # Added errors='replace' here too for reading
-            text = open(path, 'r', encoding='utf-8', errors='replace').read()
-            text = remove_problematic_chars(text) # Clean text after reading
-            # Ensure regex matching is done on cleaned text
-            parts = re.split(r'^#{1,3}\s*COMMERCIAL PROPOSAL\s*$', text, flags=re.IGNORECASE | re.MULTILINE)
-            if len(parts) < 2:
-                continue
-            body = re.split(r'^#{1,3}\s+\w', parts[1], flags=re.MULTILINE)[0]
-            for m in pattern.finditer(body):
-                val = int(m.group(1).replace(',', ''))
-                prices.append(val)
-        return prices
+        # Section names were cleaned at ingestion
+        return list(self.section_map.keys())
+
+    def extract_pricing_from_kb(self, currency=None, industry=None, client=None) -> List[float]:
+        """Amounts quoted in past commercial sections, read from the in-memory pricing index"""
+        return self.pricing_index.select(currency=currency, industry=industry, client=client)["amount"].tolist()
+
+    def pricing_summary(self, industry=None, client=None):
+        """Per-currency price statistics over past commercial sections"""
+        return self.pricing_index.summary(industry=industry, client=client)
+
+    def pricing_entries(self, currency=None, industry=None, client=None):
+        """[amount, currency, filename] rows of past commercial sections (for merging across shards)"""
+        entries = self.pricing_index.select(currency=currency, industry=industry, client=client)
+        files = self.pricing_index.files
+        return [[float(e["amount"]), str(e["currency"]), files[e["file"]]] for e in entries]
+
+    def health(self):
+        return {"version": self.version, "documents": len(self._live_ids()), "index_tier": self.index_tier}
+
+class KnowledgeBaseWatcher:
+    """Watches a KB directory with watchdog and reports changed response files in debounced batches.
+
+    Editors and copy tools emit bursts of events per file; changes are collected until the
+    directory has been quiet for ``debounce_seconds`` and then handed to ``on_change`` as one
+    list of paths, from a single background thread.
+    """
+    IGNORED_EVENTS = ("opened", "closed_no_write")
+
+    def __init__(self, directory, on_change, debounce_seconds=2.0):
+        self.directory = os.path.abspath(directory)
+        self.on_change = on_change
+        self.debounce_seconds = debounce_seconds
+        self._lock = threading.Lock()
+        self._paths = set()
+        self._last_event = 0.0
+        self._pending = threading.Event()
+        self._stopped = threading.Event()
+        self._observer = None
+        self._thread = None
+
+    def start(self):
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+
+        watcher = self
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                watcher._record(event)
+
+        self._observer = Observer()
+        self._observer.schedule(Handler(), self.directory, recursive=False)
+        self._observer.daemon = True
+        self._observer.start()
+        self._thread = threading.Thread(target=self._run, name="kb-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def _record(self, event):
+        if event.is_directory or event.event_type in self.IGNORED_EVENTS:
+            return
+        paths = [event.src_path, getattr(event, "dest_path", "")]
+        paths = [os.fsdecode(path) for path in paths if path and os.fsdecode(path).endswith(('.md', '.txt'))]
+        if not paths:
+            return
+        with self._lock:
+            self._paths.update(paths)
+            self._last_event = time.monotonic()
+        self._pending.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._pending.wait()
+            # Debounce: wait until no new event arrived for debounce_seconds
+            while not self._stopped.is_set():
+                with self._lock:
+                    remaining = self._last_event + self.debounce_seconds - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._stopped.wait(remaining)
+            with self._lock:
+                paths, self._paths = sorted(self._paths), set()
+                self._pending.clear()
+            if paths and not self._stopped.is_set():
+                try:
+                    self.on_change(paths)
+                except Exception as e:
+                    print(f"Warning: Knowledge base hot reload failed ({e}). Keeping the current index.")
+
+    def stop(self, join=True):
+        self._stopped.set()
+        self._pending.set()
+        if self._observer is not None:
+            self._observer.stop()
+            if join:
+                self._observer.join()
+        if join and self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+class KnowledgeBaseService:
+    """Process-wide registry of knowledge bases shared by every session.
+
+    Sessions hold a ``KnowledgeBaseHandle`` instead of their own ``ProposalKnowledgeBase``;
+    one instance (and one embedding model) is kept per configuration and reference-counted
+    through the handles, so it is dropped once the last session referencing it is gone.
+    Reloads fork the live instance, apply the changes to the fork and swap it in with a
+    single reference assignment, so searches in other sessions never see a half-updated
+    index and the read path takes no lock. With ``watch_directory`` enabled a
+    ``KnowledgeBaseWatcher`` drives the reloads with just the files that changed.
+    """
+    def __init__(self, reload_check_interval=30.0):
+        self.reload_check_interval = reload_check_interval
+        self._lock = threading.RLock()
+        self._models_lock = threading.Lock()
+        self._entries = {}
+        self._models = {}
+
+    @staticmethod
+    def _key(kb_directory, model_name, kb_config):
+        return (os.path.abspath(kb_directory), model_name, json.dumps(kb_config or {}, sort_keys=True, default=str))
+
+    @staticmethod
+    def _model_key(model_name, kb_config):
+        kb_config = kb_config or {}
+        return (model_name, kb_config.get("embedding_backend", "torch"), kb_config.get("embedding_onnx_file", ""))
+
+    def _model(self, model_name, kb_config=None):
+        model_key = self._model_key(model_name, kb_config)
+        with self._models_lock:
+            if model_key not in self._models:
+                self._models[model_key] = HierarchicalEmbeddingModel.from_config(model_name, kb_config)
+            return self._models[model_key]
+
+    def acquire(self, kb_directory, model_name, kb_config=None, wait=True):
+        """Reference to the shared knowledge base for this configuration, loading it on first use.
+
+        With wait=False the load (importing torch, warming the model, opening the index) runs
+        in a background thread and the handle blocks only when it is first used.
+        """
+        key = self._key(kb_directory, model_name, kb_config)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["error"] is not None:
+                # Registering under the lock keeps concurrent first sessions from building it twice;
+                # a failed load is retried, keeping the references of existing handles
+                entry = {"kb": None, "ready": threading.Event(), "error": None, "refs": entry["refs"] if entry else 0,
+                         "args": (kb_directory, model_name, kb_config), "checked_at": time.monotonic(),
+                         "reload_lock": threading.Lock(), "watcher": None}
+                self._entries[key] = entry
+                threading.Thread(target=self._load, args=(key, entry), name="kb-load", daemon=True).start()
+            entry["refs"] += 1
+        handle = KnowledgeBaseHandle(self, key)
+        weakref.finalize(handle, self._release, key)
+        if wait:
+            self.get(key)
+        return handle
+
+    def _load(self, key, entry):
+        kb_directory, model_name, kb_config = entry["args"]
+        try:
+            entry["kb"] = ProposalKnowledgeBase(kb_directory, self._model(model_name, kb_config), kb_config)
+            if (kb_config or {}).get("watch_directory"):
+                entry["watcher"] = self._start_watcher(key, kb_directory, kb_config)
+        except Exception as e:
+            entry["error"] = e
+        finally:
+            entry["ready"].set()
+
+    def _release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry["refs"] -= 1
+            if entry["refs"] > 0:
+                return
+            del self._entries[key]
+            if entry["watcher"] is not None:
+                # May run from a finalizer on any thread, so don't wait for an in-progress reload
+                entry["watcher"].stop(join=False)
+            model_key = self._model_key(*entry["args"][1:])
+            if not any(self._model_key(*other["args"][1:]) == model_key for other in self._entries.values()):
+                self._models.pop(model_key, None)
+
+    def _start_watcher(self, key, kb_directory, kb_config):
+        try:
+            return KnowledgeBaseWatcher(
+                kb_directory, lambda paths: self.apply_changes(key, paths),
+                debounce_seconds=kb_config.get("watch_debounce_seconds", 2.0)
+            ).start()
+        except ImportError:
+            print("Warning: watchdog is not installed; knowledge base changes are picked up by polling instead.")
+        except OSError as e:
+            print(f"Warning: Could not watch {kb_directory} ({e}); falling back to polling.")
+        return None
+
+    def get(self, key):
+        # Lock-free: a search resolves the instance once and keeps it even if a reload swaps it out
+        entry = self._entries[key]
+        kb = entry["kb"]
+        if kb is None:
+            entry["ready"].wait()
+            if entry["error"] is not None:
+                raise entry["error"]
+            kb = entry["kb"]
+        return kb
+
+    def is_ready(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and entry["ready"].is_set() and entry["error"] is None
+
+    def _swap(self, entry, update):
+        """Apply update(fork) to a fork of the live instance and publish it if it reports a change"""
+        # Only one reload per knowledge base at a time; readers keep using the current instance
+        with entry["reload_lock"]:
+            entry["checked_at"] = time.monotonic()
+            live = entry["kb"]
+            fork = live.fork()
+            # Without snapshots the fork is rebuilt from the directory and may already hold the change
+            if not update(fork) and fork.file_fingerprints == live.file_fingerprints:
+                return False
+            fork._save_snapshot_safely()
+            entry["kb"] = fork
+            return True
+
+    def apply_changes(self, key, file_paths):
+        """Re-ingest only the given files into a fork of the live instance and swap it in"""
+        entry = self._entries.get(key)
+        if entry is None or not self.is_ready(key):
+            return False
+        return self._swap(entry, lambda kb: kb.apply_file_changes(file_paths))
+
+    def reload(self, key, force=False):
+        """Swap in a synced instance if the KB directory changed (or a full rebuild with force)"""
+        self.get(key)
+        entry = self._entries[key]
+        if force:
+            with entry["reload_lock"]:
+                entry["checked_at"] = time.monotonic()
+                kb_directory, model_name, kb_config = entry["args"]
+                entry["kb"] = ProposalKnowledgeBase(kb_directory, self._model(model_name, kb_config), kb_config,
+                                                    rebuild=True)
+                return True
+        if not entry["kb"].has_directory_changes():
+            entry["checked_at"] = time.monotonic()
+            return False
+        return self._swap(entry, lambda kb: kb.sync_with_directory())
+
+    def refresh_if_stale(self, key):
+        """Reload when the directory changed, checking at most once per reload_check_interval"""
+        entry = self._entries[key]
+        if entry["watcher"] is not None or not self.is_ready(key):
+            return False
+        if time.monotonic() - entry["checked_at"] < self.reload_check_interval:
+            return False
+        return self.reload(key)
+
+    def stats(self):
+        with self._lock:
+            return {key[0]: {"model": key[1], "sessions": entry["refs"], "ready": entry["ready"].is_set()}
+                    for key, entry in self._entries.items()}
+
+class KnowledgeBaseHandle:
+    """A session's reference to a shared knowledge base.
+
+    Attribute access is forwarded to the service's current instance, so the handle can
+    be used wherever a ``ProposalKnowledgeBase`` is expected and picks up reloads.
+    """
+    def __init__(self, service, key):
+        self._service = service
+        self._key = key
+
+    @property
+    def kb(self):
+        return self._service.get(self._key)
+
+    def __getattr__(self, name):
+        return getattr(self._service.get(self._key), name)
+
+    def reload(self, force=True):
+        return self._service.reload(self._key, force=force)
+
+    def apply_file_changes(self, file_paths):
+        # Through the service, so the change is applied to a fork and swapped in
+        return self._service.apply_changes(self._key, file_paths)
+
+    def refresh_if_stale(self):
+        return self._service.refresh_if_stale(self._key)
+
+@st.cache_resource
+def get_knowledge_base_service():
+    """The one KnowledgeBaseService of this server process (survives script reruns)"""
+    return KnowledgeBaseService()
+
+def _json_result(result):
+    """Search result with its document view materialized for JSON"""
+    return dict(result, document=dict(result["document"]))
+
+def create_kb_app(kb):
+    """Flask app exposing a knowledge base (or KnowledgeBaseHandle) over HTTP"""
+    from flask import Flask, jsonify, request
+
+    app = Flask("rfp_knowledge_base")
+
+    def body():
+        return request.get_json(force=True, silent=True) or {}
+
+    @app.errorhandler(ValueError)
+    def bad_request(error):
+        return jsonify({"error": str(error)}), 400
+
+    @app.get("/health")
+    def health():
+        return jsonify(dict(kb.health(), status="ok"))
+
+    @app.post("/search")
+    def search():
+        data = body()
+        results = kb.hybrid_search(data["query"], k=int(data.get("k", 5)), **data.get("filters", {}))
+        return jsonify([_json_result(r) for r in results])
+
+    @app.post("/search_batch")
+    def search_batch():
+        data = body()
+        batches = kb.search_batch(data["queries"], k=int(data.get("k", 5)), **data.get("filters", {}))
+        return jsonify([[_json_result(r) for r in results] for results in batches])
+
+    @app.post("/sparse_statistics")
+    def sparse_statistics():
+        return jsonify(kb.sparse_statistics(body()["queries"]))
+
+    @app.get("/document_frequencies")
+    def document_frequencies():
+        return jsonify(kb.document_frequencies())
+
+    @app.post("/shard_candidates")
+    def shard_candidates():
+        data = body()
+        batches = kb.shard_candidates(data["queries"], int(data.get("k", 5)), data.get("corpus"), **data.get("filters", {}))
+        return jsonify([[_json_result(r) for r in results] for results in batches])
+
+    @app.post("/multi_hop_search")
+    def multi_hop_search():
+        data = body()
+        results = kb.multi_hop_search(data["query"], k=int(data.get("k", 5)), **data.get("filters", {}))
+        return jsonify([_json_result(r) for r in results])
+
+    @app.post("/multi_hop_search_batch")
+    def multi_hop_search_batch():
+        data = body()
+        batches = kb.multi_hop_search_batch(data["queries"], k=int(data.get("k", 5)), **data.get("filters", {}))
+        return jsonify([[_json_result(r) for r in results] for results in batches])
+
+    @app.get("/sections")
+    def section_names():
+        return jsonify(kb.get_all_section_names())
+
+    @app.get("/sections/<path:section_name>")
+    def section_documents(section_name):
+        return jsonify([dict(document) for document in kb.get_section_documents(section_name)])
+
+    @app.get("/facets/<field>")
+    def facet_values(field):
+        if field not in FacetIndex.FIELDS:
+            raise ValueError(f"Unknown facet '{field}'")
+        return jsonify(kb.facet_values(field))
+
+    @app.get("/pricing")
+    def pricing():
+        industry, client = request.args.get("industry"), request.args.get("client")
+        currency = request.args.get("currency")
+        return jsonify({
+            "amounts": kb.extract_pricing_from_kb(currency=currency, industry=industry, client=client),
+            "entries": kb.pricing_entries(currency=currency, industry=industry, client=client),
+            "summary": kb.pricing_summary(industry=industry, client=client)
+        })
+
+    @app.post("/closest_proposals")
+    def closest_proposals():
+        payload = body()
+        return jsonify(kb.closest_proposals(payload["query"], int(payload.get("k", 5)), **payload.get("filters", {})))
+
+    @app.get("/stats")
+    def stats():
+        return jsonify({"cache": kb.cache_stats(), "index": getattr(kb, "index_stats", {})})
+
+    @app.post("/files/changes")
+    def file_changes():
+        return jsonify({"changed": bool(kb.apply_file_changes(body()["paths"]))})
+
+    @app.post("/reload")
+    def reload():
+        if not hasattr(kb, "reload"):
+            return jsonify({"reloaded": kb.sync_with_directory()})
+        return jsonify({"reloaded": kb.reload(force=bool(body().get("force", False)))})
+
+    return app
+
+def serve_knowledge_base(argv=None):
+    """`python FINAL.py serve-kb`: run the knowledge base as a local retrieval server"""
+    parser = argparse.ArgumentParser(prog="FINAL.py serve-kb", description="Serve the proposal knowledge base over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", help="Listen on this Unix socket path instead of host/port")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--shard", help="Serve only shard I of N (format I/N), for a sharded deployment")
+    group.add_argument("--shards", type=int, default=1, help="Partition the KB across N worker processes")
+    parser.add_argument("--watch", action="store_true", help="Hot-reload when files in the KB directory change")
+    args = parser.parse_args(argv)
+
+    kb_config = dict(load_config()["knowledge_base"])
+    if args.watch:
+        kb_config["watch_directory"] = True
+    if args.shard:
+        index, count = (int(part) for part in args.shard.split("/"))
+        kb_config["shard"] = [index, count]
+    if args.shards > 1:
+        kb = ShardedKnowledgeBase.with_process_shards(
+            kb_config["directory"], kb_config["embedding_model"], kb_config, args.shards
+        )
+    else:
+        service = KnowledgeBaseService()
+        kb = service.acquire(kb_config["directory"], kb_config["embedding_model"], kb_config)
+    app = create_kb_app(kb)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket) # Stale socket from a previous run
+        print(f"Knowledge base server listening on unix://{args.socket}")
+        app.run(host=f"unix://{args.socket}", threaded=True)
+    else:
+        print(f"Knowledge base server listening on http://{args.host}:{args.port}")
+        app.run(host=args.host, port=args.port, threaded=True)
+
+def _to_plain(value):
+    """Replace document views with plain dicts so results can cross process boundaries"""
+    if isinstance(value, DocumentView):
+        return dict(value)
+    if isinstance(value, dict):
+        return {key: _to_plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_plain(item) for item in value]
+    return value
+
+_SHARD_KB = None
+
+def _shard_worker_init(kb_directory, model_name, kb_config, threads):
+    """Load one shard inside its worker process, limited to its share of the CPU cores"""
+    global _SHARD_KB
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    faiss.omp_set_num_threads(threads)
+    _SHARD_KB = ProposalKnowledgeBase(kb_directory, model_name, kb_config)
+
+def _shard_worker_call(method, args, kwargs):
+    return _to_plain(getattr(_SHARD_KB, method)(*args, **kwargs))
+
+class ProcessShard:
+    """One knowledge-base shard living in its own single-worker process"""
+    def __init__(self, kb_directory, model_name, kb_config, threads=1):
+        # spawn rather than fork: forking a process that already runs torch/FAISS threads can deadlock
+        self._executor = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+            initializer=_shard_worker_init, initargs=(kb_directory, model_name, kb_config, threads)
+        )
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        def call(*args, **kwargs):
+            return self._executor.submit(_shard_worker_call, method, args, kwargs).result()
+        return call
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+class ShardedKnowledgeBase(MultiHopSearchMixin):
+    """Knowledge base partitioned by file across shards, searched with scatter-gather.
+
+    Every shard is a full ``ProposalKnowledgeBase`` over the files that ``shard_for_file``
+    assigns to it, hosted either in a worker process (``ProcessShard``) or behind a
+    ``serve-kb --shard I/N`` server (``RemoteKnowledgeBase``). A search first sums the
+    shards' BM25 statistics for the query terms (N, total length, document frequencies),
+    then every shard returns its unfused dense and BM25 top-k, the BM25 part scored with
+    those global statistics. The coordinator merges them into the global dense top-k (cosine
+    similarity, comparable because all shards share the model) and BM25 top-k and fuses the
+    two with reciprocal-rank fusion, so results match a single index over the same files.
+
+    The average idf behind the epsilon floor (for terms in more than half of all sections)
+    needs every term's frequency, so it is gathered once per change of the shard versions.
+    Approximations: near-duplicates are only collapsed within a shard, and with
+    ``coarse_documents`` each shard picks its own closest files.
+    Document ids are rewritten to ``local_id * shard_count + shard`` so they stay unique.
+    """
+    def __init__(self, shards, kb_config=None):
+        self.shards = list(shards)
+        self.kb_config = kb_config or {}
+        self._pool = ThreadPoolExecutor(max_workers=len(self.shards))
+        self._average_idf = None # (shard versions, global average idf)
+
+    @classmethod
+    def with_process_shards(cls, kb_directory, model_name, kb_config, shard_count):
+        kb_config = kb_config or {}
+        threads = max(1, (os.cpu_count() or 1) // shard_count)
+        shards = [
+            ProcessShard(kb_directory, model_name, dict(kb_config, shard=[index, shard_count]), threads)
+            for index in range(shard_count)
+        ]
+        sharded = cls(shards, kb_config)
+        sharded.health() # Waits until every shard has loaded (in parallel)
+        return sharded
+
+    @classmethod
+    def with_remote_shards(cls, urls, kb_config=None):
+        return cls([RemoteKnowledgeBase(url) for url in urls], kb_config)
+
+    def _scatter(self, method, *args, **kwargs):
+        futures = [self._pool.submit(getattr(shard, method), *args, **kwargs) for shard in self.shards]
+        return [future.result() for future in futures]
+
+    def _globalize(self, result, shard_index):
+        result = dict(result)
+        document = dict(result["document"])
+        document["id"] = document["id"] * len(self.shards) + shard_index
+        result["document"] = document
+        if result.get("passage"):
+            result["passage"] = dict(result["passage"], document_id=document["id"])
+        return result
+
+    def _corpus_statistics(self, queries):
+        """Global BM25 statistics for the query terms: the shards' counts summed"""
+        per_shard = self._scatter("sparse_statistics", list(queries))
+        n_docs = sum(stats["n_docs"] for stats in per_shard)
+        versions = tuple(stats["version"] for stats in per_shard)
+        if self._average_idf is None or self._average_idf[0] != versions:
+            self._average_idf = (versions, self._global_average_idf(n_docs))
+        df = Counter()
+        for stats in per_shard:
+            df.update(stats["df"])
+        return {
+            "n_docs": n_docs,
+            "total_length": sum(stats["total_length"] for stats in per_shard),
+            "average_idf": self._average_idf[1],
+            "df": dict(df),
+            "version": sum(versions)
+        }
+
+    def _global_average_idf(self, n_docs):
+        """Mean idf over the union of the shard vocabularies, computed as BM25Index.average_idf does"""
+        df = self.document_frequencies()
+        if not df:
+            return 0.0
+        frequencies = np.fromiter(df.values(), dtype=np.float64, count=len(df))
+        return float(np.mean(np.log(n_docs - frequencies + 0.5) - np.log(frequencies + 0.5)))
+
+    def document_frequencies(self):
+        df = Counter()
+        for frequencies in self._scatter("document_frequencies"):
+            df.update(frequencies)
+        return dict(df)
+
+    def _merge(self, per_shard, k):
+        """Merge per-shard candidates into the global dense and BM25 top-k, then fuse them as one index does"""
+        candidates = [self._globalize(r, shard) for shard, results in enumerate(per_shard) for r in results]
+        dense = heapq.nlargest(k, (r for r in candidates if r["dense_score"] is not None), key=lambda r: r["dense_score"])
+        sparse = heapq.nlargest(k, (r for r in candidates if r["sparse_score"] is not None), key=lambda r: r["sparse_score"])
+        rrf_k = self.kb_config.get("rrf_k", 60)
+        fused, by_id = {}, {}
+        for ranking in (dense, sparse):
+            for rank, result in enumerate(ranking):
+                doc_id = result["document"]["id"]
+                by_id[doc_id] = result
+                fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+        ranked = heapq.nlargest(k, fused, key=fused.get)
+        # As in one index, sparse_score is only reported for the global BM25 top-k
+        sparse_scores = {result["document"]["id"]: result["sparse_score"] for result in sparse}
+        results = []
+        for doc_id in ranked:
+            result = dict(by_id[doc_id], fused_score=fused[doc_id], sparse_score=sparse_scores.get(doc_id, 0.0))
+            del result["dense_score"]
+            results.append(result)
+        return results
+
+    def hybrid_search(self, query, k=5, **filters):
+        return self.search_batch([query], k, **filters)[0]
+
+    def search_batch(self, queries, k=5, **filters):
+        if not queries:
+            return []
+        corpus = self._corpus_statistics(queries)
+        per_shard = self._scatter("shard_candidates", list(queries), k, corpus, **filters)
+        return [self._merge([shard_results[i] for shard_results in per_shard], k) for i in range(len(queries))]
+
+    def sparse_statistics(self, queries):
+        return self._corpus_statistics(queries)
+
+    def closest_proposals(self, query, k=5, **filters):
+        """Files live in exactly one shard, and file scores are comparable across shards"""
+        query = query if isinstance(query, str) else list(query)
+        per_shard = self._scatter("closest_proposals", query, k, **filters)
+        return heapq.nlargest(k, (proposal for proposals in per_shard for proposal in proposals), key=lambda p: p["score"])
+
+    def get_section_documents(self, section_name):
+        documents = []
+        for shard, shard_documents in enumerate(self._scatter("get_section_documents", section_name)):
+            for document in shard_documents:
+                documents.append(dict(document, id=document["id"] * len(self.shards) + shard))
+        return documents
+
+    def get_all_section_names(self):
+        return list(dict.fromkeys(name for names in self._scatter("get_all_section_names") for name in names))
+
+    def facet_values(self, field):
+        counts = Counter()
+        for values in self._scatter("facet_values", field):
+            counts.update(values)
+        return dict(sorted(counts.items()))
+
+    def pricing_entries(self, currency=None, industry=None, client=None):
+        return [row for rows in self._scatter("pricing_entries", currency, industry, client) for row in rows]
+
+    def extract_pricing_from_kb(self, currency=None, industry=None, client=None):
+        return [row[0] for row in self.pricing_entries(currency, industry, client)]
+
+    def pricing_summary(self, industry=None, client=None):
+        rows = self.pricing_entries(industry=industry, client=client)
+        files = {}
+        entries = np.array(
+            [(amount, currency, 0, files.setdefault(filename, len(files)), 0, 0, True) for amount, currency, filename in rows],
+            dtype=PRICE_ENTRY_DTYPE
+        )
+        return PricingIndex.summarize(entries)
+
+    def upsert_file(self, file_path):
+        """Only the shard that owns the file is touched"""
+        return self.shards[shard_for_file(os.path.basename(file_path), len(self.shards))].upsert_file(file_path)
+
+    def remove_file(self, file_path):
+        return self.shards[shard_for_file(os.path.basename(file_path), len(self.shards))].remove_file(file_path)
+
+    def apply_file_changes(self, file_paths):
+        """Each shard applies the changed files it owns; True if anything changed"""
+        owned = [[] for _ in self.shards]
+        for file_path in file_paths:
+            owned[shard_for_file(os.path.basename(file_path), len(self.shards))].append(file_path)
+        futures = [self._pool.submit(shard.apply_file_changes, paths) for shard, paths in zip(self.shards, owned) if paths]
+        return any([future.result() for future in futures])
+
+    def sync_with_directory(self):
+        return any(self._scatter("sync_with_directory"))
+
+    def cache_stats(self):
+        """Same shape as a single knowledge base, counters summed over shards; per-shard stats under shards"""
+        per_shard = self._scatter("cache_stats")
+        totals = {}
+        for cache in ("query_embeddings", "results"):
+            combined = {key: sum(stats.get(cache, {}).get(key, 0) for stats in per_shard)
+                        for key in ("entries", "max_entries", "hits", "misses", "evictions")}
+            lookups = combined["hits"] + combined["misses"]
+            combined["hit_rate"] = (combined["hits"] / lookups) if lookups else 0.0
+            totals[cache] = combined
+        totals["shards"] = per_shard
+        return totals
+
+    def health(self):
+        shards = self._scatter("health")
+        return {"version": sum(shard["version"] for shard in shards),
+                "documents": sum(shard["documents"] for shard in shards),
+                "index_tier": ",".join(sorted({shard["index_tier"] or "empty" for shard in shards})),
+                "shards": len(shards)}
+
+    def close(self):
+        for shard in self.shards:
+            if isinstance(shard, ProcessShard):
+                shard.close()
+        self._pool.shutdown()
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class RemoteKnowledgeBase:
+    """Client for `serve-kb` with the same search/section/pricing methods as ProposalKnowledgeBase.
+
+    ``url`` is ``http://host:port`` or ``unix:///path/to/socket``. Each thread keeps its
+    own keep-alive connection. Result documents come back as plain dicts.
+    """
+    def __init__(self, url, timeout=60.0):
+        self.url = url
+        self.timeout = timeout
+        parsed = urlparse(url)
+        self._socket_path = parsed.path if parsed.scheme == "unix" else None
+        self._host, self._port = parsed.hostname, parsed.port
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self._socket_path:
+                connection = _UnixHTTPConnection(self._socket_path, self.timeout)
+            else:
+                connection = http.client.HTTPConnection(self._host, self._port, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def _request(self, method, path, payload=None):
+        body = json.dumps(payload) if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (ConnectionError, http.client.HTTPException, OSError):
+                # The server closed an idle keep-alive connection; retry once on a new one
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+        result = json.loads(data) if data else None
+        if response.status == 400:
+            raise ValueError(result.get("error") if isinstance(result, dict) else data)
+        if response.status != 200:
+            raise RuntimeError(f"Knowledge base server returned {response.status} for {path}")
+        return result
+
+    def health(self):
+        return self._request("GET", "/health")
+
+    def hybrid_search(self, query, k=5, **filters):
+        return self._request("POST", "/search", {"query": query, "k": k, "filters": filters})
+
+    def search_batch(self, queries, k=5, **filters):
+        return self._request("POST", "/search_batch", {"queries": list(queries), "k": k, "filters": filters})
+
+    def multi_hop_search(self, initial_query, k=5, **filters):
+        return self._request("POST", "/multi_hop_search", {"query": initial_query, "k": k, "filters": filters})
+
+    def sparse_statistics(self, queries):
+        return self._request("POST", "/sparse_statistics", {"queries": list(queries)})
+
+    def document_frequencies(self):
+        return self._request("GET", "/document_frequencies")
+
+    def shard_candidates(self, queries, k=5, corpus=None, **filters):
+        return self._request("POST", "/shard_candidates", {"queries": list(queries), "k": k, "corpus": corpus, "filters": filters})
+
+    def multi_hop_search_batch(self, initial_queries, k=5, **filters):
+        return self._request("POST", "/multi_hop_search_batch", {"queries": list(initial_queries), "k": k, "filters": filters})
+
+    def closest_proposals(self, query, k=5, **filters):
+        query = query if isinstance(query, str) else list(query)
+        return self._request("POST", "/closest_proposals", {"query": query, "k": k, "filters": filters})
+
+    def get_section_documents(self, section_name):
+        return self._request("GET", "/sections/" + quote(section_name, safe=""))
+
+    def get_all_section_names(self):
+        return self._request("GET", "/sections")
+
+    def facet_values(self, field):
+        return self._request("GET", "/facets/" + quote(field, safe=""))
+
+    def _pricing(self, **params):
+        query = urlencode({key: value for key, value in params.items() if value})
+        return self._request("GET", "/pricing" + (f"?{query}" if query else ""))
+
+    def extract_pricing_from_kb(self, currency=None, industry=None, client=None):
+        return self._pricing(currency=currency, industry=industry, client=client)["amounts"]
+
+    def pricing_summary(self, industry=None, client=None):
+        return self._pricing(industry=industry, client=client)["summary"]
+
+    def pricing_entries(self, currency=None, industry=None, client=None):
+        return self._pricing(currency=currency, industry=industry, client=client)["entries"]
+
+    def cache_stats(self):
+        return self._request("GET", "/stats")["cache"]
+
+    def reload(self, force=False):
+        return self._request("POST", "/reload", {"force": force})["reloaded"]
+
+    def sync_with_directory(self):
+        return self.reload(force=False)
+
+    def apply_file_changes(self, file_paths):
+        """Re-ingest the given files on the server (paths as the server sees them); True if anything changed"""
+        return self._request("POST", "/files/changes", {"paths": list(file_paths)})["changed"]
+
+    def upsert_file(self, file_path):
+        # The server applies the change to a fork and swaps it in, so only "changed" comes back
+        return self.apply_file_changes([file_path])
+
+    def remove_file(self, file_path):
+        return self.apply_file_changes([file_path])
 
 class SpecialistRAGDrafter:
     def __init__(self, openai_key=None):
-        self.client = OpenAI(api_key=openai_key or os.environ.get("OPENAI_API_KEY"))
+        self.client = openai.OpenAI(api_key=openai_key or os.environ.get("OPENAI_API_KEY"))
 
     def generate_draft(self, section_name, rfp_section_content, relevant_kb_content, client_name):
         # Ensure all input text is cleaned before sending to LLM
@@ -509,8 +4577,8 @@ class SpecialistRAGDrafter:
 
         kb_blob = "\n\n".join([
             f"--- {('Very Relevant' if item['score']>0.7 else 'Relevant')} PAST PROPOSAL ---\n"
-            f"From: {remove_problematic_chars(item['document']['filename'])} | Section: {remove_problematic_chars(item['document']['section_name'])}\n"
-            f"{remove_problematic_chars(item['document']['content'])}"
+            f"From: {', '.join(item.get('sources') or [item['document']['filename']])} | Section: {item['document']['section_name']}\n"
+            f"{item['document']['content']}" # KB text was cleaned at ingestion
             for item in relevant_kb_content
         ])
 
@@ -587,7 +4655,7 @@ class SpecialistRAGDrafter:
 class EnhancedProposalGenerator:
     def __init__(self, knowledge_base, openai_key=None):
         self.kb = knowledge_base
-        self.client = OpenAI(api_key=openai_key or os.environ.get("OPENAI_API_KEY"))
+        self.client = openai.OpenAI(api_key=openai_key or os.environ.get("OPENAI_API_KEY"))
         self.rfp_text = None  # Store RFP text for regeneration
         self.drafter = SpecialistRAGDrafter(openai_key)  # Specialist drafter
 
@@ -782,6 +4850,23 @@ class EnhancedProposalGenerator:
         except:
             return []
 
+    def pricing_scope(self, client_name, rfp_analysis):
+        """(description, per-currency stats) of the past pricing closest to this RFP.
+
+        The client's own past proposals first, then those of the industry the RFP analysis
+        names (among the KB's industry facets), and the whole archive only as a fallback.
+        """
+        industries = [value for value in self.kb.facet_values("industry") if value != "general"]
+        industry = next((value for value in industries
+                         if re.search(r'\b' + re.escape(value) + r'\b', rfp_analysis, re.IGNORECASE)), None)
+        for description, field, value in ((f"past proposals for {client_name}", "client", client_name),
+                                          (f"past {industry} proposals", "industry", industry)):
+            if value:
+                stats = self.kb.pricing_summary(**{field: value})
+                if stats:
+                    return description, stats
+        return "all past proposals", self.kb.pricing_summary()
+
     def generate_section(self, section_name, rfp_analysis, rfp_section_content,
                          client_background, differentiators,
                          evaluation_criteria, relevant_kb_content, client_name):
@@ -797,15 +4882,12 @@ class EnhancedProposalGenerator:
         cleaned_evaluation_criteria = remove_problematic_chars(evaluation_criteria) if evaluation_criteria else ""
         cleaned_client_name = remove_problematic_chars(client_name) if client_name else ""
 
-        # relevant_kb_content is a list of dicts; ensure content within is cleaned
-        cleaned_relevant_kb_content = []
-        for item in relevant_kb_content:
-            if isinstance(item, dict) and 'document' in item and isinstance(item['document'], dict):
-                 item['document']['filename'] = remove_problematic_chars(item['document'].get('filename', ''))
-                 item['document']['section_name'] = remove_problematic_chars(item['document'].get('section_name', ''))
-                 item['document']['content'] = remove_problematic_chars(item['document'].get('content', ''))
-                 cleaned_relevant_kb_content.append(item)
-            # else: skip malformed items
+        # relevant_kb_content is a list of result dicts whose documents are read-only views
+        # (or plain dicts) with text already cleaned at ingestion; they are not modified here
+        cleaned_relevant_kb_content = [
+            item for item in relevant_kb_content
+            if isinstance(item, dict) and isinstance(item.get('document'), Mapping)
+        ] # Malformed items are skipped
 
 
         is_pricing = any(term in cleaned_section_name.lower() for term in ["commercial", "pricing", "cost", "financial", "budget", "price"])
@@ -813,34 +4895,33 @@ class EnhancedProposalGenerator:
         pricing_block = ""
         if is_pricing:
             # --- ADDED CHECK for KB before accessing pricing ---
-            if not self.kb or not hasattr(self.kb, 'extract_pricing_from_kb'):
+            if not self.kb or not hasattr(self.kb, 'pricing_summary'):
                 st.warning(f"Knowledge Base unavailable for pricing insights in section '{cleaned_section_name}'.")
                 pricing_block = "\n\n## PRICING INSIGHT\nKnowledge Base unavailable."
-                prices = [] # Define prices as empty list
             else:
                 try:
-                    prices = self.kb.extract_pricing_from_kb() # Method returns list of ints
-                    if prices:
-                        avg = sum(prices) / len(prices)
-                        pricing_block = (
-                            f"\n\n## PRICING INSIGHT\n"
-                            f"Based on {len(prices)} past proposals, prices ranged from ₹{min(prices):,} "
-                            f"to ₹{max(prices):,}, with an average of ₹{avg:,.0f}."
-                        )
+                    # Per-currency stats from the pricing index, narrowed to this client or industry when possible
+                    pricing_scope, pricing_stats = self.pricing_scope(cleaned_client_name, cleaned_rfp_analysis)
+                    if pricing_stats:
+                        # One line per currency, most frequently quoted first
+                        lines = [
+                            f"- {currency}: {stats['count']} amounts across {stats['files']} past proposals, "
+                            f"ranging from {currency} {stats['min']:,.0f} to {currency} {stats['max']:,.0f} "
+                            f"(median {currency} {stats['median']:,.0f}, average {currency} {stats['mean']:,.0f})."
+                            for currency, stats in sorted(pricing_stats.items(), key=lambda item: -item[1]["count"])
+                        ]
+                        pricing_block = f"\n\n## PRICING INSIGHT\nBased on {pricing_scope}:\n" + "\n".join(lines)
                     else:
                         pricing_block = "\n\n## PRICING INSIGHT\nNo past pricing data found in KB."
                 except Exception as e:
                     st.error(f"Error extracting pricing from KB: {e}")
                     pricing_block = "\n\n## PRICING INSIGHT\nError extracting pricing data from KB."
-                    prices = [] # Define prices as empty list on error
             # --- END CHECK ---
-        else:
-             prices = [] # Ensure prices is defined if not a pricing section
 
         # Prepare KB items string from the cleaned list
         kb_items = "\n\n".join([
              f"--- {('Very Relevant' if item.get('score', 0)>0.8 else 'Relevant')} PAST PROPOSAL ---\n"
-             f"From: {item['document']['filename']} | Section: {item['document']['section_name']}\n"
+             f"From: {', '.join(item.get('sources') or [item['document']['filename']])} | Section: {item['document']['section_name']}\n"
              f"{item['document']['content']}" # Content is already cleaned
              for item in cleaned_relevant_kb_content if item.get('score', 0) >= 0.5
         ])[:2000] # Limit length
@@ -1223,8 +5304,8 @@ class EnhancedProposalGenerator:
             # extract_required_sections uses cleaned analysis and returns cleaned sections
             required_sections = self.extract_required_sections(rfp_analysis)
             if not required_sections: # Fallback if LLM fails extraction or returns empty
-                rfp_doc_sections = extract_sections_from_rfp(cleaned_rfp_text)
-                required_sections = [remove_problematic_chars(s) for s in rfp_doc_sections.keys()] if rfp_doc_sections else ["Introduction", "Proposed Solution", "Pricing", "Conclusion"]
+                rfp_doc_sections = parse_rfp(cleaned_rfp_text).to_dict()
+                required_sections = list(rfp_doc_sections.keys()) if rfp_doc_sections else ["Introduction", "Proposed Solution", "Pricing", "Conclusion"]
                 st.warning(f"Could not extract specific required sections from RFP Analysis. Using sections: {', '.join(required_sections)}")
 
 
@@ -1252,28 +5333,40 @@ class EnhancedProposalGenerator:
         evaluation_criteria = remove_problematic_chars(evaluation_criteria_match.group(1).strip()) if evaluation_criteria_match else "Evaluation criteria not specified."
 
         proposal_sections = {}
-        # Extract sections from the cleaned RFP text once before the loop
-        rfp_sections_content_map = extract_sections_from_rfp(cleaned_rfp_text)
+        # Parsed once per RFP text (cached by hash); section lookups are dictionary based
+        rfp_structure = parse_rfp(cleaned_rfp_text)
 
+        section_queries = []
+        rfp_section_contents = []
         for section_name in required_sections: # required_sections are already cleaned
-            print(f"Generating section: {section_name}")
-
-            # Find corresponding RFP section content (case-insensitive matching)
-            rfp_section_content_for_llm = next((content for rfp_sec_name, content in rfp_sections_content_map.items() if section_name.lower() in rfp_sec_name.lower() or rfp_sec_name.lower() in section_name.lower()), "")
-            # Content is already cleaned by extract_sections_from_rfp
-
-            cleaned_rfp_section_content = remove_problematic_chars(rfp_section_content_for_llm) if rfp_section_content_for_llm else ""
-            expanded_query = expand_query(section_name + " " + cleaned_rfp_section_content)
-
-            # --- ADDED TRY-EXCEPT around KB search ---
-            relevant_kb_content = [] # Default to empty list
+            # Find corresponding RFP section content (case-insensitive, whole-word matching)
+            cleaned_rfp_section_content = rfp_structure.content_for(section_name)
+            rfp_section_contents.append(cleaned_rfp_section_content)
+            section_queries.append(expand_query(section_name + " " + cleaned_rfp_section_content))
+
+        # --- ADDED TRY-EXCEPT around KB search ---
+        # All section queries are retrieved together: one encoder pass and one index search per hop
+        kb_results_per_section = [[] for _ in required_sections] # Default to empty lists
+        try:
+            # Assuming self.kb was validated at the start of the method
+            if hasattr(self.kb, 'multi_hop_search_batch'):
+                kb_results_per_section = self.kb.multi_hop_search_batch(section_queries, k=3)
+            else:
+                kb_results_per_section = [self.kb.multi_hop_search(query, k=3) for query in section_queries]
+        except Exception as kb_error:
+            st.error(f"Error searching Knowledge Base for proposal sections: {kb_error}")
+            # Continue generation with empty KB content
+        # --- END TRY-EXCEPT ---
+        if hasattr(self.kb, 'cache_stats'):
             try:
-                # Assuming self.kb was validated at the start of the method
-                relevant_kb_content = self.kb.multi_hop_search(expanded_query, k=3) # multi_hop_search returns cleaned content
-            except Exception as kb_error:
-                st.error(f"Error searching Knowledge Base for section '{section_name}': {kb_error}")
-                # Continue generation with empty KB content
-            # --- END TRY-EXCEPT ---
+                stats = self.kb.cache_stats()
+                print(f"Retrieval cache hit rate: results {stats['results']['hit_rate']:.1%}, "
+                      f"query embeddings {stats['query_embeddings']['hit_rate']:.1%}")
+            except (KeyError, TypeError, RuntimeError, OSError) as stats_error:
+                print(f"Retrieval cache stats unavailable: {stats_error}")
+
+        for section_name, cleaned_rfp_section_content, relevant_kb_content in zip(required_sections, rfp_section_contents, kb_results_per_section):
+            print(f"Generating section: {section_name}")
 
             # Call generate_section (which now also has KB checks for pricing)
             # All inputs passed here should be cleaned versions
@@ -1622,11 +5715,11 @@ class EnhancedProposalGenerator:
         try:
             # Vectorize text
             documents = [cleaned_rfp_requirements, cleaned_vendor_proposal_text]
-            vectorizer = TfidfVectorizer()
+            vectorizer = sklearn_text.TfidfVectorizer()
             tfidf_matrix = vectorizer.fit_transform(documents)
 
             # Calculate similarity
-            similarity_matrix = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])
+            similarity_matrix = sklearn_pairwise.cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])
             similarity_score = similarity_matrix[0][0] # Get the single similarity value
 
             gaps = []
@@ -1725,18 +5818,18 @@ class EnhancedProposalGenerator:
 # Word export function
 def export_to_word(proposal_data, company_name, client_name, output_path, company_logo_path=None):
     """Export the generated proposal to a professionally formatted Word document"""
-    doc = Document()
+    doc = docx.Document()
 
     # Set document styles
     styles = doc.styles
 
     # Modify heading styles
     heading1 = styles['Heading 1']
-    heading1.font.size = Pt(16)
+    heading1.font.size = docx_shared.Pt(16)
     heading1.font.bold = True
 
     heading2 = styles['Heading 2']
-    heading2.font.size = Pt(14)
+    heading2.font.size = docx_shared.Pt(14)
     heading2.font.bold = True
 
     # Set document properties
@@ -1747,7 +5840,7 @@ def export_to_word(proposal_data, company_name, client_name, output_path, compan
     # Add title page
     if company_logo_path and os.path.exists(company_logo_path):
         try:
-            doc.add_picture(company_logo_path, width=Inches(2.0))
+            doc.add_picture(company_logo_path, width=docx_shared.Inches(2.0))
             doc.add_paragraph()  # Add some space after logo
         except Exception as e:
             print(f"Could not add logo to document: {e}")
@@ -1756,20 +5849,20 @@ def export_to_word(proposal_data, company_name, client_name, output_path, compan
     # Ensure client_name is cleaned before adding to document
     cleaned_client_name = remove_problematic_chars(client_name) if client_name else "Client"
     title = doc.add_heading(f"Proposal for {cleaned_client_name}", 0)
-    title.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    title.alignment = docx_text.WD_ALIGN_PARAGRAPH.CENTER
 
     # Add subtitle
     subtitle = doc.add_paragraph()
     # Ensure company_name is cleaned before adding to document
     cleaned_company_name = remove_problematic_chars(company_name) if company_name else "Your Company Name"
     subtitle_run = subtitle.add_run(f"Prepared by {cleaned_company_name}")
-    subtitle_run.font.size = Pt(14)
-    subtitle.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    subtitle_run.font.size = docx_shared.Pt(14)
+    subtitle.alignment = docx_text.WD_ALIGN_PARAGRAPH.CENTER
 
     # Add date
     date_para = doc.add_paragraph()
     date_run = date_para.add_run(datetime.now().strftime("%B %d, %Y"))
-    date_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    date_para.alignment = docx_text.WD_ALIGN_PARAGRAPH.CENTER
 
     # Add a page break
     doc.add_page_break()
@@ -2647,6 +6740,7 @@ input[type="radio"] {
     # Initialize session state variables
     if 'config' not in st.session_state:
         st.session_state.config = load_config()
+        configure_document_extraction(st.session_state.config.get("document_extraction"))
 
     # Ensure scoring_system exists in config after loading
     if 'scoring_system' not in st.session_state.config:
@@ -2666,10 +6760,30 @@ input[type="radio"] {
         try:
             kb_dir = st.session_state.config["knowledge_base"]["directory"]
             embedding_model_name = st.session_state.config["knowledge_base"]["embedding_model"]
-            st.session_state.knowledge_base = ProposalKnowledgeBase(kb_dir, embedding_model_name)
+            service_url = st.session_state.config["knowledge_base"].get("service_url")
+            shard_urls = st.session_state.config["knowledge_base"].get("shard_urls")
+            if shard_urls:
+                # One `serve-kb --shard I/N` server per shard, searched with scatter-gather
+                st.session_state.knowledge_base = ShardedKnowledgeBase.with_remote_shards(
+                    shard_urls, st.session_state.config["knowledge_base"]
+                )
+            elif service_url:
+                # Retrieval runs in a separate `serve-kb` process shared by every app worker
+                st.session_state.knowledge_base = RemoteKnowledgeBase(service_url)
+            else:
+                # Sessions share one process-wide knowledge base and model; this is only a reference.
+                # It loads in the background while the page renders and is first needed on generation.
+                st.session_state.knowledge_base = get_knowledge_base_service().acquire(
+                    kb_dir, embedding_model_name, st.session_state.config["knowledge_base"], wait=False
+                )
         except Exception as e:
             st.error(f"Failed to initialize knowledge base: {str(e)}")
             st.session_state.knowledge_base = None
+    elif isinstance(st.session_state.knowledge_base, KnowledgeBaseHandle):
+        try:
+            st.session_state.knowledge_base.refresh_if_stale()
+        except Exception as e:
+            print(f"Warning: Knowledge base reload failed, keeping the current one: {e}")
 
     if 'generator' not in st.session_state:
         openai_key = st.session_state.config["api_keys"]["openai_key"]
@@ -2802,10 +6916,12 @@ input[type="radio"] {
                 temp_file_path = ""
                 try:
                     file_extension = os.path.splitext(uploaded_file.name)[1] or ".tmp"
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file_obj:
-                        temp_file_obj.write(uploaded_file.getvalue())
-                        temp_file_path = temp_file_obj.name
-                    rfp_text = process_rfp(temp_file_path)
+                    temp_file_path = spool_upload(uploaded_file, file_extension)
+                    extraction_progress = st.empty()
+                    def show_extraction_progress(done, total):
+                        extraction_progress.progress(done / max(total, 1), text=f"Extracting page {done} of {total}")
+                    rfp_text = process_rfp(temp_file_path, progress=show_extraction_progress)
+                    extraction_progress.empty()
                     st.session_state.rfp_text = rfp_text
                     st.success(f"Successfully processed {uploaded_file.name}")
                     with st.expander("Preview RFP Content", expanded=False):
@@ -2847,6 +6963,17 @@ input[type="radio"] {
                             else: st.markdown("No deliverables found.")
                             st.markdown("#### Compliance Assessment")
                             st.markdown(st.session_state.compliance_assessment)
+                            if st.session_state.knowledge_base:
+                                # Pool the RFP's paragraphs into one vector and compare it with past responses
+                                rfp_paragraphs = [p for p in re.split(r"\n\s*\n", st.session_state.rfp_text) if p.strip()][:64]
+                                try:
+                                    closest = st.session_state.knowledge_base.closest_proposals(rfp_paragraphs, k=3)
+                                except Exception as e:
+                                    print(f"Warning: Closest past proposal lookup failed: {e}")
+                                    closest = []
+                                if closest:
+                                    st.markdown("#### Closest Past Proposals")
+                                    st.markdown("\n".join(f"- {p['filename']} ({p['client']}, similarity {p['score']:.2f})" for p in closest))
                             st.markdown("#### Full RFP Analysis")
                             st.write(rfp_analysis_result) # Display cleaned analysis
 
@@ -2975,8 +7102,7 @@ input[type="radio"] {
                 if uploaded_logo_export:
                     try:
                         logo_ext = os.path.splitext(uploaded_logo_export.name)[1] or ".png"
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=logo_ext) as temp_logo_file:
-                            temp_logo_file.write(uploaded_logo_export.getvalue()); logo_path_export = temp_logo_file.name
+                        logo_path_export = spool_upload(uploaded_logo_export, logo_ext)
                     except Exception as e: st.error(f"Error processing logo: {e}"); logo_path_export = None
                 export_format_selection = st.selectbox("Export Format", ["Word (.docx)", "PDF (.pdf)", "Markdown (.md)"], key="export_format_select") # Simplified labels
                 if st.button("Export", type="primary", key="export_button_final"):
@@ -3071,7 +7197,7 @@ input[type="radio"] {
                     temp_vendor_file_path = ""
                     try:
                         vendor_file_ext = os.path.splitext(uploaded_vendor_proposal_file.name)[1] or ".tmp"
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=vendor_file_ext) as temp_vp_file: temp_vp_file.write(uploaded_vendor_proposal_file.getvalue()); temp_vendor_file_path = temp_vp_file.name
+                        temp_vendor_file_path = spool_upload(uploaded_vendor_proposal_file, vendor_file_ext)
                         vendor_proposal_text_content = process_rfp(temp_vendor_file_path)
                         st.session_state.vendor_proposal_text = vendor_proposal_text_content
                         st.session_state.processed_vendor_file_name = uploaded_vendor_proposal_file.name
@@ -3161,5 +7287,345 @@ input[type="radio"] {
             template_filename_dl = f"RFP_Template_{safe_template_filename_base}_{datetime.now().strftime('%Y%m%d%H%M%S')}.md"
             st.download_button("Download Template (MD)", st.session_state.rfp_template_content, template_filename_dl, "text/markdown", key="download_rfp_template_button")
 
+# Command-line entry points; anything else runs the Streamlit app
+def benchmark_shards(argv=None):
+    """Cold build time and search latency of the KB with 1, 2, 4, ... worker-process shards"""
+    parser = argparse.ArgumentParser(prog="FINAL.py bench-shards", description=benchmark_shards.__doc__)
+    parser.add_argument("--shards", default="1,2,4", help="Comma-separated shard counts to compare")
+    parser.add_argument("--queries", type=int, default=20, help="Number of section-name queries to time")
+    args = parser.parse_args(argv)
+
+    kb_config = dict(load_config()["knowledge_base"])
+    queries = None
+    baseline = None
+    for shard_count in [int(n) for n in args.shards.split(",")]:
+        # Fresh cache dirs per run: every build encodes from scratch, nothing comes from a snapshot
+        with tempfile.TemporaryDirectory(prefix="bench-shards-") as scratch:
+            config = dict(kb_config, snapshot_dir=os.path.join(scratch, "snapshots"),
+                          embedding_cache_dir=os.path.join(scratch, "embeddings"))
+            start = time.perf_counter()
+            kb = ShardedKnowledgeBase.with_process_shards(
+                config["directory"], config["embedding_model"], config, shard_count
+            )
+            build = time.perf_counter() - start
+            try:
+                if queries is None:
+                    queries = kb.get_all_section_names()[:args.queries] or ["project timeline"]
+                kb.hybrid_search(queries[0], k=5) # warm-up
+                start = time.perf_counter()
+                for query in queries:
+                    kb.hybrid_search(query, k=5)
+                latency = (time.perf_counter() - start) / len(queries) * 1000
+                documents = kb.health()["documents"]
+            finally:
+                kb.close()
+        baseline = baseline or build
+        print(f"shards={shard_count}: {documents} sections, build {build:.2f}s "
+              f"(speedup x{baseline / build:.2f}), search {latency:.1f} ms/query")
+
+def check_embedding_backend(kb, candidate, k=10, max_queries=200, max_sections=2000):
+    """Top-k neighbour overlap and encode speed of a candidate backend against the KB's own model.
+
+    Both models embed the same sample of KB sections and use its section names as queries;
+    overlap@k is the share of each query's k nearest sections that both models agree on.
+    """
+    live_ids = kb._live_ids()
+    step = max(1, len(live_ids) // max_sections)
+    sample = live_ids[::step][:max_sections]
+    corpus = [kb.documents.content(doc_id) for doc_id in sample]
+    queries = list(dict.fromkeys(kb.documents.section_name(doc_id) for doc_id in sample))[:max_queries]
+    k = min(k, len(corpus))
+    if not corpus or not queries:
+        raise ValueError("The knowledge base has no sections to compare on")
+
+    def neighbours(model):
+        start = time.perf_counter()
+        corpus_vectors = np.asarray(model.encode(corpus), dtype=np.float32)
+        seconds = time.perf_counter() - start
+        query_vectors = np.asarray(model.encode(queries), dtype=np.float32)
+        faiss.normalize_L2(corpus_vectors)
+        faiss.normalize_L2(query_vectors)
+        scores = query_vectors @ corpus_vectors.T
+        return np.argpartition(-scores, k - 1, axis=1)[:, :k], seconds
+
+    reference, reference_seconds = neighbours(kb.model)
+    result, candidate_seconds = neighbours(candidate)
+    overlap = np.array([len(np.intersect1d(a, b)) / k for a, b in zip(reference, result)])
+    return {
+        "reference": kb.model.model_id, "candidate": candidate.model_id, "k": k,
+        "queries": len(queries), "sections": len(corpus),
+        "mean_overlap": float(overlap.mean()), "min_overlap": float(overlap.min()),
+        "reference_sections_per_s": len(corpus) / reference_seconds,
+        "candidate_sections_per_s": len(corpus) / candidate_seconds,
+    }
+
+def benchmark_embedding_backend(argv=None):
+    """Accuracy (top-k overlap with full precision) and encode speed of a quantized embedding backend"""
+    parser = argparse.ArgumentParser(prog="FINAL.py bench-embedding-backend", description=benchmark_embedding_backend.__doc__)
+    kb_config = dict(load_config()["knowledge_base"])
+    parser.add_argument("--backend", default=kb_config.get("embedding_backend", "torch"),
+                        choices=HierarchicalEmbeddingModel.BACKENDS)
+    parser.add_argument("--onnx-file", default=kb_config.get("embedding_onnx_file", ""))
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--sections", type=int, default=2000, help="Maximum KB sections to embed")
+    parser.add_argument("--threshold", type=float, default=kb_config.get("embedding_backend_min_overlap", 0.9))
+    args = parser.parse_args(argv)
+
+    # The reference is always the full-precision PyTorch model
+    reference_config = dict(kb_config, embedding_backend="torch", embedding_onnx_file="")
+    kb = ProposalKnowledgeBase(kb_config["directory"], kb_config["embedding_model"], reference_config)
+    candidate = HierarchicalEmbeddingModel(kb_config["embedding_model"], args.backend, args.onnx_file)
+    report = check_embedding_backend(kb, candidate, k=args.k, max_queries=args.queries, max_sections=args.sections)
+
+    print(f"{report['candidate']} vs {report['reference']} on {report['sections']} sections, {report['queries']} queries")
+    print(f"overlap@{report['k']}: mean {report['mean_overlap']:.3f}, worst query {report['min_overlap']:.3f} "
+          f"(threshold {args.threshold:.2f})")
+    print(f"encode: {report['reference_sections_per_s']:.1f} -> {report['candidate_sections_per_s']:.1f} sections/s "
+          f"(x{report['candidate_sections_per_s'] / report['reference_sections_per_s']:.2f})")
+    if report["mean_overlap"] < args.threshold:
+        print(f"FAIL: {args.backend} changes retrieval too much for this knowledge base")
+        sys.exit(1)
+    print(f"OK: {args.backend} can be used (set \"embedding_backend\" in config.json)")
+
+def benchmark_compression(argv=None):
+    """Dense index memory and recall@k (with and without full-precision re-ranking) per compression setting"""
+    parser = argparse.ArgumentParser(prog="FINAL.py bench-compression", description=benchmark_compression.__doc__)
+    parser.add_argument("--variants", default="sq8,pq,pca128+sq8,pca128+pq",
+                        help="Comma-separated settings: none, sq8, pq, pcaN, or pcaN+sq8 / pcaN+pq")
+    parser.add_argument("--tier", default="auto", choices=["auto", "flat", "hnsw", "ivfpq"])
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    kb_config = dict(load_config()["knowledge_base"])
+    rows = []
+    for variant in ["none"] + [v for v in args.variants.split(",") if v and v != "none"]:
+        compression, pca_dims = "none", 0
+        for part in variant.split("+"):
+            if part.startswith("pca"):
+                pca_dims = int(part[3:])
+            else:
+                compression = part
+        index_config = dict(kb_config.get("index", {}), type=args.tier, compression=compression, pca_dims=pca_dims,
+                            recall_eval_k=args.k, recall_eval_queries=args.queries)
+        # Vectors come from the shared embedding cache; only the index is rebuilt per variant
+        with tempfile.TemporaryDirectory(prefix="bench-compression-") as scratch:
+            config = dict(kb_config, index=index_config, snapshot_dir=os.path.join(scratch, "snapshots"))
+            kb = ProposalKnowledgeBase(config["directory"], config["embedding_model"], config)
+            if kb.index is None:
+                raise SystemExit("The knowledge base is empty")
+            headings = kb.get_all_section_names()[:args.queries] or ["project timeline"]
+            queries = kb.model.encode(headings)
+            kb._dense_passage_search(queries[:1], args.k) # warm-up
+            start = time.perf_counter()
+            kb._dense_passage_search(queries, args.k)
+            latency = (time.perf_counter() - start) / len(headings) * 1000
+            reranked = kb.evaluate_index_recall(k=args.k, n_queries=args.queries)["recall"]
+            kb.index_config["rerank_factor"] = 0
+            raw = kb.evaluate_index_recall(k=args.k, n_queries=args.queries)["recall"]
+            rows.append({
+                "variant": variant, "tier": kb.index_tier, "vectors": kb.index.ntotal,
+                "index_bytes": dense_index_bytes(kb.index),
+                "disk_bytes": kb.full_vectors.nbytes() if kb.full_vectors is not None else 0,
+                "recall_raw": raw, "recall_reranked": reranked if kb.full_vectors is not None else None,
+                "ms_per_query": latency
+            })
+
+    baseline = rows[0]["index_bytes"]
+    print(f"{rows[0]['vectors']} passage vectors, recall@{args.k} against exact float32 search")
+    print(f"{'variant':<14}{'tier':<7}{'index MB':>10}{'saved':>8}{'on disk MB':>12}"
+          f"{'recall':>8}{'reranked':>10}{'ms/query':>10}")
+    for row in rows:
+        reranked = "-" if row["recall_reranked"] is None else f"{row['recall_reranked']:.3f}"
+        print(f"{row['variant']:<14}{row['tier']:<7}{row['index_bytes'] / 2**20:>10.2f}"
+              f"{1 - row['index_bytes'] / baseline:>8.0%}{row['disk_bytes'] / 2**20:>12.2f}"
+              f"{row['recall_raw']:>8.3f}{reranked:>10}{row['ms_per_query']:>10.2f}")
+
+def _chained_remove_problematic_chars(text):
+    """The previous cleaner (11 replaces, a latin-1 round trip and a regex); bench-clean's baseline"""
+    for char, replacement in _CLEAN_REPLACEMENTS.items():
+        text = text.replace(char, replacement)
+    text = text.encode('latin-1', errors='ignore').decode('latin-1')
+    return re.sub(r'[^\x20-\x7E\n\r\t\u00A0]', '', text)
+
+def benchmark_cleaning(argv=None):
+    """Time remove_problematic_chars against the chained-replace cleaner on the largest KB responses"""
+    parser = argparse.ArgumentParser(prog="FINAL.py bench-clean", description=benchmark_cleaning.__doc__)
+    parser.add_argument("files", nargs="*", help="Files to clean (default: the largest files in the KB directory)")
+    parser.add_argument("--largest", type=int, default=3, help="How many of the largest KB files to use")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    files = args.files
+    if not files:
+        directory = load_config()["knowledge_base"]["directory"]
+        candidates = glob.glob(os.path.join(directory, "*.md")) + glob.glob(os.path.join(directory, "*.txt"))
+        files = sorted(candidates, key=os.path.getsize, reverse=True)[:args.largest]
+    if not files:
+        raise SystemExit("No files to benchmark")
+
+    def best_of(function, text):
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            function(text)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    print(f"{'file':<48}{'KB':>7}{'chained ms':>12}{'single-pass ms':>16}{'speedup':>9}{'re-clean us':>13}  same")
+    for path in files:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            text = f.read()
+        chained = best_of(_chained_remove_problematic_chars, text)
+        single_pass = best_of(remove_problematic_chars, text)
+        cleaned = remove_problematic_chars(text)
+        again = best_of(remove_problematic_chars, cleaned)
+        same = cleaned == _chained_remove_problematic_chars(text)
+        print(f"{os.path.basename(path)[:46]:<48}{len(text.encode('utf-8')) / 1024:>7.0f}{chained * 1000:>12.3f}"
+              f"{single_pass * 1000:>16.3f}{chained / single_pass:>8.1f}x{again * 1e6:>13.2f}  {'yes' if same else 'NO'}")
+
+def _write_synthetic_tender_docx(path, tables, rows_per_table, columns=4):
+    """A tender-like DOCX: numbered headings, requirement paragraphs and a table per subsection"""
+    document = docx.Document()
+    for t in range(tables):
+        document.add_heading(f"{t + 1}. Requirement group {t + 1}", 1 if t % 5 == 0 else 2)
+        for line in range(3):
+            document.add_paragraph(f"The bidder shall describe how requirement {t + 1}.{line + 1} is met, "
+                                   "including staffing, timelines, reporting and service levels.")
+        table = document.add_table(rows=rows_per_table, cols=columns)
+        for r, row in enumerate(table.rows):
+            for c, cell in enumerate(row.cells):
+                cell.text = f"Item {t + 1}.{r + 1}" if c == 0 else f"Value {r * columns + c} (SAR, excl. VAT)"
+    document.save(path)
+
+def benchmark_docx(argv=None):
+    """Time the streaming DOCX extractor against the python-docx object model on large tenders"""
+    parser = argparse.ArgumentParser(prog="FINAL.py bench-docx", description=benchmark_docx.__doc__)
+    parser.add_argument("files", nargs="*", help="DOCX files (default: a generated tender)")
+    parser.add_argument("--tables", type=int, default=400, help="Tables in the generated tender")
+    parser.add_argument("--rows", type=int, default=15, help="Rows per generated table")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    files = args.files
+    scratch = None
+    if not files:
+        scratch = tempfile.mkdtemp(prefix="bench-docx-")
+        files = [os.path.join(scratch, f"tender_{args.tables}_tables.docx")]
+        _write_synthetic_tender_docx(files[0], args.tables, args.rows)
+
+    # Each run in a fresh interpreter; memory is the resident set sampled during the extraction above the
+    # level after imports (lxml allocates outside tracemalloc's view). Linux only, 0 elsewhere.
+    probe = (
+        "import json, os, threading, time, importlib.util\n"
+        f"spec = importlib.util.spec_from_file_location('rfp_app_bench', {os.path.abspath(__file__)!r})\n"
+        "module = importlib.util.module_from_spec(spec); spec.loader.exec_module(module)\n"
+        "import docx, lxml.etree\n"
+        "def rss():\n"
+        "    try:\n"
+        "        with open('/proc/self/statm') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')\n"
+        "    except (OSError, ValueError, AttributeError): return 0\n"
+        "before = rss(); peak = [before]; done = threading.Event()\n"
+        "def sample():\n"
+        "    while not done.wait(0.002): peak[0] = max(peak[0], rss())\n"
+        "sampler = threading.Thread(target=sample); sampler.start()\n"
+        "start = time.perf_counter()\n"
+        "text = getattr(module, {function!r})({path!r})\n"
+        "seconds = time.perf_counter() - start\n"
+        "done.set(); sampler.join(); peak = max(peak[0], rss()) - before\n"
+        "print(json.dumps({{'seconds': seconds, 'peak_kb': peak / 1024, 'lines': text.split('\\n')}}))"
+    )
+    try:
+        print(f"{'file':<40}{'KB':>7}{'lines':>8}{'python-docx s':>15}{'streaming s':>13}{'speedup':>9}"
+              f"{'docx peak MB':>14}{'stream peak MB':>16}  same lines")
+        for path in files:
+            runs = {}
+            for function in ("_object_model_extract_text_from_docx", "extract_text_from_docx"):
+                results = [_time_in_fresh_interpreter(probe.format(function=function, path=os.path.abspath(path)))
+                           for _ in range(args.repeat)]
+                runs[function] = min(results, key=lambda result: result["seconds"])
+            baseline, streaming = runs["_object_model_extract_text_from_docx"], runs["extract_text_from_docx"]
+            same = Counter(baseline["lines"]) == Counter(streaming["lines"])
+            print(f"{os.path.basename(path)[:38]:<40}{os.path.getsize(path) / 1024:>7.0f}{len(streaming['lines']):>8}"
+                  f"{baseline['seconds']:>15.2f}{streaming['seconds']:>13.2f}{baseline['seconds'] / streaming['seconds']:>8.1f}x"
+                  f"{baseline['peak_kb'] / 1024:>14.1f}{streaming['peak_kb'] / 1024:>16.1f}  "
+                  f"{'yes' if same else 'no (merged or nested cells differ)'}")
+    finally:
+        if scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+# Modules the app used to import eagerly at the top of this file
+EAGER_STARTUP_IMPORTS = (
+    "faiss", "sentence_transformers", "torch", "sklearn.feature_extraction.text", "sklearn.metrics.pairwise",
+    "scipy.sparse", "PyPDF2", "docx", "openai", "markdown", "PIL.Image", "matplotlib.pyplot", "plotly.express",
+    "pandas", "nltk.sentiment.vader", "requests",
+)
+
+def _time_in_fresh_interpreter(code):
+    """Run a snippet in a new Python process and return the JSON it prints"""
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def benchmark_startup(argv=None):
+    """Per-import cold cost of the heavy dependencies and the app's import time with lazy loading"""
+    parser = argparse.ArgumentParser(prog="FINAL.py bench-startup", description=benchmark_startup.__doc__)
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh interpreters per measurement (best is kept)")
+    args = parser.parse_args(argv)
+
+    # Cost of each module on top of what every start pays anyway (streamlit and numpy)
+    probe = (
+        "import json, time, importlib, streamlit, numpy\n"
+        "start = time.perf_counter()\n"
+        "try:\n    importlib.import_module({name!r}); seconds = time.perf_counter() - start\n"
+        "except ImportError:\n    seconds = None\n"
+        "print(json.dumps(seconds))"
+    )
+    costs = {}
+    for name in EAGER_STARTUP_IMPORTS:
+        runs = [_time_in_fresh_interpreter(probe.format(name=name)) for _ in range(args.repeat)]
+        costs[name] = None if runs[0] is None else min(runs)
+
+    eager = (
+        "import json, time, importlib, streamlit, numpy\n"
+        "start = time.perf_counter()\n"
+        f"for name in {list(EAGER_STARTUP_IMPORTS)!r}:\n"
+        "    try: importlib.import_module(name)\n"
+        "    except ImportError: pass\n"
+        "print(json.dumps(time.perf_counter() - start))"
+    )
+    lazy = (
+        "import json, sys, time, importlib.util, streamlit, numpy\n"
+        "start = time.perf_counter()\n"
+        f"spec = importlib.util.spec_from_file_location('rfp_app_startup', {os.path.abspath(__file__)!r})\n"
+        "module = importlib.util.module_from_spec(spec); spec.loader.exec_module(module)\n"
+        "seconds = time.perf_counter() - start\n"
+        f"print(json.dumps({{'seconds': seconds, 'loaded': [n for n in {list(EAGER_STARTUP_IMPORTS)!r} if n in sys.modules]}}))"
+    )
+    before = min(_time_in_fresh_interpreter(eager) for _ in range(args.repeat))
+    after_runs = [_time_in_fresh_interpreter(lazy) for _ in range(args.repeat)]
+    after = min(run["seconds"] for run in after_runs)
+    loaded = set(after_runs[0]["loaded"])
+
+    print(f"{'module':<34}{'cold import':>12}  at startup (before -> after)")
+    for name, seconds in sorted(costs.items(), key=lambda item: -(item[1] or 0)):
+        cost = "not installed" if seconds is None else f"{seconds * 1000:.0f} ms"
+        print(f"{name:<34}{cost:>12}  yes -> {'yes' if name in loaded else 'no'}")
+    print(f"\nHeavy imports at startup: {before:.2f}s before, {after:.2f}s after (app module incl. its own code), "
+          f"excluding streamlit/numpy")
+
+COMMANDS = {
+    "serve-kb": serve_knowledge_base,
+    "bench-shards": benchmark_shards,
+    "bench-startup": benchmark_startup,
+    "bench-embedding-backend": benchmark_embedding_backend,
+    "bench-compression": benchmark_compression,
+    "bench-clean": benchmark_cleaning,
+    "bench-docx": benchmark_docx,
+}
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        main()
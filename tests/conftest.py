@@ -0,0 +1,82 @@
+import hashlib
+import os
+import re
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import FINAL  # noqa: E402
+
+
+class HashingEncoder:
+    """Deterministic bag-of-words encoder with the SentenceTransformer methods the knowledge base uses"""
+    dimension = 64
+    max_seq_length = 256
+    tokenizer = None
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, texts, convert_to_tensor=False, batch_size=32, show_progress_bar=False,
+               normalize_embeddings=False, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        vectors = np.full((len(texts), self.dimension), 0.01, dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower())[:self.max_seq_length]:
+                digest = int(hashlib.md5(word.encode()).hexdigest(), 16)
+                vectors[row, digest % self.dimension] += 1.0 if (digest >> 7) & 1 else -1.0
+        if normalize_embeddings:
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors[0] if single else vectors
+
+
+class HashingEmbeddingModel(FINAL.HierarchicalEmbeddingModel):
+    def __init__(self):
+        self.model_name = "hashing-test-encoder"
+        self.backend = "torch"
+        self.onnx_file = ""
+        self.model = HashingEncoder()
+
+
+TOPICS = ["social media strategy", "website design", "crm implementation", "performance campaign",
+          "content production", "search engine optimization", "analytics dashboard", "brand identity"]
+
+CALL_SIGNS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliet", "kilo"]
+
+
+def write_response_file(directory, index, extra=""):
+    topic = TOPICS[index % len(TOPICS)]
+    # Section lengths vary per file so that no two sections tie on BM25 or cosine scores
+    filler = " ".join(["notes"] * (index % 7))
+    path = os.path.join(directory, f"Client_{index:03d}_Proposal_{index:03d}_RESPONSE.md")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"# Introduction\nProposal {index} for client {index} covering {topic}. {filler}{extra}\n"
+                f"# Scope of Work\nWe deliver {topic} with weekly reporting for client {index}, "
+                f"milestone {index * 7}, led by team {CALL_SIGNS[index % len(CALL_SIGNS)]} {index * 37 + 11}. {filler}\n"
+                f"# Pricing\nTotal fee AED {10000 + index * 250:,} per month for {topic}. {filler}\n")
+    return path
+
+
+@pytest.fixture
+def embedding_model():
+    return HashingEmbeddingModel()
+
+
+@pytest.fixture
+def kb_factory(tmp_path, embedding_model):
+    directory = tmp_path / "responses"
+    directory.mkdir()
+
+    def make(file_count, **config):
+        for index in range(file_count):
+            write_response_file(str(directory), index)
+        kb_config = {"embedding_cache_dir": "", "snapshot_dir": "", "dedup": {"enabled": False}}
+        kb_config.update(config)
+        return FINAL.ProposalKnowledgeBase(str(directory), embedding_model, kb_config)
+
+    make.directory = str(directory)
+    return make
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+import FINAL
+
+rank_bm25 = pytest.importorskip("rank_bm25")
+
+# "proposal" and "client" occur in most documents, so their idf is negative and falls back to the epsilon floor
+CORPUS = [
+    "proposal for client social media strategy and monthly reporting",
+    "proposal for client website design with weekly reporting",
+    "client crm implementation proposal with training",
+    "proposal client brand identity refresh and logo design",
+    "performance campaign proposal for client with paid search",
+    "analytics dashboard build for the client proposal",
+    "zebra quokka ocelot",
+]
+QUERIES = ["proposal client reporting", "website design", "crm training proposal proposal", "zebra", "unknown words"]
+
+
+def assert_parity(index, live_ids):
+    reference = rank_bm25.BM25Okapi([FINAL.BM25Index.tokenize(CORPUS[doc_id]) for doc_id in live_ids])
+    for query in QUERIES:
+        expected = reference.get_scores(FINAL.BM25Index.tokenize(query))
+        actual = dict((doc_id, score) for score, doc_id in index.search(query, len(CORPUS)))
+        assert np.allclose([actual.get(doc_id, 0.0) for doc_id in live_ids], expected, atol=1e-5)
+        # The batched sparse product drops zero scores (terms with an idf of exactly 0)
+        batch = dict((doc_id, score) for score, doc_id in index.search_batch([query], len(CORPUS))[0])
+        assert batch == pytest.approx({doc_id: score for doc_id, score in actual.items() if score})
+
+
+def test_scores_match_rank_bm25_through_adds_removes_and_compaction(tmp_path):
+    index = FINAL.BM25Index()
+    for doc_id, text in enumerate(CORPUS[:4]):
+        index.add(doc_id, text)
+    index.compact()
+    assert_parity(index, [0, 1, 2, 3])
+
+    # Delta adds and removals must move the average idf behind the epsilon floor too
+    for doc_id in range(4, len(CORPUS)):
+        index.add(doc_id, CORPUS[doc_id])
+    assert_parity(index, list(range(len(CORPUS))))
+    index.remove(6)
+    index.remove(1)
+    live_ids = [0, 2, 3, 4, 5]
+    assert_parity(index, live_ids)
+
+    # Terms only the removed documents contained ("zebra", "website") no longer count toward the average idf
+    index.compact()
+    assert "zebra" not in index.document_frequencies()
+    assert_parity(index, live_ids)
+
+    index.save(str(tmp_path))
+    assert_parity(FINAL.BM25Index.load(str(tmp_path)), live_ids)
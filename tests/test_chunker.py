@@ -0,0 +1,62 @@
+import re
+
+import FINAL
+
+
+class SyllableTokenizer:
+    """Fast-tokenizer stand-in: every 3 characters of a word is one token, with character offsets"""
+    def _offsets(self, text):
+        return [(start, min(start + 3, match.end())) for match in re.finditer(r"\S+", text)
+                for start in range(match.start(), match.end(), 3)]
+
+    def __call__(self, texts, add_special_tokens=False, return_offsets_mapping=True, verbose=False):
+        if isinstance(texts, str):
+            return {"offset_mapping": self._offsets(texts)}
+        return {"offset_mapping": [self._offsets(text) for text in texts]}
+
+
+def decode(text, ranges):
+    data = text.encode("utf-8")
+    return [data[start:end].decode("utf-8") for start, end in ranges]
+
+
+def test_word_windows_cover_the_text_with_the_configured_overlap():
+    words = [f"w{index}" for index in range(100)]
+    text = " ".join(words)
+    passages = [passage.split() for passage in decode(text, FINAL.PassageChunker(None, 20, 5).chunk(text))]
+    assert all(len(passage) <= 20 for passage in passages)
+    assert passages[0][0] == "w0" and passages[-1][-1] == "w99"
+    for previous, current in zip(passages, passages[1:]):
+        assert previous[-5:] == current[:5]
+    assert FINAL.PassageChunker(None, 20, 5).chunk("   ") == []
+
+
+def test_ranges_are_utf8_byte_offsets():
+    text = "Café résumé naïve " * 30
+    ranges = FINAL.PassageChunker(None, 16, 4).chunk(text)
+    assert len(ranges) > 1
+    assert all(passage.split()[0] in ("Café", "résumé", "naïve") for passage in decode(text, ranges))
+
+
+def test_tokenizer_offsets_bound_the_passages_and_batches_match_single_calls():
+    chunker = FINAL.PassageChunker(SyllableTokenizer(), 12, 3)
+    texts = ["internationalization " * 10, "short text", "Über großartige Änderungen " * 8]
+    batched = chunker.chunk_many(texts)
+    assert batched == [chunker.chunk(text) for text in texts]
+    for text, ranges in zip(texts, batched):
+        for passage in decode(text, ranges):
+            assert len(SyllableTokenizer()._offsets(passage)) <= 12
+
+
+def test_long_sections_are_searched_by_passage_and_reported_once(kb_factory):
+    with open(f"{kb_factory.directory}/Atlas_Proposal_RESPONSE.md", "w", encoding="utf-8") as f:
+        f.write("# Methodology\n" + " ".join(f"step{index}" for index in range(200)) + " pelican migration tracking\n")
+    kb = kb_factory(4, passage_max_tokens=40, passage_overlap_tokens=8)
+    section = kb.file_doc_ids["Atlas_Proposal_RESPONSE.md"][0]
+    assert len(kb.doc_passages[section]) > 4
+
+    results = kb.hybrid_search("pelican migration tracking", k=3)
+    assert [r["document"]["id"] for r in results].count(section) == 1
+    best = next(r for r in results if r["document"]["id"] == section)
+    assert "pelican migration tracking" in best["passage"]["text"]
+    assert best["passage"]["document_id"] == section
@@ -0,0 +1,17 @@
+import json
+
+import FINAL
+
+
+def test_load_config_keeps_nested_defaults(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "config.json").write_text(json.dumps({
+        "company_info": {"name": "Acme"},
+        "knowledge_base": {"directory": "responses", "bm25": {"k1": 1.2}}
+    }))
+    config = FINAL.load_config()
+    assert config["company_info"]["name"] == "Acme"
+    assert config["company_info"]["default_styles"]["font_family"] == "Arial"
+    assert config["knowledge_base"]["directory"] == "responses"
+    assert config["knowledge_base"]["bm25"] == {"k1": 1.2, "b": 0.75, "epsilon": 0.25}
+    assert config["knowledge_base"]["snapshot_dir"] == ".kb_cache/snapshots"
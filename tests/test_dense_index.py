@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+import FINAL
+from conftest import TOPICS, write_response_file
+
+QUERIES = [f"{topic} for client {index}" for index, topic in enumerate(TOPICS * 3)]
+
+
+def dense_top_ids(kb, k=10):
+    return [[passage_id for _, passage_id in row] for row in kb._dense_passage_search(kb._encode_queries(QUERIES), k)]
+
+
+def recall(hits, exact):
+    return float(np.mean([len(set(row) & set(exact_row)) / len(exact_row) for row, exact_row in zip(hits, exact)]))
+
+
+def test_auto_tier_follows_corpus_size():
+    config = dict(FINAL.DEFAULT_INDEX_CONFIG, flat_max_vectors=100, hnsw_max_vectors=1000)
+    assert [FINAL.select_index_tier(n, config) for n in (100, 101, 1000, 1001)] == ["flat", "hnsw", "hnsw", "ivfpq"]
+    assert FINAL.select_index_tier(5, dict(config, type="ivfpq")) == "ivfpq"
+
+
+@pytest.mark.parametrize("index", [{"type": "hnsw"}, {"type": "ivfpq"}, {"flat_max_vectors": 50, "hnsw_max_vectors": 100}])
+def test_ann_tiers_keep_recall_against_exact_search(kb_factory, embedding_model, index):
+    flat = kb_factory(60)
+    kb = FINAL.ProposalKnowledgeBase(kb_factory.directory, embedding_model, dict(flat.kb_config, index=index))
+    assert kb.index_tier != "flat"
+    assert recall(dense_top_ids(kb), dense_top_ids(flat)) >= 0.95
+
+
+@pytest.mark.parametrize("index", [{"compression": "sq8"}, {"compression": "pq"}, {"pca_dims": 32},
+                                   {"type": "hnsw", "compression": "pq"}])
+def test_compressed_storage_is_smaller_and_reranks_to_exact_scores(kb_factory, embedding_model, index):
+    flat = kb_factory(60)
+    kb = FINAL.ProposalKnowledgeBase(kb_factory.directory, embedding_model, dict(flat.kb_config, index=index))
+    assert kb.full_vectors is not None
+    if "compression" in index and "type" not in index:
+        assert kb.index_stats["index_bytes"] < flat.index_stats["index_bytes"]
+    assert recall(dense_top_ids(kb), dense_top_ids(flat)) >= 0.95
+    # Candidates are re-scored against the full-precision vectors, so scores are exact cosines
+    query = kb._encode_queries(QUERIES[:1])
+    exact = dict((passage_id, score) for score, passage_id in flat._dense_passage_search(query, 5)[0])
+    for score, passage_id in kb._dense_passage_search(query, 5)[0]:
+        if passage_id in exact:
+            assert score == pytest.approx(exact[passage_id], abs=1e-5)
+
+
+def test_compressed_snapshots_keep_the_full_precision_vectors(kb_factory, embedding_model, tmp_path):
+    config = {"embedding_cache_dir": "", "snapshot_dir": str(tmp_path / "snapshots"), "dedup": {"enabled": False},
+              "index": {"compression": "sq8"}}
+    built = kb_factory(20, **config)
+    reopened = FINAL.ProposalKnowledgeBase(kb_factory.directory, embedding_model, config)
+    assert reopened.full_vectors.read_only
+    assert dense_top_ids(reopened) == dense_top_ids(built)
+
+    # The first write copies the mapped store to a scratch file instead of touching the snapshot
+    reopened.upsert_file(write_response_file(kb_factory.directory, 40, extra=" narwhal"))
+    assert not reopened.full_vectors.read_only
+    assert reopened.full_vectors.path != built.full_vectors.path
+    assert "Client_040_Proposal_040_RESPONSE.md" in {r["document"]["filename"] for r in reopened.hybrid_search("narwhal", k=3)}
@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+import FINAL
+
+
+def fill(store, count, start=0):
+    for index in range(start, start + count):
+        store.append(f"file_{index % 3}.md", f"Section {index}", f"Text of section {index} é" * (index % 4),
+                     {"client_industry": "retail", "key_differentiators": ["speed"]})
+
+
+def contents(store):
+    return [store.content(doc_id) for doc_id in range(len(store))]
+
+
+def test_spilled_text_reads_back_and_survives_a_snapshot_round_trip(tmp_path):
+    store = FINAL.DocumentStore()
+    fill(store, 5)
+    store.spill(str(tmp_path / "scratch"))
+    fill(store, 4, start=5)
+    assert store.unspilled_bytes() > 0
+    expected = [f"Text of section {index} é" * (index % 4) for index in range(9)]
+    assert contents(store) == expected
+    store.spill(str(tmp_path / "scratch"))
+    assert store.unspilled_bytes() == 0 and contents(store) == expected
+
+    snapshot = tmp_path / "snapshot"
+    snapshot.mkdir()
+    store.save(str(snapshot))
+    loaded = FINAL.DocumentStore.load(str(snapshot))
+    assert contents(loaded) == expected
+
+    # The writable copy maps the snapshot's text and never writes to it
+    writable = loaded.writable()
+    fill(writable, 2, start=9)
+    snapshot_bytes = (snapshot / "content.bin").read_bytes()
+    writable.spill(str(tmp_path / "scratch"))
+    assert contents(writable) == expected + [f"Text of section {index} é" * (index % 4) for index in (9, 10)]
+    assert (snapshot / "content.bin").read_bytes() == snapshot_bytes
+    assert contents(loaded) == expected
+
+
+def test_builds_spill_section_text_as_they_read(kb_factory, tmp_path):
+    kb = kb_factory(12, ingest_spill_mb=0.0005, snapshot_dir=str(tmp_path / "snapshots"))
+    assert kb.documents.unspilled_bytes() == 0
+    assert os.listdir(tmp_path / "snapshots" / "scratch")
+    section = kb.documents[kb.file_doc_ids["Client_007_Proposal_007_RESPONSE.md"][1]]
+    assert section["section_name"] == "Scope of Work"
+    assert "client 7" in section["content"]
+    assert kb.hybrid_search("milestone 49", k=1)[0]["document"]["filename"] == "Client_007_Proposal_007_RESPONSE.md"
+
+
+def test_document_views_read_like_the_old_section_dicts():
+    store = FINAL.DocumentStore()
+    metadata = {"client_industry": "retail", "proposal_success": False, "project_size": "large",
+                "key_differentiators": ["speed", "price"]}
+    doc_id = store.append("a.md", "Pricing", "Total fee AED 5,000", metadata)
+    view = store[doc_id]
+    assert dict(view) == {"id": 0, "filename": "a.md", "section_name": "Pricing", "content": "Total fee AED 5,000",
+                          "metadata": metadata}
+    content = view["content"]
+    assert isinstance(content, FINAL.CleanText) and FINAL.remove_problematic_chars(content) is content
+    with pytest.raises(KeyError):
+        view["score"]
+    assert view.get("score") is None
+    with pytest.raises(IndexError):
+        store[1]
+
+
+def test_repeated_values_are_interned_and_removed_rows_keep_their_ids(tmp_path):
+    store = FINAL.DocumentStore()
+    fill(store, 9)
+    assert store.tables["filename"] == ["file_0.md", "file_1.md", "file_2.md"]
+    assert len(store.tables["industry"]) == 1 and len(store.tables["differentiators"]) == 1
+    store.remove(4)
+    assert store[4] is None and store.live_ids() == [0, 1, 2, 3, 5, 6, 7, 8]
+
+    store.save(str(tmp_path))
+    loaded = FINAL.DocumentStore.load(str(tmp_path))
+    assert len(loaded) == 9 and loaded[4] is None
+    assert loaded.content(4) == ""  # removed text is dropped from the saved buffer
+    assert [loaded.content(doc_id) for doc_id in loaded.live_ids()] == [store.content(doc_id) for doc_id in store.live_ids()]
+    assert loaded[5]["metadata"]["key_differentiators"] == ["speed"]
+
+    writable = loaded.writable()
+    assert writable is not loaded and loaded.read_only and not writable.read_only
+    writable.remove(5)
+    assert loaded[5] is not None
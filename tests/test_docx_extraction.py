@@ -0,0 +1,51 @@
+import pytest
+
+import FINAL
+
+docx = pytest.importorskip("docx")
+
+
+@pytest.fixture
+def tender_path(tmp_path):
+    document = docx.Document()
+    document.add_paragraph("Request for proposal issued by the authority.")
+    document.add_heading("Scope of Work", level=1)
+    document.add_paragraph("The agency will run three channels.")
+    table = document.add_table(rows=2, cols=3)
+    for row, values in zip(table.rows, [("Deliverable", "Due", ""), ("Launch plan", "Week 2", "Signed")]):
+        for cell, value in zip(row.cells, values):
+            cell.text = value
+    nested = table.rows[1].cells[2].add_table(rows=1, cols=2)
+    nested.rows[0].cells[0].text, nested.rows[0].cells[1].text = "Sub item", "Week 3"
+    document.add_heading("Pricing", level=2)
+    run = document.add_paragraph().add_run("Fixed fee")
+    run.add_tab()
+    run.add_text("AED")
+    run.add_break()
+    run.add_text("Paid monthly.")
+    document.add_paragraph("   ")
+    path = tmp_path / "tender.docx"
+    document.save(str(path))
+    return str(path)
+
+
+def test_blocks_stream_in_document_order(tender_path):
+    assert list(FINAL.iter_docx_blocks(tender_path)) == [
+        ("paragraph", "Request for proposal issued by the authority.", 0),
+        ("heading", "Scope of Work", 1),
+        ("paragraph", "The agency will run three channels.", 0),
+        ("row", "Deliverable | Due", 0),
+        ("row", "Sub item | Week 3", 0),  # nested rows come before the row that holds them
+        ("row", "Launch plan | Week 2 | Signed", 0),
+        ("heading", "Pricing", 2),
+        ("paragraph", "Fixed fee\tAED\nPaid monthly.", 0),
+    ]
+
+
+def test_text_has_the_same_lines_as_the_object_model_extractor(tender_path):
+    text = FINAL.extract_text_from_docx(tender_path)
+    assert text.startswith("Request for proposal issued by the authority.\n# Scope of Work\n")
+    assert "## Pricing" in text
+    # python-docx puts all tables before the paragraphs and skips nested tables
+    baseline = FINAL._object_model_extract_text_from_docx(tender_path)
+    assert set(baseline.splitlines()) <= set(text.splitlines())
@@ -0,0 +1,79 @@
+import types
+
+import pytest
+import torch
+
+import FINAL
+
+
+class FakeSentenceTransformer(torch.nn.Module):
+    """Records how it was loaded; holds a Linear layer so int8 quantization has something to swap"""
+
+    def __init__(self, model_name, device=None, backend="torch", model_kwargs=None, **kwargs):
+        super().__init__()
+        if backend == "onnx" and FakeSentenceTransformer.onnx_error:
+            raise FakeSentenceTransformer.onnx_error
+        self.model_name = model_name
+        self.load_backend = backend
+        self.model_kwargs = model_kwargs
+        self.dense = torch.nn.Linear(8, 4)
+
+    onnx_error = None
+
+
+@pytest.fixture
+def fake_sentence_transformers(monkeypatch):
+    FakeSentenceTransformer.onnx_error = None
+    monkeypatch.setattr(FINAL, "sentence_transformers", types.SimpleNamespace(SentenceTransformer=FakeSentenceTransformer))
+    return FakeSentenceTransformer
+
+
+def test_int8_backend_quantizes_the_linear_layers(fake_sentence_transformers):
+    model = FINAL.HierarchicalEmbeddingModel("test-model", "int8")
+    assert model.backend == "int8"
+    assert model.model.load_backend == "torch"
+    assert not isinstance(model.model.dense, torch.nn.Linear)
+    assert "quantized" in type(model.model.dense).__module__
+    assert model.model_id == "test-model@int8"
+
+
+def test_onnx_backend_loads_the_chosen_export(fake_sentence_transformers):
+    model = FINAL.HierarchicalEmbeddingModel("test-model", "onnx", "onnx/model_qint8_avx512.onnx")
+    assert model.model.load_backend == "onnx"
+    assert model.model.model_kwargs == {"file_name": "onnx/model_qint8_avx512.onnx"}
+    assert model.model_id == "test-model@onnx:onnx/model_qint8_avx512.onnx"
+
+    default_export = FINAL.HierarchicalEmbeddingModel("test-model", "onnx")
+    assert default_export.model.model_kwargs is None
+    assert default_export.model_id == "test-model@onnx"
+
+
+def test_onnx_backend_falls_back_to_torch_when_unavailable(fake_sentence_transformers, capsys):
+    fake_sentence_transformers.onnx_error = ImportError("onnxruntime is not installed")
+    model = FINAL.HierarchicalEmbeddingModel("test-model", "onnx", "onnx/model.onnx")
+    assert "Falling back to PyTorch" in capsys.readouterr().out
+    assert (model.backend, model.onnx_file) == ("torch", "")
+    assert model.model.load_backend == "torch"
+    assert model.model_id == "test-model"
+
+
+def test_from_config_reads_the_backend_and_rejects_unknown_ones(fake_sentence_transformers):
+    model = FINAL.HierarchicalEmbeddingModel.from_config("test-model", {"embedding_backend": "int8"})
+    assert model.model_id == "test-model@int8"
+    assert FINAL.HierarchicalEmbeddingModel.from_config("test-model").model_id == "test-model"
+    with pytest.raises(ValueError, match="Unknown embedding backend"):
+        FINAL.HierarchicalEmbeddingModel("test-model", "fp16")
+
+
+def test_backends_keep_separate_snapshots(kb_factory, tmp_path):
+    kb = kb_factory(3, snapshot_dir=str(tmp_path / "snapshots"))
+    torch_namespace = kb._snapshot_namespace()
+    torch_snapshot = kb.save_snapshot()
+
+    kb.model.backend = "int8"
+    assert kb._snapshot_namespace() != torch_namespace
+    with pytest.raises(FileNotFoundError):
+        kb.load_snapshot()
+    # Even pointed at it directly, the full-precision snapshot is refused
+    with pytest.raises(FINAL.SnapshotMismatchError, match="test-encoder@int8"):
+        kb.load_snapshot(torch_snapshot)
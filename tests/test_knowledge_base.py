@@ -0,0 +1,359 @@
+import gc
+import os
+
+import pytest
+
+import FINAL
+from conftest import write_response_file
+
+
+def count_builds(kb, monkeypatch):
+    builds = []
+    original = kb._build_index
+
+    def build():
+        builds.append(len(kb.documents))
+        original()
+    monkeypatch.setattr(kb, "_build_index", build)
+    return builds
+
+
+def test_compaction_drops_removed_sections_and_stays_incremental(kb_factory, monkeypatch):
+    kb = kb_factory(45)
+    builds = count_builds(kb, monkeypatch)
+
+    for index in range(14):
+        kb.remove_file(os.path.join(kb_factory.directory, f"Client_{index:03d}_Proposal_{index:03d}_RESPONSE.md"))
+    assert len(builds) == 1  # 14 of 45 files crosses the 0.3 tombstone ratio once
+    assert not kb.deleted_ids
+    assert len(kb.documents) == len(kb._live_ids()) == 31 * 3
+    assert all(doc_id < len(kb.documents) for ids in kb.file_doc_ids.values() for doc_id in ids)
+
+    # Later single-file changes stay incremental
+    kb.upsert_file(write_response_file(kb_factory.directory, 20, extra=" Updated scope."))
+    kb.upsert_file(write_response_file(kb_factory.directory, 99, extra=" Zanzibar rollout."))
+    kb.remove_file(os.path.join(kb_factory.directory, "Client_030_Proposal_030_RESPONSE.md"))
+    assert len(builds) == 1
+
+    results = kb.hybrid_search("Zanzibar rollout", k=3)
+    assert results and results[0]["document"]["filename"] == "Client_099_Proposal_099_RESPONSE.md"
+    updated = [kb.documents[doc_id] for doc_id in kb.file_doc_ids["Client_020_Proposal_020_RESPONSE.md"]]
+    assert any("Updated scope." in document["content"] for document in updated)
+
+
+def test_shards_return_the_same_top_k_as_one_index(kb_factory, embedding_model):
+    whole = kb_factory(24)
+    config = dict(whole.kb_config)
+    shards = [FINAL.ProposalKnowledgeBase(kb_factory.directory, embedding_model, dict(config, shard=[i, 3]))
+              for i in range(3)]
+    assert sorted(len(shard._live_ids()) for shard in shards) != [0, 0, len(whole._live_ids())]
+    sharded = FINAL.ShardedKnowledgeBase(shards, config)
+    try:
+        queries = ["website design weekly reporting", "crm implementation pricing AED",
+                   "proposal for client 7 covering brand identity", "milestone 91 analytics dashboard"]
+
+        def ranking(results):
+            return [(r["document"]["filename"], r["document"]["section_name"]) for r in results]
+
+        for query in queries:
+            expected = whole.hybrid_search(query, k=5)
+            actual = sharded.hybrid_search(query, k=5)
+            assert ranking(actual) == ranking(expected)
+            for got, want in zip(actual, expected):
+                assert abs(got["sparse_score"] - want["sparse_score"]) < 1e-4
+                assert abs(got["score"] - want["score"]) < 1e-5
+        assert [ranking(r) for r in sharded.search_batch(queries, k=5)] == \
+            [ranking(whole.hybrid_search(query, k=5)) for query in queries]
+    finally:
+        sharded.close()
+
+
+def test_forced_reload_rebuilds_from_the_directory_and_writes_a_fresh_snapshot(kb_factory, embedding_model,
+                                                                               tmp_path, monkeypatch):
+    kb_factory(6)
+    config = {"embedding_cache_dir": "", "snapshot_dir": str(tmp_path / "snapshots"), "dedup": {"enabled": False}}
+    FINAL.ProposalKnowledgeBase(kb_factory.directory, embedding_model, config)  # leaves a snapshot behind
+
+    service = FINAL.KnowledgeBaseService()
+    service._models[service._model_key(embedding_model.model_name, config)] = embedding_model
+    handle = service.acquire(kb_factory.directory, embedding_model.model_name, config)
+    previous = handle.kb
+    assert previous.snapshot_path is not None  # the first open attaches to the existing snapshot
+
+    opened = []
+    original = FINAL.ProposalKnowledgeBase.load_snapshot
+    monkeypatch.setattr(FINAL.ProposalKnowledgeBase, "load_snapshot",
+                        lambda self, *args: opened.append(args) or original(self, *args))
+    assert handle.reload(force=True)
+    assert not opened
+    assert handle.kb is not previous
+    assert handle.kb.snapshot_path not in (None, previous.snapshot_path)
+
+
+def test_filtered_search_reports_the_duplicate_that_matched(kb_factory):
+    shared = ("Our delivery approach pairs a discovery sprint with weekly design reviews, a staged "
+              "development plan and a launch checklist agreed with the client stakeholders. " * 3)
+    for name in ("Acme_industry_retail_Proposal_RESPONSE.md", "Sewa_industry_utilities_Proposal_RESPONSE.md"):
+        with open(os.path.join(kb_factory.directory, name), "w", encoding="utf-8") as f:
+            f.write(f"# Delivery Approach\n{shared}\n")
+    kb = kb_factory(6, dedup={"enabled": True, "min_words": 20})
+    retail, utilities = (kb.file_doc_ids[name][0] for name in ("Acme_industry_retail_Proposal_RESPONSE.md",
+                                                                "Sewa_industry_utilities_Proposal_RESPONSE.md"))
+    assert kb.duplicate_of == {utilities: retail}
+
+    for search in (lambda **f: kb.hybrid_search("discovery sprint design reviews launch checklist", k=3, **f),
+                   lambda **f: kb.search_batch(["discovery sprint design reviews launch checklist"], k=3, **f)[0]):
+        results = search(industry="utilities")
+        assert [r["document"]["filename"] for r in results] == ["Sewa_industry_utilities_Proposal_RESPONSE.md"]
+        assert results[0]["sources"] == ["Sewa_industry_utilities_Proposal_RESPONSE.md",
+                                          "Acme_industry_retail_Proposal_RESPONSE.md"]
+        assert search(industry="retail")[0]["document"]["filename"] == "Acme_industry_retail_Proposal_RESPONSE.md"
+
+
+def test_filtered_results_stay_inside_the_filter(kb_factory):
+    for index in range(4):
+        name = f"Clinic_{index}_industry_health_Proposal_RESPONSE.md"
+        with open(os.path.join(kb_factory.directory, name), "w", encoding="utf-8") as f:
+            f.write(f"# Scope of Work\nWebsite design and weekly reporting for clinic {index}.\n"
+                    f"# Pricing\nTotal fee AED {5000 + index:,} per month for website design.\n")
+    kb = kb_factory(16)
+    query = "website design weekly reporting pricing"
+    assert {r["document"]["metadata"]["client_industry"] for r in kb.hybrid_search(query, k=8)} != {"health"}
+
+    for results in (kb.hybrid_search(query, k=8, industry="health"),
+                    kb.search_batch([query, "crm implementation"], k=8, industry="health")[0]):
+        assert len(results) == 8
+        assert {r["document"]["metadata"]["client_industry"] for r in results} == {"health"}
+    assert kb.hybrid_search(query, k=8, industry="health", size="large") == []
+
+    # A filter every section passes is dropped instead of masking the whole index
+    assert kb._filter_masks({"success": True}) == (None, None, None)
+    assert kb.hybrid_search(query, k=5, success=True) == kb.hybrid_search(query, k=5)
+
+
+def test_coarse_stage_scores_only_the_closest_files(kb_factory, monkeypatch):
+    with open(os.path.join(kb_factory.directory, "Clinic_industry_health_Proposal_RESPONSE.md"), "w", encoding="utf-8") as f:
+        f.write("# Scope of Work\nSocial media strategy for a clinic.\n")
+    kb = kb_factory(16, coarse_documents=3, coarse_min_files=8)
+    query = "crm implementation weekly reporting"
+    closest = {proposal["filename"] for proposal in kb.closest_proposals(query, k=3)}
+
+    def full_index_search(*args, **kwargs):
+        raise AssertionError("the fine stage must not search the whole dense index")
+
+    monkeypatch.setattr(kb.index, "search", full_index_search)
+    results = kb.hybrid_search(query, k=5)
+    assert results and {r["document"]["filename"] for r in results} <= closest
+    assert [r["document"]["id"] for r in kb.search_batch([query], k=5)[0]] == [r["document"]["id"] for r in results]
+
+    # The closest files are picked among those passing the filter
+    filtered = kb.hybrid_search(query, k=5, industry="health")
+    assert [r["document"]["filename"] for r in filtered] == ["Clinic_industry_health_Proposal_RESPONSE.md"]
+
+
+def test_coarse_stage_is_off_below_the_file_count_threshold(kb_factory):
+    kb = kb_factory(16, coarse_documents=3, coarse_min_files=16)
+    assert kb._coarse_candidates(kb._encode_queries(["crm implementation"])) is None
+
+
+def test_snapshots_still_mapped_by_a_swapped_out_instance_are_not_pruned(kb_factory, embedding_model, tmp_path):
+    kb_factory(6)
+    config = {"embedding_cache_dir": "", "snapshot_dir": str(tmp_path / "snapshots"), "dedup": {"enabled": False},
+              "snapshots_to_keep": 1}
+    FINAL.ProposalKnowledgeBase(kb_factory.directory, embedding_model, config)  # leaves a snapshot behind
+
+    service = FINAL.KnowledgeBaseService()
+    service._models[service._model_key(embedding_model.model_name, config)] = embedding_model
+    handle = service.acquire(kb_factory.directory, embedding_model.model_name, config)
+    in_flight = handle.kb  # e.g. held by a search that started before the reloads
+    mapped = in_flight.snapshot_path
+    expected = in_flight.hybrid_search("website design weekly reporting", k=3)
+
+    for index in (20, 21, 22):
+        assert handle.apply_file_changes([write_response_file(kb_factory.directory, index)])
+    assert os.path.isdir(mapped)
+    assert in_flight.hybrid_search("website design weekly reporting", k=3) == expected
+
+    del in_flight, expected
+    gc.collect()
+    assert handle.apply_file_changes([write_response_file(kb_factory.directory, 23)])
+    assert not os.path.exists(mapped)
+
+
+def test_multi_hop_always_refines_and_merges_the_hops_by_rank(kb_factory):
+    def result(doc_id, score):
+        return {"document": {"id": doc_id, "content": f"section {doc_id}"}, "score": score}
+
+    class TwoHops(FINAL.MultiHopSearchMixin):
+        kb_config = {}
+
+        def __init__(self):
+            self.queries = []
+
+        def hybrid_search(self, query, k=5, **filters):
+            self.queries.append(query)
+            if len(self.queries) == 1:
+                return [dict(result(doc_id, 0.2), fused_score=0.03) for doc_id in "abcdef"]
+            # The second hop's results only carry cosine scores, on another scale than fused scores
+            return [result("b", 0.95), result("x", 0.9)]
+
+    search = TwoHops()
+    assert [r["document"]["id"] for r in search.multi_hop_search("query", k=4)] == ["b", "a", "x", "c"]
+    assert len(search.queries) == 2
+
+    search = TwoHops()
+    search.kb_config = {"multi_hop_always_refine": False}
+    assert [r["document"]["id"] for r in search.multi_hop_search("query", k=4)] == ["a", "b", "c", "d"]
+    assert len(search.queries) == 1
+
+    kb = kb_factory(10)
+    queries = ["website design weekly reporting", "crm implementation pricing"]
+    assert [[r["document"]["id"] for r in results] for results in kb.multi_hop_search_batch(queries, k=3)] == \
+        [[r["document"]["id"] for r in kb.multi_hop_search(query, k=3)] for query in queries]
+
+
+def test_search_batch_matches_hybrid_search_query_by_query(kb_factory):
+    kb = kb_factory(12)
+    queries = ["website design weekly reporting", "crm implementation", "website design weekly reporting",
+               "team golf milestone", "no such words anywhere"]
+
+    def ids(results):
+        return [(r["document"]["id"], round(r["score"], 6), round(r["sparse_score"], 6)) for r in results]
+
+    expected = [ids(kb.hybrid_search(query, k=4)) for query in queries]
+    kb.result_cache.clear()
+    assert [ids(results) for results in kb.search_batch(queries, k=4)] == expected
+    assert kb.search_batch([], k=4) == []
+
+    # Results come back as copies, so callers cannot corrupt the result cache
+    kb.search_batch(queries[:1], k=4)[0][0]["score"] = -1.0
+    assert ids(kb.search_batch(queries[:1], k=4)[0]) == expected[0]
+
+
+def test_lru_cache_evicts_the_least_recently_used_entry():
+    cache = FINAL.LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None and cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats() == {"entries": 2, "max_entries": 2, "hits": 3, "misses": 1, "evictions": 1, "hit_rate": 0.75}
+    disabled = FINAL.LRUCache(0)
+    disabled.put("a", 1)
+    assert disabled.get("a") is None
+
+
+def test_cached_results_are_dropped_when_the_index_version_changes(kb_factory, monkeypatch):
+    kb = kb_factory(6)
+    query = "website design weekly reporting"
+    first = kb.hybrid_search(query, k=3)
+    encoded = []
+    original_encode = kb.model.encode
+    monkeypatch.setattr(kb.model, "encode", lambda texts, *args, **kwargs: encoded.append(texts) or original_encode(texts, *args, **kwargs))
+
+    assert kb.hybrid_search(query, k=3) == first
+    assert kb.cache_stats()["results"]["hits"] == 1
+    assert len(kb.hybrid_search(query, k=2)) == 2  # another k is another entry, but the query vector is reused
+    assert encoded == []
+
+    version = kb.version
+    kb.upsert_file(write_response_file(kb_factory.directory, 1, extra=" website design weekly reporting website design"))
+    assert kb.version > version
+    refreshed = kb.hybrid_search(query, k=3)
+    assert refreshed[0]["document"]["filename"] == "Client_001_Proposal_001_RESPONSE.md"
+    assert refreshed != first
+    assert [texts for texts in encoded if query in texts] == []  # query vectors do not depend on the index
+
+
+def test_facet_index_intersects_facets_and_unions_value_lists():
+    facets = FINAL.FacetIndex()
+    rows = [("retail", True, "large"), ("Retail", False, "small"), ("health", True, "large"), ("utilities", True, "small")]
+    for doc_id, (industry, success, size) in enumerate(rows):
+        facets.add(doc_id, {"industry": industry, "success": success, "size": size, "client": f"c{doc_id}"})
+    assert facets.match({}) is None and facets.match({"industry": None}) is None
+    assert facets.match({"industry": "RETAIL"}).tolist() == [0, 1]
+    assert facets.match({"industry": ["retail", "health"], "size": "large"}).tolist() == [0, 2]
+    assert facets.match({"industry": "retail", "success": True}).tolist() == [0]
+    assert facets.match({"industry": "mining"}).tolist() == []
+    with pytest.raises(ValueError, match="Unknown search filter"):
+        facets.match({"colour": "red"})
+
+    facets.remove([0])
+    assert facets.values("industry") == {"health": 1, "retail": 1, "utilities": 1}
+    assert facets.match({"size": "large"}).tolist() == [2]
+
+
+def test_facet_filters_follow_file_updates(kb_factory):
+    kb = kb_factory(4)
+    path = os.path.join(kb_factory.directory, "Nova_industry_energy_Proposal_RESPONSE.md")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("# Scope of Work\nGrid analytics dashboard.\n")
+    kb.upsert_file(path)
+    assert [r["document"]["filename"] for r in kb.hybrid_search("analytics dashboard", k=5, industry="energy")] == \
+        ["Nova_industry_energy_Proposal_RESPONSE.md"]
+    os.remove(path)
+    kb.remove_file(path)
+    assert kb.hybrid_search("analytics dashboard", k=5, industry="energy") == []
+    assert "energy" not in kb.facet_values("industry")
+
+
+def test_closest_proposals_ranks_files_by_their_pooled_vectors(kb_factory):
+    with open(os.path.join(kb_factory.directory, "Nova_industry_energy_Proposal_RESPONSE.md"), "w", encoding="utf-8") as f:
+        f.write("# Introduction\nSolar farm telemetry for the grid operator.\n# Pricing\nFixed fee for turbine monitoring.\n")
+    kb = kb_factory(8)
+    sections = ["Solar farm telemetry for the grid operator.", "Fixed fee for turbine monitoring."]
+
+    for query in (" ".join(sections), sections):
+        proposals = kb.closest_proposals(query, k=3)
+        assert proposals[0]["filename"] == "Nova_industry_energy_Proposal_RESPONSE.md"
+        assert proposals[0]["sections"] == 2
+        assert [p["score"] for p in proposals] == sorted((p["score"] for p in proposals), reverse=True)
+    assert len(kb.closest_proposals("website design", k=20)) == 9
+    assert [p["filename"] for p in kb.closest_proposals("website design", k=3, industry="energy")] == \
+        ["Nova_industry_energy_Proposal_RESPONSE.md"]
+    assert kb.closest_proposals(sections, k=3, industry="retail") == []
+
+    # The document level is rebuilt after a change, so a removed file is never proposed
+    kb.remove_file(os.path.join(kb_factory.directory, "Nova_industry_energy_Proposal_RESPONSE.md"))
+    assert "Nova_industry_energy_Proposal_RESPONSE.md" not in \
+        [p["filename"] for p in kb.closest_proposals(sections, k=20)]
+
+
+def test_near_duplicate_index_matches_edited_copies_only_above_the_threshold():
+    detector = FINAL.NearDuplicateIndex(threshold=0.8, min_words=10)
+    words = [f"word{i}" for i in range(60)]
+    detector.add(0, detector.signature(" ".join(words)))
+    assert detector.query(detector.signature(" ".join(words[:-1] + ["changed"]))) == 0
+    assert detector.query(detector.signature(" ".join(reversed(words)))) is None
+    assert detector.signature("too short to deduplicate") is None
+    detector.remove(0)
+    assert detector.query(detector.signature(" ".join(words))) is None
+
+
+def test_collapsed_sections_keep_every_source_and_survive_removing_the_canonical_copy(kb_factory):
+    shared = ("Our delivery approach pairs a discovery sprint with weekly design reviews and a launch checklist. "
+              + " ".join(f"clause{i}" for i in range(80)))
+    names = ["Acme_Proposal_RESPONSE.md", "Bolt_Proposal_RESPONSE.md", "Cove_Proposal_RESPONSE.md"]
+    for name, ending in zip(names, ["", "", " Signed off by the account lead."]):
+        with open(os.path.join(kb_factory.directory, name), "w", encoding="utf-8") as f:
+            f.write(f"# Delivery Approach\n{shared}{ending}\n")
+    kb = kb_factory(4, dedup={"enabled": True, "min_words": 20})
+    ids = {kb.file_doc_ids[name][0]: name for name in names}
+    canonical = min(ids) # sections are checked in load order, so the first one loaded is kept
+    assert kb.duplicate_of == {doc_id: canonical for doc_id in ids if doc_id != canonical}
+    for doc_id, name in ids.items():
+        assert kb.section_sources(doc_id)[0] == name
+        assert sorted(kb.section_sources(doc_id)) == names
+
+    query = "discovery sprint design reviews launch checklist"
+    hits = [r for r in kb.hybrid_search(query, k=3) if r["document"]["filename"] in names]
+    assert [r["document"]["filename"] for r in hits] == [ids[canonical]]
+    assert sorted(hits[0]["sources"]) == names
+
+    # Another copy becomes canonical and still carries the remaining one
+    kb.remove_file(os.path.join(kb_factory.directory, ids.pop(canonical)))
+    heir, other = sorted(ids)
+    assert kb.duplicate_of == {other: heir}
+    hits = [r for r in kb.hybrid_search(query, k=3) if r["document"]["filename"] in names]
+    assert [r["document"]["filename"] for r in hits] == [ids[heir]]
+    assert hits[0]["sources"] == [ids[heir], ids[other]]
@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+import threading
+
+import FINAL
+
+HEAVY_MODULES = ["faiss", "torch", "sentence_transformers", "transformers", "openai", "sklearn", "scipy",
+                 "docx", "lxml", "PyPDF2", "fitz", "onnxruntime"]
+
+
+def test_importing_the_app_loads_none_of_the_heavy_modules():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = ("import sys, json, FINAL; "
+              f"print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))")
+    output = subprocess.run([sys.executable, "-c", script], cwd=root, capture_output=True, text=True, check=True)
+    assert output.stdout.strip().splitlines()[-1] == "[]"
+
+
+def test_lazy_module_imports_once_on_first_use_and_records_the_time():
+    module = FINAL.LazyModule("json.decoder")
+    assert "not loaded" in repr(module)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(module.JSONDecoder)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(results)) == 1
+    assert "(loaded)" in repr(module)
+    assert FINAL.IMPORT_TIMINGS["json.decoder"] >= 0
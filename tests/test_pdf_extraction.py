@@ -0,0 +1,78 @@
+import pytest
+
+import FINAL
+
+pytest.importorskip("PyPDF2")
+
+
+def write_pdf(path, page_texts):
+    """Minimal PDF with one line of Helvetica text per page"""
+    count = len(page_texts)
+    font_id = 3 + 2 * count
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>",
+               b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % (3 + 2 * i) for i in range(count)), count)]
+    for i, text in enumerate(page_texts):
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents %d 0 R "
+                       b"/Resources << /Font << /F1 %d 0 R >> >> >>" % (4 + 2 * i, font_id))
+        stream = b"BT /F1 12 Tf 72 720 Td (%s) Tj ET" % text.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    data, offsets = b"%PDF-1.4\n", []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    path.write_bytes(data)
+    return str(path)
+
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    return write_pdf(tmp_path / "rfp.pdf", [f"Requirement page {n} of the tender" for n in range(7)])
+
+
+def make_extractor(tmp_path, **settings):
+    defaults = {"pdf_executor": "thread", "pdf_workers": 1, "page_cache_dir": str(tmp_path / "pages")}
+    return FINAL.PdfPageExtractor({**defaults, **settings})
+
+
+def test_pages_come_back_in_order_with_progress(tmp_path, pdf_path):
+    extractor = make_extractor(tmp_path)
+    progress = []
+    text = extractor.extract(pdf_path, lambda done, total: progress.append((done, total)))
+    assert text.splitlines() == [f"Requirement page {n} of the tender" for n in range(7)]
+    assert progress == [(n, 7) for n in range(1, 8)]
+
+
+def test_worker_pool_matches_serial_extraction(tmp_path, pdf_path):
+    serial = make_extractor(tmp_path, page_cache_dir="").extract(pdf_path)
+    pooled = make_extractor(tmp_path, page_cache_dir="", pdf_workers=3, pdf_parallel_min_pages=2, pdf_pages_per_task=2)
+    try:
+        assert pooled.extract(pdf_path) == serial
+        assert pooled._executor is not None
+    finally:
+        pooled.shutdown()
+
+
+def test_cached_pages_are_not_extracted_again(tmp_path, pdf_path, monkeypatch):
+    extractor = make_extractor(tmp_path)
+    pages = extractor.iter_pages(pdf_path)
+    first = [next(pages) for _ in range(3)]
+    pages.close() # stopping early still caches the finished pages
+
+    extracted = []
+    serial = FINAL.PdfPageExtractor._extract_serially
+    monkeypatch.setattr(FINAL.PdfPageExtractor, "_extract_serially", staticmethod(
+        lambda file_path, page_numbers: (extracted.append(n) or (n, text) for n, text in serial(file_path, page_numbers))))
+    resumed = make_extractor(tmp_path)
+    assert list(resumed.iter_pages(pdf_path))[:3] == first
+    assert extracted == [3, 4, 5, 6]
+
+    extracted.clear()
+    text = make_extractor(tmp_path).extract(pdf_path)
+    assert extracted == []
+    assert text.splitlines()[-1] == "Requirement page 6 of the tender"
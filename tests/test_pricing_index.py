@@ -0,0 +1,65 @@
+import json
+import os
+
+import pytest
+
+import FINAL
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Total fee AED 3 200,00 per month", [(3200.0, "AED")]),
+    ("Retainer of AED 10 000 monthly", [(10000.0, "AED")]),
+    ("USD 1,250.50 per sprint", [(1250.5, "USD")]),
+    ("EUR 4500,00 one-off", [(4500.0, "EUR")]),
+    ("45,000 AED for phase one", [(45000.0, "AED")]),
+    ("$2.5 million over three years", [(2500000.0, "USD")]),
+    ("AED2,2I9", []),
+    ("|Animator CGI|AED 800,00|AED 3 200,00|AED 2 Ooo,00|", [(800.0, "AED"), (3200.0, "AED")]),
+    ("AED 2 OOO for the shoot", []),
+    ("AED 50 100 hours", []),
+    ("AED 10 000 per month", [(10000.0, "AED")]),
+    ("12 500 AED", [(12500.0, "AED")]),
+    ("AED 1,5 million", [(1500000.0, "AED")]),
+    ("AED 750 for table rental", [(750.0, "AED")]),
+])
+def test_parse_amounts(text, expected):
+    assert FINAL.PricingIndex.parse_amounts(text) == expected
+
+
+def test_cleaned_currency_symbols_leave_no_truncated_amounts():
+    cleaned = FINAL.remove_problematic_chars("Budget € 300 or £400, i.e. GBP 400")
+    assert FINAL.PricingIndex.parse_amounts(cleaned) == [(400.0, "GBP")]
+
+
+def write_priced_file(directory, name, body):
+    with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+        f.write(f"# Pricing\n{body}\n")
+
+
+def test_collapsed_copies_are_priced_once(kb_factory):
+    quote = ("Monthly retainer covering strategy, content production, community management, paid media "
+             "optimisation and reporting. Total fee AED 48,000 per month, payable in advance, excluding VAT. ") * 2
+    write_priced_file(kb_factory.directory, "Acme_Proposal_RESPONSE.md", quote)
+    write_priced_file(kb_factory.directory, "Copy_of_Acme_Proposal_RESPONSE.md", quote)
+    kb = kb_factory(3, dedup={"enabled": True, "min_words": 20})
+    assert len(kb.duplicate_of) == 1
+    assert kb.extract_pricing_from_kb().count(48000.0) == 2  # "AED 48,000" twice in one canonical section
+
+    kb.remove_file(os.path.join(kb_factory.directory, "Acme_Proposal_RESPONSE.md"))
+    assert kb.extract_pricing_from_kb().count(48000.0) == 2  # the copy took over
+
+
+def test_pricing_scope_prefers_the_client_then_the_rfp_industry(kb_factory):
+    write_priced_file(kb_factory.directory, "Clinic_industry_health_Proposal_RESPONSE.md", "Total fee AED 90,000.")
+    with open(os.path.join(kb_factory.directory, "files_index.json"), "w", encoding="utf-8") as f:
+        json.dump([{"markdown_file": "markdown_responses\\Clinic_industry_health_Proposal_RESPONSE.md",
+                    "client": "Clinic Group", "project": "Patient campaigns"}], f)
+    kb = kb_factory(4)
+    generator = FINAL.EnhancedProposalGenerator(kb, openai_key="test")
+
+    description, stats = generator.pricing_scope("Clinic Group", "An aviation RFP.")
+    assert description == "past proposals for Clinic Group" and stats["AED"]["count"] == 1
+    description, stats = generator.pricing_scope("New Client", "A health authority RFP for patient campaigns.")
+    assert description == "past health proposals" and stats["AED"]["count"] == 1
+    description, stats = generator.pricing_scope("New Client", "An aviation RFP.")
+    assert description == "all past proposals" and stats["AED"]["count"] == 5
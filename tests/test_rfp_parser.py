@@ -0,0 +1,68 @@
+import re
+
+import FINAL
+
+RFP_TEXT = """This request invites agencies to bid.
+1. Introduction
+The authority seeks a digital partner, starting in 2025.
+2. Scope of Work
+2.1. Website Redesign
+Rebuild the portal, with accessibility.
+2.2. Social Media Management
+Run campaigns on three channels.
+SECTION 3: Pricing
+Quote a fixed fee, in AED.
+EVALUATION CRITERIA:
+Price 40%, quality 60%.
+"""
+
+
+def line_by_line_sections(rfp_text):
+    """The line-by-line parser parse_rfp replaced, kept as the reference for the flat map"""
+    patterns = [r'^(?:\d+\.)?(?:\d+\.)?(?:\d+\.)?\s*([A-Z][A-Za-z\s]+)$',
+                r'^([A-Z][A-Z\s]+)(?:\:|\.)?\s*$',
+                r'^(?:Section|SECTION)\s+\d+\s*[\:\-\.]\s*([A-Za-z\s]+)$']
+    sections, current_section, current_content = {}, "Overview", []
+    for line in FINAL.remove_problematic_chars(rfp_text).split('\n'):
+        match = next((m for m in (re.match(p, line.strip()) for p in patterns) if m), None)
+        if match is None:
+            current_content.append(line)
+            continue
+        if current_content:
+            sections[current_section] = '\n'.join(current_content)
+            current_content = []
+        current_section = match.group(1).strip()
+    if current_content:
+        sections[current_section] = '\n'.join(current_content)
+    return sections
+
+
+def test_flat_sections_match_the_line_by_line_parser():
+    assert FINAL.extract_sections_from_rfp(RFP_TEXT) == line_by_line_sections(RFP_TEXT)
+
+
+def test_headings_nest_by_number_and_style():
+    structure = FINAL.parse_rfp(RFP_TEXT)
+    outline = structure.outline()
+    assert [(c["number"], c["title"], c["level"]) for c in outline["children"]] == [
+        ("1.", "Introduction", 1), ("2.", "Scope of Work", 1), ("3", "Pricing", 1), ("", "EVALUATION CRITERIA", 1)]
+    assert [c["title"] for c in outline["children"][1]["children"]] == ["Website Redesign", "Social Media Management"]
+    assert outline["subtree_end"] == len(structure.text)
+
+
+def test_lookups_by_title_words_and_introductory_headings():
+    structure = FINAL.parse_rfp(RFP_TEXT)
+    assert structure.content_for("social media") == "Run campaigns on three channels."
+    assert structure.content_for("Pricing and payment terms") == "Quote a fixed fee, in AED."
+    # A heading without text of its own stands for its subsections
+    scope = structure.content_for("SCOPE OF WORK")
+    assert scope.startswith("2.1. Website Redesign") and scope.endswith("Run campaigns on three channels.")
+    assert structure.content_for("timeline") == ""
+    assert structure.find("") is None
+
+
+def test_repeated_headings_are_merged_and_parses_are_cached():
+    text = "Deliverables\nMonthly reports.\nTimeline\nSix months.\nDeliverables\nA launch plan.\n"
+    assert FINAL.extract_sections_from_rfp(text)["Deliverables"] == "Monthly reports.\n\nA launch plan.\n"
+    assert FINAL.parse_rfp(text) is FINAL.parse_rfp(text)
+    assert FINAL.parse_rfp("No headings here, only text.").to_dict() == {"Overview": "No headings here, only text."}
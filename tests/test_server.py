@@ -0,0 +1,90 @@
+import os
+import threading
+
+import pytest
+
+import FINAL
+from conftest import write_response_file
+
+pytest.importorskip("flask")
+from werkzeug.serving import make_server  # noqa: E402
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(kb, socket_path=None):
+        host = f"unix://{socket_path}" if socket_path else "127.0.0.1"
+        server = make_server(host, 0, FINAL.create_kb_app(kb), threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return host if socket_path else f"http://127.0.0.1:{server.server_port}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def test_remote_shards_apply_file_changes_and_sync(kb_factory, embedding_model, serve):
+    config = dict(kb_factory(6).kb_config)
+    shards = [FINAL.ProposalKnowledgeBase(kb_factory.directory, embedding_model, dict(config, shard=[i, 2]))
+              for i in range(2)]
+    sharded = FINAL.ShardedKnowledgeBase.with_remote_shards([serve(shard) for shard in shards], config)
+    try:
+        def filenames(query):
+            return {r["document"]["filename"] for r in sharded.hybrid_search(query, k=10)}
+
+        path = write_response_file(kb_factory.directory, 40, extra=" zanzibar rollout")
+        assert sharded.upsert_file(path)
+        assert "Client_040_Proposal_040_RESPONSE.md" in filenames("zanzibar rollout")
+        assert not sharded.upsert_file(path)  # Unchanged on disk
+
+        os.remove(path)
+        assert sharded.remove_file(path)
+        assert "Client_040_Proposal_040_RESPONSE.md" not in filenames("zanzibar rollout")
+
+        paths = [write_response_file(kb_factory.directory, index, extra=" quokka launch") for index in (41, 42, 43)]
+        assert sharded.apply_file_changes(paths)
+        assert {os.path.basename(p) for p in paths} <= filenames("quokka launch")
+
+        os.remove(paths[0])
+        assert sharded.sync_with_directory()
+        assert not sharded.sync_with_directory()
+        assert os.path.basename(paths[0]) not in filenames("quokka launch")
+    finally:
+        sharded.close()
+
+
+@pytest.mark.parametrize("transport", ["tcp", "unix"])
+def test_remote_client_answers_like_the_served_knowledge_base(kb_factory, embedding_model, serve, tmp_path, transport):
+    with open(os.path.join(kb_factory.directory, "Clinic_industry_health_Proposal_RESPONSE.md"), "w", encoding="utf-8") as f:
+        f.write("# Pricing\nTotal fee AED 7,500 per month for website design.\n")
+    local = kb_factory(6)
+    service = FINAL.KnowledgeBaseService()
+    service._models[service._model_key(embedding_model.model_name, local.kb_config)] = embedding_model
+    handle = service.acquire(kb_factory.directory, embedding_model.model_name, local.kb_config)
+    remote = FINAL.RemoteKnowledgeBase(serve(handle, str(tmp_path / "kb.sock") if transport == "unix" else None))
+
+    def plain(results):
+        return [(r["document"]["filename"], r["document"]["section_name"], round(r["score"], 5)) for r in results]
+
+    assert remote.health()["status"] == "ok"
+    query = "website design weekly reporting"
+    assert plain(remote.hybrid_search(query, k=4)) == plain(local.hybrid_search(query, k=4))
+    assert plain(remote.hybrid_search(query, k=4, industry="health")) == plain(local.hybrid_search(query, k=4, industry="health"))
+    assert [plain(r) for r in remote.search_batch([query, "crm"], k=3)] == [plain(r) for r in local.search_batch([query, "crm"], k=3)]
+    assert plain(remote.multi_hop_search(query, k=3)) == plain(local.multi_hop_search(query, k=3))
+    assert remote.get_all_section_names() == local.get_all_section_names()
+    assert [d["content"] for d in remote.get_section_documents("Pricing")] == \
+        [d["content"] for d in local.get_section_documents("Pricing")]
+    assert remote.facet_values("industry") == local.facet_values("industry")
+    assert remote.extract_pricing_from_kb(industry="health") == local.extract_pricing_from_kb(industry="health") == [7500.0]
+    assert remote.pricing_summary() == local.pricing_summary()
+    assert remote.closest_proposals(query, k=2) == local.closest_proposals(query, k=2)
+    assert remote.cache_stats()["results"]["misses"] > 0
+
+    with pytest.raises(ValueError, match="Unknown search filter"):
+        remote.hybrid_search(query, k=3, colour="red")
+    with pytest.raises(ValueError, match="Unknown facet"):
+        remote.facet_values("colour")
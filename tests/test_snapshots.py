@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+import pytest
+
+import FINAL
+from conftest import write_response_file
+
+
+def snapshot_config(tmp_path, **config):
+    return dict({"embedding_cache_dir": "", "snapshot_dir": str(tmp_path / "snapshots"), "dedup": {"enabled": False}},
+                **config)
+
+
+def ranking(results):
+    return [(r["document"]["filename"], r["document"]["section_name"], round(r["score"], 5)) for r in results]
+
+
+def test_reopening_maps_the_snapshot_and_searches_like_the_build(kb_factory, embedding_model, tmp_path, monkeypatch):
+    config = snapshot_config(tmp_path)
+    built = kb_factory(8, **config)
+    assert built.snapshot_path is not None and os.path.exists(os.path.join(built.snapshot_path, "manifest.json"))
+
+    monkeypatch.setattr(FINAL.ProposalKnowledgeBase, "_build_index",
+                        lambda self: (_ for _ in ()).throw(AssertionError("the snapshot should have been used")))
+    reopened = FINAL.ProposalKnowledgeBase(kb_factory.directory, embedding_model, config)
+    assert reopened.snapshot_path == built.snapshot_path
+    assert isinstance(reopened.passages, np.memmap)
+    assert isinstance(reopened.sparse_index.posting_docs, np.memmap)
+    assert reopened.documents.read_only
+    for query in ("website design weekly reporting", "Total fee AED pricing", "team delta"):
+        assert ranking(reopened.hybrid_search(query, k=5)) == ranking(built.hybrid_search(query, k=5))
+    assert reopened.extract_pricing_from_kb() == built.extract_pricing_from_kb()
+
+
+def test_reopening_catches_up_with_directory_changes(kb_factory, embedding_model, tmp_path):
+    config = snapshot_config(tmp_path)
+    built = kb_factory(6, **config)
+    write_response_file(kb_factory.directory, 30, extra=" okapi roadmap")
+    os.remove(os.path.join(kb_factory.directory, "Client_002_Proposal_002_RESPONSE.md"))
+
+    reopened = FINAL.ProposalKnowledgeBase(kb_factory.directory, embedding_model, config)
+    assert reopened.snapshot_path != built.snapshot_path  # the catch-up is saved as a new version
+    assert "Client_002_Proposal_002_RESPONSE.md" not in reopened.file_doc_ids
+    assert reopened.hybrid_search("okapi roadmap", k=1)[0]["document"]["filename"] == "Client_030_Proposal_030_RESPONSE.md"
+    # The original instance keeps serving its own mapped version
+    assert "Client_002_Proposal_002_RESPONSE.md" in built.file_doc_ids
+
+
+def test_a_snapshot_built_with_other_settings_is_rebuilt(kb_factory, embedding_model, tmp_path):
+    config = snapshot_config(tmp_path)
+    built = kb_factory(4, **config)
+    other = dict(config, dedup={"enabled": True, "min_words": 5})
+    rebuilt = FINAL.ProposalKnowledgeBase(kb_factory.directory, embedding_model, other)
+    assert rebuilt.snapshot_path != built.snapshot_path
+    assert not isinstance(rebuilt.passages, np.memmap)  # built in memory, not mapped
+
+    with pytest.raises(FINAL.SnapshotMismatchError, match="deduplicated"):
+        FINAL.ProposalKnowledgeBase(kb_factory.directory, embedding_model, config).load_snapshot(rebuilt.snapshot_path)
@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+
+import pytest
+
+import FINAL
+from conftest import write_response_file
+
+pytest.importorskip("watchdog")
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_bursts_of_events_are_reported_as_one_debounced_batch(tmp_path):
+    batches = []
+    delivered = threading.Event()
+    watcher = FINAL.KnowledgeBaseWatcher(str(tmp_path), lambda paths: batches.append(paths) or delivered.set(),
+                                         debounce_seconds=0.3).start()
+    try:
+        for index in range(3):
+            for _ in range(3):
+                write_response_file(str(tmp_path), index)
+        (tmp_path / "notes.docx").write_bytes(b"ignored")
+        assert delivered.wait(10)
+        time.sleep(0.5)
+        assert len(batches) == 1
+        assert [os.path.basename(path) for path in batches[0]] == \
+            [f"Client_{index:03d}_Proposal_{index:03d}_RESPONSE.md" for index in range(3)]
+    finally:
+        watcher.stop()
+
+
+def test_a_failing_callback_keeps_the_watcher_running(tmp_path, capsys):
+    calls = []
+
+    def on_change(paths):
+        calls.append(paths)
+        if len(calls) == 1:
+            raise RuntimeError("disk full")
+
+    watcher = FINAL.KnowledgeBaseWatcher(str(tmp_path), on_change, debounce_seconds=0.1).start()
+    try:
+        write_response_file(str(tmp_path), 1)
+        assert wait_for(lambda: len(calls) == 1)
+        write_response_file(str(tmp_path), 2)
+        assert wait_for(lambda: len(calls) == 2)
+    finally:
+        watcher.stop()
+    assert "hot reload failed (disk full)" in capsys.readouterr().out
+
+
+def test_the_service_swaps_in_watched_changes(kb_factory, embedding_model):
+    config = dict(kb_factory(4).kb_config, watch_directory=True, watch_debounce_seconds=0.2)
+    service = FINAL.KnowledgeBaseService()
+    service._models[service._model_key(embedding_model.model_name, config)] = embedding_model
+    handle = service.acquire(kb_factory.directory, embedding_model.model_name, config)
+    before = handle.kb
+
+    write_response_file(kb_factory.directory, 9, extra=" axolotl")
+    assert wait_for(lambda: "Client_009_Proposal_009_RESPONSE.md" in handle.file_doc_ids)
+    assert handle.kb is not before
+    assert "Client_009_Proposal_009_RESPONSE.md" not in before.file_doc_ids  # the old instance was never mutated
+
+    os.remove(os.path.join(kb_factory.directory, "Client_000_Proposal_000_RESPONSE.md"))
+    assert wait_for(lambda: "Client_000_Proposal_000_RESPONSE.md" not in handle.file_doc_ids)
+    assert not handle.refresh_if_stale()  # the watcher replaces polling
+    service._release(handle._key)